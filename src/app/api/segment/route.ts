@@ -1,11 +1,46 @@
 import { NextResponse } from 'next/server';
-import { spawn } from 'child_process';
-import path from 'path';
+import { getSegmentWorker } from '@/lib/segmentWorker';
+
+// Note: segmentation runs in a persistent local python worker (see src/lib/segmentWorker.ts).
+// For production deployment (e.g. Vercel), this will FAIL unless the environment is set up exactly the same way (which is hard on Vercel serverless).
+// If deploying to Vercel, you cannot use local conda environments or spawn python scripts easily without custom build steps or using a separate backend.
+
+export async function GET() {
+    try {
+        const health = await getSegmentWorker().health();
+        return NextResponse.json(health, { status: health.ready ? 200 : 503 });
+    } catch (error: any) {
+        return NextResponse.json(
+            { status: 'error', ready: false, error: error.message },
+            { status: 503 }
+        );
+    }
+}
+
+// Forward each mask as its own NDJSON line as soon as python has encoded it,
+// finishing with the python "summary" record (or an error record).
+function streamSegmentation(payload: Record<string, any>) {
+    const encoder = new TextEncoder();
+    const body = new ReadableStream({
+        start(controller) {
+            const send = (record: Record<string, any>) => {
+                controller.enqueue(encoder.encode(JSON.stringify(record) + '\n'));
+            };
+            getSegmentWorker()
+                .request({ ...payload, stream: true }, send)
+                .then(send, (error: Error) => send({ error: error.message || 'Failed to segment image' }))
+                .finally(() => controller.close());
+        },
+    });
+    return new Response(body, {
+        headers: { 'Content-Type': 'application/x-ndjson' },
+    });
+}
 
 export async function POST(request: Request) {
     try {
         const body = await request.json();
-        const { imageBase64 } = body;
+        const { imageBase64, prompts, boxes, points, maskFormat, stream } = body;
 
         if (!imageBase64) {
             return NextResponse.json(
@@ -14,61 +49,21 @@ export async function POST(request: Request) {
             );
         }
 
-        // Path to the python script
-        const scriptPath = path.join(process.cwd(), 'src', 'scripts', 'segment.py');
-        
-        // Use the python executable from the conda environment
-        // Note: This path is specific to the local machine setup. 
-        // For production deployment (e.g. Vercel), this will FAIL unless the environment is set up exactly the same way (which is hard on Vercel serverless).
-        // If deploying to Vercel, you cannot use local conda environments or spawn python scripts easily without custom build steps or using a separate backend.
-        const pythonExec = '/opt/miniconda3/envs/sam3_env/bin/python';
+        const payload = { imageBase64, prompts, boxes, points, maskFormat };
 
-        return new Promise((resolve) => {
-            const pythonProcess = spawn(pythonExec, [scriptPath]);
-            
-            let dataString = '';
-            let errorString = '';
-
-            // Send data to python script
-            pythonProcess.stdin.write(JSON.stringify({ imageBase64 }));
-            pythonProcess.stdin.end();
-
-            pythonProcess.stdout.on('data', (data) => {
-                dataString += data.toString();
-            });
-
-            pythonProcess.stderr.on('data', (data) => {
-                errorString += data.toString();
-                console.error('Python Error:', data.toString());
-            });
-
-            pythonProcess.on('close', (code) => {
-                if (code !== 0) {
-                    resolve(NextResponse.json(
-                        { error: `Process exited with code ${code}`, details: errorString },
-                        { status: 500 }
-                    ));
-                    return;
-                }
+        if (stream) {
+            return streamSegmentation(payload);
+        }
 
-                try {
-                    const result = JSON.parse(dataString);
-                    if (result.error) {
-                        resolve(NextResponse.json(
-                            { error: result.error },
-                            { status: 500 }
-                        ));
-                    } else {
-                        resolve(NextResponse.json(result));
-                    }
-                } catch (e) {
-                    resolve(NextResponse.json(
-                        { error: 'Failed to parse python output', raw: dataString },
-                        { status: 500 }
-                    ));
-                }
-            });
-        });
+        // Several prompts share a single encoder pass on the python side
+        const result = await getSegmentWorker().request(payload);
+        if (result.error) {
+            return NextResponse.json(
+                { error: result.error },
+                { status: 500 }
+            );
+        }
+        return NextResponse.json(result);
 
     } catch (error: any) {
         console.error('Segmentation error:', error);
@@ -77,4 +72,4 @@ export async function POST(request: Request) {
             { status: 500 }
         );
     }
-}
\ No newline at end of file
+}
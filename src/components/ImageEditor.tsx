@@ -123,40 +123,69 @@ export default function ImageEditor({
           // Get base64 of current image
           const imageBase64 = await imageToBase64(currentImageUrl);
           
+          // Ask for a stream so masks show up on the canvas as soon as each one is ready
           const response = await fetch('/api/segment', {
               method: 'POST',
               headers: { 'Content-Type': 'application/json' },
-              body: JSON.stringify({ imageBase64 })
+              body: JSON.stringify({ imageBase64, stream: true })
           });
-          
-          const data = await response.json();
-          
-          if (data.error) throw new Error(data.error);
-          
-          if (data.type === 'image') {
-              canvasRef.current?.drawMask(data.data);
-          } else if (data.type === 'masks' && Array.isArray(data.data)) {
-              // Composite masks
-              const canvas = document.createElement('canvas');
-              if (imgDimensions) {
-                  canvas.width = imgDimensions.width;
-                  canvas.height = imgDimensions.height;
-                  const ctx = canvas.getContext('2d');
-                  if (ctx) {
-                      // Draw each mask
-                      for (const item of data.data) {
-                          if (item.mask) { // item.mask is base64 string
-                             const maskImg = new Image();
-                             // Handle if mask is raw base64 or data uri
-                             maskImg.src = item.mask.startsWith('data:') ? item.mask : `data:image/png;base64,${item.mask}`;
-                             await new Promise((resolve) => { maskImg.onload = resolve; });
-                             ctx.drawImage(maskImg, 0, 0, canvas.width, canvas.height);
-                          }
-                      }
-                      canvasRef.current?.drawMask(canvas.toDataURL('image/png'));
+
+          if (!response.ok || !response.body) {
+              const data = await response.json();
+              throw new Error(data.error || 'Segmentation request failed');
+          }
+
+          // Composite masks
+          const canvas = document.createElement('canvas');
+          const ctx = canvas.getContext('2d');
+          if (imgDimensions) {
+              canvas.width = imgDimensions.width;
+              canvas.height = imgDimensions.height;
+          }
+
+          // Encoding the composite as PNG is expensive, so do it at most once per
+          // animation frame while masks stream in, and once more at the end
+          let exportFrame = 0;
+          const exportComposite = () => {
+              exportFrame = 0;
+              canvasRef.current?.drawMask(canvas.toDataURL('image/png'));
+          };
+
+          const drawItem = async (item: { mask?: string }) => {
+              if (!item.mask || !ctx || !imgDimensions) return;
+              const maskImg = new Image();
+              // Handle if mask is raw base64 or data uri
+              maskImg.src = item.mask.startsWith('data:') ? item.mask : `data:image/png;base64,${item.mask}`;
+              await new Promise((resolve) => { maskImg.onload = resolve; });
+              ctx.drawImage(maskImg, 0, 0, canvas.width, canvas.height);
+              if (!exportFrame) {
+                  exportFrame = requestAnimationFrame(exportComposite);
+              }
+          };
+
+          // The route answers with one JSON record per line: "mask" records, then a "summary"
+          const reader = response.body.getReader();
+          const decoder = new TextDecoder();
+          let buffered = '';
+          while (true) {
+              const { done, value } = await reader.read();
+              if (done) break;
+              buffered += decoder.decode(value, { stream: true });
+              const lines = buffered.split('\n');
+              buffered = lines.pop() || '';
+              for (const line of lines) {
+                  if (!line.trim()) continue;
+                  const record = JSON.parse(line);
+                  if (record.error) throw new Error(record.error);
+                  if (record.type === 'mask') {
+                      await drawItem(record);
                   }
               }
           }
+          if (exportFrame) {
+              cancelAnimationFrame(exportFrame);
+              exportComposite();
+          }
           
           const botMsg: ChatMessage = {
               id: uuidv4(),
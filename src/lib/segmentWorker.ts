@@ -0,0 +1,152 @@
+import { spawn, ChildProcessWithoutNullStreams } from 'child_process';
+import path from 'path';
+import readline from 'readline';
+
+// Use the python executable from the conda environment
+// Note: This path is specific to the local machine setup.
+const PYTHON_EXEC = process.env.SAM3_PYTHON || '/opt/miniconda3/envs/sam3_env/bin/python';
+
+type SegmentRecord = Record<string, any>;
+
+type Pending = {
+    resolve: (record: SegmentRecord) => void;
+    reject: (error: Error) => void;
+    // Streaming requests get each intermediate "mask" record here
+    onRecord?: (record: SegmentRecord) => void;
+};
+
+// Keeps one `segment.py --serve` process alive so the model is loaded once
+// instead of on every request. Requests are tagged with an id and matched to
+// the line-delimited JSON responses the worker writes to stdout.
+//
+// Requests go over stdin as binary frames (see read_frame in segment.py):
+// a 4-byte big-endian header length, the JSON header, then the raw image
+// bytes, so python never has to parse or base64-decode the image payload.
+class SegmentWorker {
+    private proc: ChildProcessWithoutNullStreams | null = null;
+    private pending = new Map<string, Pending>();
+    private nextId = 0;
+    private lastHealth: SegmentRecord = { status: 'stopped', ready: false };
+
+    private start() {
+        const scriptPath = path.join(process.cwd(), 'src', 'scripts', 'segment.py');
+        const proc = spawn(PYTHON_EXEC, [scriptPath, '--serve', '--binary']);
+        this.proc = proc;
+        this.lastHealth = { status: 'loading', ready: false };
+
+        const lines = readline.createInterface({ input: proc.stdout });
+        lines.on('line', (line) => this.onLine(line));
+
+        proc.stderr.on('data', (data) => {
+            console.error('Python Error:', data.toString());
+        });
+
+        proc.on('close', (code) => {
+            this.fail(proc, new Error(`Process exited with code ${code}`), {
+                status: 'stopped',
+                ready: false,
+                exitCode: code,
+            });
+        });
+
+        // Without these a failed spawn (ENOENT) or a write to a dead worker
+        // (EPIPE) is an unhandled 'error' event that takes the server down.
+        proc.on('error', (error) => {
+            this.fail(proc, error, { status: 'error', ready: false, error: error.message });
+        });
+        proc.stdin.on('error', (error) => {
+            this.fail(proc, error, { status: 'error', ready: false, error: error.message });
+            proc.kill();
+        });
+    }
+
+    // Rejects everything in flight and forgets the process, so the next
+    // request spawns a fresh one. Later events of a process that was already
+    // given up on (e.g. 'close' after 'error') are ignored.
+    private fail(proc: ChildProcessWithoutNullStreams, error: Error, health: SegmentRecord) {
+        if (this.proc !== proc) {
+            return;
+        }
+        this.proc = null;
+        this.lastHealth = health;
+        for (const pending of this.pending.values()) {
+            pending.reject(error);
+        }
+        this.pending.clear();
+    }
+
+    private onLine(line: string) {
+        let record: SegmentRecord;
+        try {
+            record = JSON.parse(line);
+        } catch (e) {
+            console.error('Failed to parse python output:', line);
+            return;
+        }
+
+        if (record.type === 'ready') {
+            this.lastHealth = record.error
+                ? { status: 'error', ready: false, error: record.error }
+                : {
+                      status: 'ready',
+                      ready: true,
+                      device: record.device,
+                      loadSeconds: record.loadSeconds,
+                      warmupSeconds: record.warmupSeconds,
+                  };
+            return;
+        }
+
+        const pending = record.id !== undefined ? this.pending.get(record.id) : undefined;
+        if (!pending) {
+            return;
+        }
+        const id = record.id;
+        delete record.id;
+        if (record.type === 'mask') {
+            pending.onRecord?.(record);
+            return;
+        }
+        this.pending.delete(id);
+        pending.resolve(record);
+    }
+
+    private encodeFrame(payload: SegmentRecord, id: string): Buffer {
+        const { imageBase64, ...fields } = payload;
+        const image = imageBase64
+            ? Buffer.from(imageBase64.replace(/^data:[^,]*,/, ''), 'base64')
+            : Buffer.alloc(0);
+        const header = Buffer.from(JSON.stringify({ ...fields, id, imageBytes: image.length }));
+        const prefix = Buffer.alloc(4);
+        prefix.writeUInt32BE(header.length, 0);
+        return Buffer.concat([prefix, header, image]);
+    }
+
+    request(payload: SegmentRecord, onRecord?: (record: SegmentRecord) => void): Promise<SegmentRecord> {
+        if (!this.proc) {
+            this.start();
+        }
+        const id = String(this.nextId++);
+        return new Promise((resolve, reject) => {
+            this.pending.set(id, { resolve, reject, onRecord });
+            this.proc!.stdin.write(this.encodeFrame(payload, id));
+        });
+    }
+
+    health(): Promise<SegmentRecord> {
+        if (!this.proc) {
+            return Promise.resolve(this.lastHealth);
+        }
+        return this.request({ op: 'health' });
+    }
+}
+
+// Survive module reloads in `next dev` so we don't leak worker processes.
+const globalForWorker = globalThis as unknown as { segmentWorker?: SegmentWorker };
+
+export function getSegmentWorker(): SegmentWorker {
+    if (!globalForWorker.segmentWorker) {
+        globalForWorker.segmentWorker = new SegmentWorker();
+    }
+    return globalForWorker.segmentWorker;
+}
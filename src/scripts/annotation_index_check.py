@@ -0,0 +1,151 @@
+"""
+Consistency check of the compiled annotation loaders of dataset_patch.py
+(installed as sam3/train/data/sam3_image_dataset.py) against COCO_FROM_JSON.
+
+Writes a synthetic COCO file (or takes --ann-file), compiles it into a
+ColumnarAnnotationIndex and, when zstandard is installed, a ZstdSamplePack,
+then compares the per-datapoint query stats used by the prefilter
+(getQueryStats) and the LVIS repeat factors (getPositiveCategories) with
+what the JSON loader gives, for the full id list, a subset in file order
+and shuffled subsets like the ones limit_ids and set_sharded_annotation_file
+produce. Every other query of the JSON loader carries its category in
+category_id instead of original_cat_id, as some loaders do. The exit status
+is non-zero on any mismatch.
+
+Usage:
+    python src/scripts/annotation_index_check.py
+    python src/scripts/annotation_index_check.py --ann-file /data/coco/annotations/val.json
+"""
+
+import argparse
+import json
+import os
+import sys
+import tempfile
+
+import numpy as np
+
+from sam3.train.data.coco_json_loaders import COCO_FROM_JSON
+from sam3.train.data.sam3_image_dataset import (
+    build_sample_pack,
+    ColumnarAnnotationIndex,
+    compile_annotation_index,
+    lvis_repeat_factors,
+    train_sample_dictionary,
+    zstd,
+    ZstdSamplePack,
+)
+
+
+def write_coco(path, num_images, num_categories, seed=0):
+    """Images with a varying number of annotations per category, some without any."""
+    rng = np.random.default_rng(seed)
+    images, annotations = [], []
+    for image_id in range(num_images):
+        images.append({"id": image_id, "file_name": f"{image_id}.jpg", "height": 64, "width": 64})
+        for category_id in range(1, num_categories + 1):
+            for _ in range(int(rng.integers(0, 4)) * int(rng.integers(0, 2))):
+                x, y = (int(v) for v in rng.integers(0, 48, size=2))
+                annotations.append(
+                    {
+                        "id": len(annotations),
+                        "image_id": image_id,
+                        "category_id": category_id,
+                        "bbox": [x, y, 8, 8],
+                        "area": 64,
+                        "iscrowd": 0,
+                    }
+                )
+    categories = [{"id": i, "name": f"category {i}"} for i in range(1, num_categories + 1)]
+    with open(path, "w") as fopen:
+        json.dump({"images": images, "annotations": annotations, "categories": categories}, fopen)
+
+
+class CategoryIdLoader:
+    """COCO_FROM_JSON whose odd queries have category_id but no original_cat_id."""
+
+    def __init__(self, loader):
+        self.loader = loader
+
+    def getDatapointIds(self):
+        return self.loader.getDatapointIds()
+
+    def loadImagesFromDatapoint(self, idx):
+        return self.loader.loadImagesFromDatapoint(idx)
+
+    def loadQueriesAndAnnotationsFromDatapoint(self, idx):
+        queries, annotations = self.loader.loadQueriesAndAnnotationsFromDatapoint(idx)
+        for query in queries[1::2]:
+            query["category_id"], query["original_cat_id"] = query["original_cat_id"], None
+        return queries, annotations
+
+
+def reference_query_stats(loader, ids):
+    # What CustomCocoDetectionAPI._query_stats computes for loaders without getQueryStats
+    num_queries, max_outputs = [], []
+    for datapoint_id in ids:
+        queries, _ = loader.loadQueriesAndAnnotationsFromDatapoint(datapoint_id)
+        num_queries.append(len(queries))
+        max_outputs.append(max((len(q["object_ids_output"]) for q in queries), default=0))
+    return np.asarray(num_queries), np.asarray(max_outputs)
+
+
+def id_orders(ids, seed=0):
+    rng = np.random.default_rng(seed)
+    subset = ids[1::3]
+    yield "all", ids
+    yield "subset", subset
+    yield "shuffled", rng.permutation(ids).tolist()
+    yield "shuffled subset", rng.permutation(subset).tolist()[: max(1, len(subset) // 2)]
+
+
+def check(name, loader, reference, ids):
+    failures = []
+    for order, order_ids in id_orders(ids):
+        expected = reference_query_stats(reference, order_ids)
+        actual = loader.getQueryStats(order_ids)
+        for stat, want, got in zip(("num_queries", "max_outputs"), expected, actual):
+            if not np.array_equal(want, got):
+                failures.append(f"{name}, {order} ids: {stat} differs at {int(np.argmax(want != got))}")
+        # The JSON loader goes through lvis_repeat_factors' per-query fallback
+        want = lvis_repeat_factors(reference, order_ids, threshold=0.5)
+        got = lvis_repeat_factors(loader, order_ids, threshold=0.5)
+        if not np.array_equal(want.numpy(), got.numpy()):
+            failures.append(f"{name}, {order} ids: repeat factors differ")
+    print(f"{name:>24}: {'ok' if not failures else f'{len(failures)} mismatches'}")
+    return failures
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--ann-file", default=None, help="COCO file to check (default: a synthetic one).")
+    parser.add_argument("--num-images", type=int, default=60)
+    parser.add_argument("--num-categories", type=int, default=3)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        ann_file = args.ann_file
+        if ann_file is None:
+            ann_file = os.path.join(tmp, "synthetic.json")
+            write_coco(ann_file, args.num_images, args.num_categories)
+        reference = CategoryIdLoader(COCO_FROM_JSON(ann_file))
+        ids = reference.getDatapointIds()
+
+        index_path = os.path.join(tmp, "annotations.colidx")
+        compile_annotation_index(reference, index_path)
+        failures = check("ColumnarAnnotationIndex", ColumnarAnnotationIndex(index_path), reference, ids)
+
+        if zstd is not None:
+            dict_path = os.path.join(tmp, "records.zdict")
+            pack_path = os.path.join(tmp, "records.zpack")
+            train_sample_dictionary(reference, dict_path, dict_size=16 << 10)
+            build_sample_pack(reference, pack_path, dict_path)
+            failures += check("ZstdSamplePack", ZstdSamplePack(pack_path, dict_path), reference, ids)
+
+    if failures:
+        print("\nCheck failed:\n  " + "\n  ".join(failures))
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,141 @@
+"""
+Offline preprocessing for the SAM3 training dataset (dataset_patch.py, installed
+as sam3/train/data/sam3_image_dataset.py).
+
+    images   Decode every image referenced by an annotation file into the
+             memory-mapped shard cache read by CustomCocoDetectionAPI when
+             use_caching is set (default location: <ann_file>.imgcache).
+    annotations
+             Compile an annotation file into the memory-mapped columnar index
+             read by ColumnarAnnotationIndex; train with
+             coco_json_loader=ColumnarAnnotationIndex and ann_file=<the index>.
+    zstd-dict
+             Train a zstd dictionary on a sample of the datapoint records.
+    pack     Compress every datapoint record with that dictionary into an
+             indexed pack read by ZstdSamplePack; train with
+             zstd_dict_path=<the dictionary> and ann_file=<the pack>.
+
+Usage:
+    python src/scripts/build_dataset_cache.py images --img-folder /data/coco/train2017 \
+        --ann-file /data/coco/annotations/train.json --max-size 1008
+    python src/scripts/build_dataset_cache.py annotations \
+        --ann-file /data/coco/annotations/train.json --out /data/coco/annotations/train.colidx
+    python src/scripts/build_dataset_cache.py zstd-dict \
+        --ann-file /data/coco/annotations/train.json --out /data/coco/annotations/train.zdict
+    python src/scripts/build_dataset_cache.py pack --ann-file /data/coco/annotations/train.json \
+        --dict /data/coco/annotations/train.zdict
+"""
+
+import argparse
+import os
+import time
+
+from sam3.train.data.coco_json_loaders import COCO_FROM_JSON
+from sam3.train.data.sam3_image_dataset import (
+    build_image_cache,
+    build_sample_pack,
+    ColumnarAnnotationIndex,
+    compile_annotation_index,
+    CustomCocoDetectionAPI,
+    train_sample_dictionary,
+)
+
+
+def build_images(args):
+    dataset = CustomCocoDetectionAPI(
+        args.img_folder,
+        args.ann_file,
+        load_segmentation=False,
+        fix_fname=args.fix_fname,
+        use_caching=False,
+        image_cache_dir=args.cache_dir,
+    )
+    start = time.perf_counter()
+    cache = build_image_cache(
+        dataset,
+        max_size=args.max_size,
+        shard_bytes=args.shard_mb << 20,
+    )
+    print(
+        f"Cached {len(cache)} images in {len(cache.shards)} shards at "
+        f"{cache.cache_dir} ({time.perf_counter() - start:.1f}s)"
+    )
+
+
+def build_annotations(args):
+    out = args.out or os.path.splitext(args.ann_file)[0] + ".colidx"
+    start = time.perf_counter()
+    compile_annotation_index(COCO_FROM_JSON(args.ann_file), out)
+    index = ColumnarAnnotationIndex(out)
+    print(
+        f"Compiled {len(index.getDatapointIds())} datapoints, "
+        f"{len(index.columns['ann_id'])} annotations into {out} "
+        f"({os.path.getsize(out) / 2**20:.1f} MiB, {time.perf_counter() - start:.1f}s)"
+    )
+
+
+def build_dictionary(args):
+    start = time.perf_counter()
+    dict_id = train_sample_dictionary(
+        COCO_FROM_JSON(args.ann_file),
+        args.out,
+        dict_size=args.dict_kb << 10,
+        num_samples=args.num_samples,
+    )
+    print(
+        f"Trained dictionary {dict_id} ({os.path.getsize(args.out) >> 10} KiB) at "
+        f"{args.out} ({time.perf_counter() - start:.1f}s)"
+    )
+
+
+def build_pack(args):
+    out = args.out or os.path.splitext(args.ann_file)[0] + ".zpack"
+    start = time.perf_counter()
+    sizes = build_sample_pack(COCO_FROM_JSON(args.ann_file), out, args.dict, level=args.level)
+    print(
+        f"Packed {sizes['raw_bytes'] / 2**20:.1f} MiB of records into {out}: "
+        f"{sizes['compressed_bytes'] / 2**20:.1f} MiB compressed "
+        f"({sizes['raw_bytes'] / max(sizes['compressed_bytes'], 1):.1f}x), "
+        f"{os.path.getsize(out) / 2**20:.1f} MiB with the index "
+        f"({time.perf_counter() - start:.1f}s)"
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    images = subparsers.add_parser("images", help="Build the decoded image shard cache.")
+    images.add_argument("--img-folder", required=True)
+    images.add_argument("--ann-file", required=True)
+    images.add_argument("--cache-dir", default=None, help="Defaults to <ann-file>.imgcache")
+    images.add_argument("--max-size", type=int, default=None, help="Resize so the longest side is at most this.")
+    images.add_argument("--shard-mb", type=int, default=1024)
+    images.add_argument("--fix-fname", action="store_true")
+    images.set_defaults(func=build_images)
+
+    annotations = subparsers.add_parser("annotations", help="Compile the columnar annotation index.")
+    annotations.add_argument("--ann-file", required=True)
+    annotations.add_argument("--out", default=None, help="Defaults to <ann-file without .json>.colidx")
+    annotations.set_defaults(func=build_annotations)
+
+    dictionary = subparsers.add_parser("zstd-dict", help="Train the zstd dictionary for sample packs.")
+    dictionary.add_argument("--ann-file", required=True)
+    dictionary.add_argument("--out", required=True)
+    dictionary.add_argument("--dict-kb", type=int, default=112)
+    dictionary.add_argument("--num-samples", type=int, default=20000, help="Records sampled for training.")
+    dictionary.set_defaults(func=build_dictionary)
+
+    pack = subparsers.add_parser("pack", help="Build a dictionary-compressed sample pack.")
+    pack.add_argument("--ann-file", required=True)
+    pack.add_argument("--dict", required=True, help="Dictionary from the zstd-dict command.")
+    pack.add_argument("--out", default=None, help="Defaults to <ann-file without .json>.zpack")
+    pack.add_argument("--level", type=int, default=10)
+    pack.set_defaults(func=build_pack)
+
+    args = parser.parse_args()
+    args.func(args)
+
+
+if __name__ == "__main__":
+    main()
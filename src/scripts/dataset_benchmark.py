@@ -0,0 +1,252 @@
+"""
+Benchmark for the datapoint construction path of dataset_patch.py (installed
+as sam3/train/data/sam3_image_dataset.py).
+
+Builds synthetic datapoints shaped like COCO_FROM_JSON output (normalized
+xywh bbox tensors, a few queries with input boxes and points) and times
+CustomCocoDetectionAPI.load_queries next to the per-annotation loop it
+replaced, checking that both produce the same boxes and points.
+
+The second table measures what a datapoint costs to ship from a DataLoader
+worker (bytes and dumps + loads time through the worker queue's pickler),
+its size as a plain pickle and the memory allocated to rebuild it, for the
+slotted dataclasses (whose Images pickle their objects column-wise) next to
+plain __dict__ copies of them, and checks that the objects round-trip.
+
+Usage:
+    python src/scripts/dataset_benchmark.py --num-annotations 10,100,500
+"""
+
+import argparse
+import dataclasses
+import pickle
+import time
+import tracemalloc
+
+import torch
+import torch.multiprocessing  # registers the shared memory reductions
+from multiprocessing.reduction import ForkingPickler
+from PIL import Image as PILImage
+
+from sam3.model.box_ops import box_xywh_to_xyxy
+from sam3.train.data import sam3_image_dataset
+from sam3.train.data.sam3_image_dataset import CustomCocoDetectionAPI
+
+
+def legacy_geometry(annotations, queries, id2imsize):
+    # The per-annotation / per-query conversion load_queries used to do
+    bboxes = []
+    for annotation in annotations:
+        bbox = box_xywh_to_xyxy(torch.as_tensor(annotation["bbox"])).view(1, 4)
+        h, w = id2imsize[annotation["image_id"]]
+        bbox[:, 0::2].mul_(w).clamp_(min=0, max=w)
+        bbox[:, 1::2].mul_(h).clamp_(min=0, max=h)
+        bboxes.append(bbox[0])
+    query_boxes, query_points = [], []
+    for query in queries:
+        h, w = id2imsize[query["image_id"]]
+        if query["input_box"] is not None and len(query["input_box"]) > 0:
+            bbox = box_xywh_to_xyxy(torch.as_tensor(query["input_box"])).view(-1, 4)
+            bbox[:, 0::2].mul_(w).clamp_(min=0, max=w)
+            bbox[:, 1::2].mul_(h).clamp_(min=0, max=h)
+        else:
+            bbox = None
+        if query["input_points"] is not None:
+            # clone(): the original scaled the caller's tensor in place, which would
+            # compound across benchmark repeats
+            points = torch.as_tensor(query["input_points"]).clone().view(1, -1, 3)
+            points[:, :, 0:1].mul_(w).clamp_(min=0, max=w)
+            points[:, :, 1:2].mul_(h).clamp_(min=0, max=h)
+        else:
+            points = None
+        query_boxes.append(bbox)
+        query_points.append(points)
+    return bboxes, query_boxes, query_points
+
+
+def make_datapoint(num_annotations, num_queries, seed=0):
+    generator = torch.Generator().manual_seed(seed)
+    annotations = []
+    for i in range(num_annotations):
+        # Slightly out of range boxes so clamping is exercised
+        bbox = torch.rand(4, generator=generator) * 0.6 - 0.05
+        annotations.append(
+            {
+                "image_id": 0,
+                "bbox": bbox,
+                "area": (bbox[2] * bbox[3]).item(),
+                "segmentation": None,
+                "object_id": i,
+                "is_crowd": 0,
+                "id": i,
+            }
+        )
+    queries = []
+    per_query = max(1, num_annotations // num_queries)
+    for i in range(num_queries):
+        queries.append(
+            {
+                "id": i,
+                "original_cat_id": i,
+                "object_ids_output": list(
+                    range(i * per_query, min(num_annotations, (i + 1) * per_query))
+                ),
+                "query_text": f"category {i}",
+                "query_processing_order": 0,
+                "ptr_x_query_id": None,
+                "ptr_y_query_id": None,
+                "image_id": 0,
+                "input_box": torch.rand(2, 4, generator=generator).tolist() if i % 2 else None,
+                "input_box_label": None,
+                "input_points": torch.rand(3, 3, generator=generator) if i % 3 == 0 else None,
+                "is_exhaustive": True,
+            }
+        )
+    image_meta = [{"id": 0, "file_name": "synthetic.jpg", "original_img_id": 0, "coco_img_id": 0}]
+    return annotations, queries, image_meta
+
+
+def _unslotted_class(cls):
+    # Same fields as the dataset class, but with a per-instance __dict__
+    fields = [(f.name, f.type, f) for f in dataclasses.fields(cls)]
+    plain = dataclasses.make_dataclass(cls.__name__ + "Plain", fields)
+    plain.__module__ = __name__
+    globals()[plain.__name__] = plain
+    return plain
+
+
+UNSLOTTED = {
+    getattr(sam3_image_dataset, name): None
+    for name in ("InferenceMetadata", "FindQueryLoaded", "Object", "Image", "Datapoint")
+}
+for _cls in UNSLOTTED:
+    UNSLOTTED[_cls] = _unslotted_class(_cls)
+
+
+def unslotted(value):
+    """Deep copy of a datapoint using the __dict__ based mirror classes."""
+    if type(value) in UNSLOTTED:
+        return UNSLOTTED[type(value)](
+            **{f.name: unslotted(getattr(value, f.name)) for f in dataclasses.fields(value)}
+        )
+    if isinstance(value, list):
+        return [unslotted(item) for item in value]
+    return value
+
+
+def ipc_cost(datapoint, repeats):
+    """
+    (IPC bytes, best IPC dumps + loads seconds, plain pickle bytes, bytes
+    allocated to rebuild). IPC is measured with the ForkingPickler and torch
+    reductions DataLoader workers use, where tensor storages travel through
+    shared memory and views of one storage share it.
+    """
+    # Drop the image: its pixels dominate and do not depend on the representation
+    for image in datapoint.images:
+        image.data = None
+    datapoint.raw_images = None
+    payload = bytes(ForkingPickler.dumps(datapoint))
+    seconds = time_call(
+        lambda: pickle.loads(bytes(ForkingPickler.dumps(datapoint))), repeats
+    )
+    plain = pickle.dumps(datapoint, protocol=pickle.HIGHEST_PROTOCOL)
+    pickle.loads(plain)  # warmup, so one-time allocations are not counted
+    tracemalloc.start()
+    loaded = pickle.loads(plain)
+    allocated, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    assert_same_objects(datapoint, loaded)
+    del loaded
+    return len(payload), seconds, len(plain), allocated
+
+
+def assert_same_objects(datapoint, loaded):
+    assert len(datapoint.images) == len(loaded.images)
+    for image, loaded_image in zip(datapoint.images, loaded.images):
+        assert len(image.objects) == len(loaded_image.objects)
+        for obj, loaded_obj in zip(image.objects, loaded_image.objects):
+            for field in dataclasses.fields(obj):
+                value, loaded_value = getattr(obj, field.name), getattr(loaded_obj, field.name)
+                if isinstance(value, torch.Tensor):
+                    assert torch.equal(value, loaded_value), field.name
+                else:
+                    assert value == loaded_value, field.name
+
+
+def time_call(fn, repeats):
+    fn()  # warmup
+    best = float("inf")
+    for _ in range(repeats):
+        start = time.perf_counter()
+        fn()
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+def make_dataset(training=True):
+    # load_queries only needs these attributes; skip annotation file loading
+    dataset = CustomCocoDetectionAPI.__new__(CustomCocoDetectionAPI)
+    dataset.load_segmentation = False
+    dataset.training = training
+    return dataset
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--num-annotations", default="10,100,500")
+    parser.add_argument("--num-queries", type=int, default=20)
+    parser.add_argument("--height", type=int, default=480)
+    parser.add_argument("--width", type=int, default=640)
+    parser.add_argument("--repeats", type=int, default=20)
+    args = parser.parse_args()
+
+    dataset = make_dataset()
+    image = PILImage.new("RGB", (args.width, args.height))
+    id2imsize = {0: (args.height, args.width)}
+    print(f"{'anns':>6} {'legacy geom ms':>15} {'batched geom ms':>16} {'speedup':>8} {'load_queries ms':>16}")
+    for num_annotations in [int(n) for n in args.num_annotations.split(",")]:
+        annotations, queries, image_meta = make_datapoint(num_annotations, args.num_queries)
+
+        datapoint = dataset.load_queries([(0, image)], annotations, queries, image_meta)
+        bboxes, query_boxes, query_points = legacy_geometry(annotations, queries, id2imsize)
+        assert torch.allclose(
+            torch.stack([obj.bbox for obj in datapoint.images[0].objects]), torch.stack(bboxes)
+        )
+        for query, bbox, points in zip(datapoint.find_queries, query_boxes, query_points):
+            assert (query.input_bbox is None) == (bbox is None)
+            assert bbox is None or torch.allclose(query.input_bbox, bbox)
+            assert (query.input_points is None) == (points is None)
+            assert points is None or torch.allclose(query.input_points, points)
+
+        legacy = time_call(lambda: legacy_geometry(annotations, queries, id2imsize), args.repeats)
+        vectorized = time_call(
+            lambda: (
+                dataset._annotation_boxes(annotations, id2imsize),
+                dataset._query_geometry(queries, id2imsize),
+            ),
+            args.repeats,
+        )
+        full = time_call(
+            lambda: dataset.load_queries([(0, image)], annotations, queries, image_meta),
+            args.repeats,
+        )
+        print(
+            f"{num_annotations:>6} {legacy * 1000:>15.3f} {vectorized * 1000:>16.3f} "
+            f"{legacy / vectorized:>7.2f}x {full * 1000:>16.3f}"
+        )
+
+    print(
+        f"\n{'anns':>6} {'repr':>9} {'IPC B':>8} {'IPC ms':>8} {'pickle B':>10} {'alloc B':>9}"
+    )
+    for num_annotations in [int(n) for n in args.num_annotations.split(",")]:
+        annotations, queries, image_meta = make_datapoint(num_annotations, args.num_queries)
+        datapoint = dataset.load_queries([(0, image)], annotations, queries, image_meta)
+        for name, value in (("packed", datapoint), ("__dict__", unslotted(datapoint))):
+            ipc_bytes, seconds, pickle_bytes, allocated = ipc_cost(value, args.repeats)
+            print(
+                f"{num_annotations:>6} {name:>9} {ipc_bytes:>8} {seconds * 1000:>8.3f} "
+                f"{pickle_bytes:>10} {allocated:>9}"
+            )
+
+if __name__ == "__main__":
+    main()
@@ -2,19 +2,28 @@
 
 """Dataset class for modulated detection"""
 
+import copy
+import functools
+import gc
+import hashlib
+import io
 import json
+import mmap
 import os
 import random
+import struct
 import sys
+import threading
 import traceback
-from collections import Counter
-from dataclasses import dataclass
-from enum import Enum
+import types
+from collections import Counter, OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor
+from dataclasses import dataclass, fields
 from typing import Any, Callable, Dict, List, Optional, Set, Tuple, Union
 
+import numpy as np
 import torch
 import torch.utils.data
-import torchvision
 
 # START PATCH: Optional decord import
 try:
@@ -30,6 +39,16 @@ except ImportError:
 
 from iopath.common.file_io import g_pathmgr
 
+try:
+    from pycocotools import mask as mask_utils
+except ImportError:
+    mask_utils = None
+
+try:
+    import zstandard as zstd
+except ImportError:
+    zstd = None
+
 from PIL import Image as PILImage
 from PIL.Image import DecompressionBombError
 
@@ -38,8 +57,12 @@ from torchvision.datasets.vision import VisionDataset
 
 from .coco_json_loaders import COCO_FROM_JSON
 
+# Hundreds of these objects are created per sample and pickled across DataLoader
+# worker boundaries; __slots__ drops the per-instance __dict__ (Python >= 3.10)
+_SLOTS = {"slots": True} if sys.version_info >= (3, 10) else {}
 
-@dataclass
+
+@dataclass(**_SLOTS)
 class InferenceMetadata:
     """Metadata required for postprocessing"""
 
@@ -67,7 +90,7 @@ class InferenceMetadata:
     is_conditioning_only: Optional[bool] = False
 
 
-@dataclass
+@dataclass(**_SLOTS)
 class FindQuery:
     query_text: str
 
@@ -100,13 +123,13 @@ class FindQuery:
     is_pixel_exhaustive: Optional[bool] = None
 
 
-@dataclass
+@dataclass(**_SLOTS)
 class FindQueryLoaded(FindQuery):
     # Must have default value since FindQuery has entries with default values
     inference_metadata: Optional[InferenceMetadata] = None
 
 
-@dataclass
+@dataclass(**_SLOTS)
 class Object:
     # Initially in denormalized XYXY format, gets converted to normalized CxCyWH by the Normalize transform
     bbox: torch.Tensor
@@ -125,7 +148,60 @@ class Object:
     source: Optional[str] = None
 
 
-@dataclass
+# How a packed Object field is stored: one stacked tensor, one value shared
+# by every object, or the plain list of values
+_COLUMN_STACKED, _COLUMN_CONSTANT, _COLUMN_LIST = range(3)
+
+
+def _pack_column(values: List[Any]) -> Tuple[int, Any]:
+    first = values[0]
+    if isinstance(first, torch.Tensor):
+        if all(
+            isinstance(value, torch.Tensor)
+            and value.shape == first.shape
+            and value.dtype == first.dtype
+            and value.device == first.device
+            for value in values
+        ):
+            return _COLUMN_STACKED, torch.stack(values)
+    elif first is None or isinstance(first, (bool, int, float, str)):
+        if all(type(value) is type(first) and value == first for value in values):
+            return _COLUMN_CONSTANT, first
+    return _COLUMN_LIST, values
+
+
+def _unpack_column(column: Tuple[int, Any], length: int) -> List[Any]:
+    kind, values = column
+    if kind == _COLUMN_STACKED:
+        return list(values.unbind(0))
+    if kind == _COLUMN_CONSTANT:
+        return [values] * length
+    return values
+
+
+def _pack_objects(objects: List[Object]) -> Union[List[Object], Tuple[int, tuple]]:
+    """Objects as one column per field (struct of arrays), for pickling."""
+    if not objects or any(type(obj) is not Object for obj in objects):
+        return objects
+    return len(objects), tuple(
+        _pack_column([getattr(obj, field.name) for obj in objects])
+        for field in fields(Object)
+    )
+
+
+def _unpack_objects(packed: Union[List[Object], Tuple[int, tuple]]) -> List[Object]:
+    if isinstance(packed, list):
+        return packed
+    length, columns = packed
+    values = [_unpack_column(column, length) for column in columns]
+    return [Object(*row) for row in zip(*values)]
+
+
+def _unpickle_image(data, objects, size, blurring_mask) -> "Image":
+    return Image(data, _unpack_objects(objects), size, blurring_mask)
+
+
+@dataclass(**_SLOTS)
 class Image:
     data: Union[torch.Tensor, PILImage.Image]
     objects: List[Object]
@@ -134,8 +210,17 @@ class Image:
     # For blurring augmentation
     blurring_mask: Optional[Dict[str, Any]] = None
 
+    def __reduce__(self):
+        # Pickled struct-of-arrays: the bboxes (and same-sized masks) of all
+        # objects travel as one tensor, so a DataLoader worker hands over one
+        # shared memory segment per field instead of one per object
+        return (
+            _unpickle_image,
+            (self.data, _pack_objects(self.objects), self.size, self.blurring_mask),
+        )
+
 
-@dataclass
+@dataclass(**_SLOTS)
 class Datapoint:
     """Refers to an image/video and all its annotations"""
 
@@ -144,8 +229,1379 @@ class Datapoint:
     raw_images: Optional[List[PILImage.Image]] = None
 
 
+IMAGE_CACHE_INDEX = "index.json"
+IMAGE_CACHE_VERSION = 1
+
+
+class ImageShardCache:
+    """Decoded RGB images stored back to back in memory-mapped shard files.
+
+    Layout of `cache_dir`:
+        index.json          {"version", "max_size", "shards": [file names],
+                             "entries": {file_name: [shard, offset, height, width]}}
+        shard_00000.bin     raw HxWx3 uint8 pixels, one image after the other
+
+    The shards are opened read-only and lazily in each process, so DataLoader
+    workers share the decoded pixels through the OS page cache instead of each
+    decoding every JPEG again. Built once with `build_image_cache`.
+    """
+
+    def __init__(self, cache_dir: str):
+        self.cache_dir = cache_dir
+        with open(os.path.join(cache_dir, IMAGE_CACHE_INDEX), "r") as fopen:
+            index = json.load(fopen)
+        if index.get("version") != IMAGE_CACHE_VERSION:
+            raise ValueError(
+                f"Unsupported image cache version {index.get('version')} in {cache_dir}"
+            )
+        self.max_size = index.get("max_size")
+        self.shards = index["shards"]
+        self.entries = index["entries"]
+        self._pid = None
+        self._maps = {}
+
+    @staticmethod
+    def exists(cache_dir: Optional[str]) -> bool:
+        return cache_dir is not None and os.path.isfile(
+            os.path.join(cache_dir, IMAGE_CACHE_INDEX)
+        )
+
+    def __contains__(self, file_name: str) -> bool:
+        return file_name in self.entries
+
+    def __len__(self) -> int:
+        return len(self.entries)
+
+    def __getstate__(self):
+        # mmaps cannot be pickled (spawned workers); they are reopened on demand
+        state = self.__dict__.copy()
+        state["_pid"] = None
+        state["_maps"] = {}
+        return state
+
+    def _shard(self, shard: int) -> mmap.mmap:
+        if self._pid != os.getpid():
+            # Maps inherited through fork stay valid, but keep them per process anyway
+            # so closing them in one worker never affects another
+            self._pid = os.getpid()
+            self._maps = {}
+        mapped = self._maps.get(shard)
+        if mapped is None:
+            path = os.path.join(self.cache_dir, self.shards[shard])
+            with open(path, "rb") as fopen:
+                mapped = mmap.mmap(fopen.fileno(), 0, access=mmap.ACCESS_READ)
+            self._maps[shard] = mapped
+        return mapped
+
+    def array(self, file_name: str) -> np.ndarray:
+        """Zero-copy read-only HxWx3 uint8 view of a cached image."""
+        shard, offset, height, width = self.entries[file_name]
+        return np.frombuffer(
+            self._shard(shard), dtype=np.uint8, count=height * width * 3, offset=offset
+        ).reshape(height, width, 3)
+
+    def get(self, file_name: str) -> PILImage.Image:
+        """The cached image as a PIL RGB image, without decoding anything."""
+        shard, offset, height, width = self.entries[file_name]
+        view = memoryview(self._shard(shard))[offset : offset + height * width * 3]
+        # PIL keeps RGB as 4 bytes per pixel internally, so this is one memcpy
+        # from the page cache; use `array` for a true zero-copy view
+        return PILImage.frombuffer("RGB", (width, height), view, "raw", "RGB", 0, 1)
+
+
+def build_image_cache(
+    dataset: "CustomCocoDetectionAPI",
+    cache_dir: Optional[str] = None,
+    max_size: Optional[int] = None,
+    shard_bytes: int = 1 << 30,
+) -> ImageShardCache:
+    """One-time preprocessing step that decodes every image of `dataset` into shards.
+
+    Args:
+        dataset: The dataset whose images are cached, keyed by their file name.
+        cache_dir: Where to write the shards, defaults to `dataset.image_cache_dir`.
+        max_size: If set, images are resized so that their longest side is at most
+            this many pixels. Boxes are stored normalized so they are unaffected,
+            but RLE masks keep the original resolution, so datasets that load
+            segmentation will not use a resized cache.
+        shard_bytes: Size at which a new shard file is started.
+
+    Building is incremental: images already in an existing index are skipped and
+    new ones go to new shards. The index is replaced atomically at the end.
+    """
+    cache_dir = cache_dir or dataset.image_cache_dir
+    os.makedirs(cache_dir, exist_ok=True)
+    if ImageShardCache.exists(cache_dir):
+        previous = ImageShardCache(cache_dir)
+        if previous.max_size != max_size:
+            raise ValueError(
+                f"{cache_dir} was built with max_size={previous.max_size}, not {max_size}"
+            )
+        shards, entries = list(previous.shards), dict(previous.entries)
+    else:
+        shards, entries = [], {}
+
+    shard_file = None
+    try:
+        for datapoint_id in dataset.ids.tolist():
+            for meta in dataset.coco.loadImagesFromDatapoint(datapoint_id):
+                file_name = dataset._file_name(meta)
+                if file_name in entries or ".mp4" in file_name:
+                    continue
+                image = dataset._read_image(os.path.join(dataset.root, file_name))
+                if max_size is not None and max(image.size) > max_size:
+                    scale = max_size / max(image.size)
+                    image = image.resize(
+                        (
+                            max(1, round(image.width * scale)),
+                            max(1, round(image.height * scale)),
+                        ),
+                        PILImage.BILINEAR,
+                    )
+                pixels = image.tobytes()
+                if shard_file is None or shard_file.tell() + len(pixels) > shard_bytes:
+                    if shard_file is not None:
+                        shard_file.close()
+                    shards.append(f"shard_{len(shards):05d}.bin")
+                    shard_file = open(os.path.join(cache_dir, shards[-1]), "wb")
+                entries[file_name] = [
+                    len(shards) - 1,
+                    shard_file.tell(),
+                    image.height,
+                    image.width,
+                ]
+                shard_file.write(pixels)
+    finally:
+        if shard_file is not None:
+            shard_file.close()
+
+    index = {
+        "version": IMAGE_CACHE_VERSION,
+        "max_size": max_size,
+        "shards": shards,
+        "entries": entries,
+    }
+    tmp_path = os.path.join(cache_dir, IMAGE_CACHE_INDEX + ".tmp")
+    with open(tmp_path, "w") as fopen:
+        json.dump(index, fopen)
+    os.replace(tmp_path, os.path.join(cache_dir, IMAGE_CACHE_INDEX))
+    return ImageShardCache(cache_dir)
+
+
+def is_video_frame_path(path: str) -> bool:
+    return ".mp4" in path and path[-4:] == ".mp4"
+
+
+def split_video_frame_path(path: str) -> Tuple[str, int]:
+    video_path, frame = path.split("@")
+    return video_path, int(frame)
+
+
+class VideoReaderPool:
+    """Per-process LRU of open decord VideoReaders, keyed by video path.
+
+    Opening a container and seeking to a frame is the expensive part of
+    reading video frames, so readers stay open across datapoints. The pool is
+    tied to the pid that created the readers: after a fork into a DataLoader
+    worker it starts empty instead of sharing decoder state with the parent.
+    """
+
+    def __init__(self, max_open: int = 8):
+        self.max_open = max_open
+        self._pid = None
+        self._readers = OrderedDict()
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state["_pid"] = None
+        state["_readers"] = OrderedDict()
+        return state
+
+    def get(self, video_path: str) -> VideoReader:
+        if self._pid != os.getpid():
+            self._pid = os.getpid()
+            self._readers = OrderedDict()
+        reader = self._readers.get(video_path)
+        if reader is not None:
+            self._readers.move_to_end(video_path)
+            return reader
+        reader = VideoReader(video_path, ctx=cpu(0))
+        self._readers[video_path] = reader
+        while len(self._readers) > self.max_open:
+            self._readers.popitem(last=False)
+        return reader
+
+    def read_frames(self, video_path: str, frames: List[int]) -> np.ndarray:
+        """(N, H, W, 3) uint8 frames decoded with a single batched seek/decode."""
+        return self.get(video_path).get_batch(frames).asnumpy()
+
+
+def _rle_string_to_counts(counts: Union[str, bytes]) -> np.ndarray:
+    """Run lengths of a COCO compressed RLE string (rleFrString in pycocotools).
+
+    Each run is a little-endian group of 5-bit digits, the last digit of a
+    group has 0x20 clear and its 0x10 bit is the sign; from the third run on,
+    runs are stored as differences to the run two places before.
+    """
+    if isinstance(counts, str):
+        counts = counts.encode("ascii")
+    digits = np.frombuffer(counts, dtype=np.uint8).astype(np.int64) - 48
+    if len(digits) == 0:
+        return np.zeros(0, dtype=np.int64)
+    last = (digits & 0x20) == 0
+    group_start = np.flatnonzero(np.concatenate(([True], last[:-1])))
+    group_length = np.diff(np.append(group_start, len(digits)))
+    position = np.arange(len(digits)) - np.repeat(group_start, group_length)
+    values = np.add.reduceat((digits & 0x1F) << (5 * position), group_start)
+    negative = (digits[last] & 0x10) != 0
+    values[negative] -= np.int64(1) << (5 * group_length[negative])
+    runs = values.copy()
+    runs[2::2] = np.cumsum(values[2::2])
+    if len(values) > 3:
+        runs[3::2] = values[1] + np.cumsum(values[3::2])
+    return runs
+
+
+class DecodedMaskCache:
+    """Per-process LRU of decoded masks, bounded by the bytes it holds."""
+
+    def __init__(self, max_bytes: int):
+        self.max_bytes = max_bytes
+        self._pid = None
+        self._masks = OrderedDict()
+        self._bytes = 0
+
+    def get(self, key) -> Optional[torch.Tensor]:
+        if self._pid != os.getpid():
+            self._pid = os.getpid()
+            self._masks = OrderedDict()
+            self._bytes = 0
+        mask = self._masks.get(key)
+        if mask is not None:
+            self._masks.move_to_end(key)
+        return mask
+
+    def put(self, key, mask: torch.Tensor):
+        size = mask.numel() * mask.element_size()
+        if size > self.max_bytes:
+            return
+        if key in self._masks:
+            previous = self._masks.pop(key)
+            self._bytes -= previous.numel() * previous.element_size()
+        self._masks[key] = mask
+        self._bytes += size
+        while self._bytes > self.max_bytes:
+            _, evicted = self._masks.popitem(last=False)
+            self._bytes -= evicted.numel() * evicted.element_size()
+
+    def __getstate__(self):
+        # Workers start empty; decoded pixels never travel between processes
+        return {"max_bytes": self.max_bytes}
+
+    def __setstate__(self, state):
+        self.__init__(state["max_bytes"])
+
+
+DEFAULT_DECODED_MASK_CACHE_BYTES = int(
+    os.environ.get("SAM3_DECODED_MASK_CACHE_BYTES", 256 << 20)
+)
+
+# Used by LazyRLEMask.decode when no cache is passed; datasets bring their own
+DECODED_MASK_CACHE = DecodedMaskCache(DEFAULT_DECODED_MASK_CACHE_BYTES)
+
+
+class LazyRLEMask(dict):
+    """A COCO RLE dict ({"size", "counts"}) that decodes itself on demand.
+
+    Anything that expects the RLE dict (pycocotools' decode/area, the
+    segmentation transforms) keeps working unchanged. `decode` builds the
+    binary mask on first use, optionally straight at a target resolution,
+    without ever materializing the full resolution mask, and keeps the result
+    in a DecodedMaskCache (DECODED_MASK_CACHE unless one is passed) so
+    repeated accesses within a worker are free while the memory held stays
+    bounded. In the training pipeline LazyDecodeRle calls it.
+    """
+
+    def __reduce__(self):
+        # Ship the plain RLE across processes, never decoded pixels
+        return (LazyRLEMask, (dict(self),))
+
+    def runs(self) -> np.ndarray:
+        counts = self["counts"]
+        if isinstance(counts, (str, bytes)):
+            return _rle_string_to_counts(counts)
+        return np.asarray(counts, dtype=np.int64)
+
+    def area(self) -> int:
+        return int(self.runs()[1::2].sum())
+
+    def _cache_key(self, size: Tuple[int, int]):
+        counts = self["counts"]
+        if not isinstance(counts, (str, bytes)):
+            counts = tuple(counts)
+        return counts, tuple(self["size"]), size
+
+    def decode(
+        self,
+        size: Optional[Tuple[int, int]] = None,
+        cache: Optional[DecodedMaskCache] = None,
+    ) -> torch.Tensor:
+        """(H, W) uint8 mask, resized with nearest neighbour if `size` is given.
+
+        Returns a copy; the cached mask is never handed out.
+        """
+        if cache is None:
+            cache = DECODED_MASK_CACHE
+        height, width = self["size"]
+        size = (height, width) if size is None else tuple(size)
+        key = self._cache_key(size)
+        mask = cache.get(key)
+        if mask is None:
+            mask = torch.from_numpy(self._decode(size))
+            cache.put(key, mask)
+        return mask.clone()
+
+    def _decode(self, size: Tuple[int, int], chunk_columns: int = 128) -> np.ndarray:
+        height, width = self["size"]
+        out_height, out_width = size
+        compressed = isinstance(self["counts"], (str, bytes))
+        if (out_height, out_width) == (height, width) and compressed and mask_utils:
+            return np.ascontiguousarray(mask_utils.decode(dict(self)))
+        # Runs cover the column-major flattened mask and alternate 0/1, starting
+        # with 0: the value at a flat position is the parity of the run it is in.
+        ends = np.cumsum(self.runs())
+        # Source pixel of every output row/column, as F.interpolate(mode="nearest")
+        rows = np.minimum(
+            (np.arange(out_height) * (height / out_height)).astype(np.int64),
+            height - 1,
+        )
+        cols = np.minimum(
+            (np.arange(out_width) * (width / out_width)).astype(np.int64), width - 1
+        )
+        mask = np.empty((out_width, out_height), dtype=np.uint8)
+        for start in range(0, out_width, chunk_columns):
+            positions = cols[start : start + chunk_columns, None] * height + rows
+            mask[start : start + chunk_columns] = (
+                np.searchsorted(ends, positions, side="right") & 1
+            )
+        return np.ascontiguousarray(mask.T)
+
+
+class LazyDecodeRle:
+    """Drop-in replacement for sam3.train.transforms.segmentation.DecodeRle.
+
+    LazyRLEMask segments are decoded straight at the size of their image
+    through `cache`, instead of at full resolution and resized afterwards.
+    Everything else (polygons, plain RLE dicts, semantic targets) is left to
+    `fallback`, the upstream transform. Sam3ImageDataset swaps it in for
+    every DecodeRle among its transforms.
+    """
+
+    def __init__(
+        self,
+        cache: Optional[DecodedMaskCache] = None,
+        fallback: Optional[Callable] = None,
+    ):
+        self.cache = DECODED_MASK_CACHE if cache is None else cache
+        self.fallback = fallback
+
+    def __call__(self, datapoint: "Datapoint", **kwargs):
+        for img in datapoint.images:
+            if isinstance(img.data, PILImage.Image):
+                img_w, img_h = img.data.size
+            elif isinstance(img.data, torch.Tensor):
+                img_h, img_w = img.data.shape[-2:]
+            else:
+                # Unexpected image type; the fallback reports it
+                continue
+            for obj in img.objects:
+                if not isinstance(obj.segment, LazyRLEMask):
+                    continue
+                if obj.segment.area() == 0:
+                    # As DecodeRle does: approximate an empty mask from the box
+                    print("Warning, empty mask found, approximating from box")
+                    obj.segment = torch.zeros(img_h, img_w, dtype=torch.uint8)
+                    x1, y1, x2, y2 = obj.bbox.int().tolist()
+                    obj.segment[y1 : max(y2, y1 + 1), x1 : max(x1 + 1, x2)] = 1
+                else:
+                    obj.segment = obj.segment.decode((img_h, img_w), cache=self.cache)
+        if self.fallback is not None:
+            datapoint = self.fallback(datapoint, **kwargs)
+        return datapoint
+
+
+def _with_lazy_rle_decoding(transforms, cache: DecodedMaskCache):
+    """Copy of `transforms` with every upstream DecodeRle wrapped in a LazyDecodeRle.
+
+    Looks into nested `transforms` lists (ComposeAPI and friends), copying
+    the containers rather than editing transforms other datasets may share.
+    """
+
+    def swap(transform):
+        cls = type(transform)
+        if cls.__name__ == "DecodeRle" and cls.__module__.endswith(
+            "transforms.segmentation"
+        ):
+            return LazyDecodeRle(cache, fallback=transform)
+        inner = getattr(transform, "transforms", None)
+        if isinstance(inner, (list, tuple)):
+            transform = copy.copy(transform)
+            transform.transforms = [swap(t) for t in inner]
+        return transform
+
+    if transforms is None:
+        return None
+    return [swap(transform) for transform in transforms]
+
+
+class ImagePrefetcher:
+    """Reads raw image files ahead of time on a thread pool.
+
+    `submit` starts background reads and `take` hands the bytes over (waiting
+    for the read if it is still running), so storage latency overlaps with
+    decoding and transforms of the datapoints before it. Bytes that are being
+    read or waiting to be taken are bounded by `max_inflight_bytes`: past the
+    budget, `submit` skips paths, which are then read synchronously as before.
+
+    The pool and pending reads belong to the process that started them and
+    are dropped after a fork into DataLoader workers or on pickling.
+    """
+
+    # Budget charged for a read whose size is not known yet
+    _DEFAULT_ESTIMATE = 512 << 10
+
+    def __init__(self, num_threads: int = 8, max_inflight_bytes: int = 256 << 20):
+        self.num_threads = num_threads
+        self.max_inflight_bytes = max_inflight_bytes
+        self._reset()
+
+    def _reset(self):
+        self._pid = os.getpid()
+        self._pool = None
+        self._lock = threading.Lock()
+        self._pending: Dict[str, Tuple[Future, int]] = {}
+        self._reserved = 0
+        self._read_bytes = 0
+        self._read_count = 0
+
+    def __getstate__(self):
+        return {
+            "num_threads": self.num_threads,
+            "max_inflight_bytes": self.max_inflight_bytes,
+        }
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._reset()
+
+    def _estimate(self) -> int:
+        if self._read_count == 0:
+            return self._DEFAULT_ESTIMATE
+        return self._read_bytes // self._read_count
+
+    def _read(self, path: str, reserved: int) -> bytes:
+        try:
+            with g_pathmgr.open(path, "rb") as fopen:
+                data = fopen.read()
+        except BaseException:
+            with self._lock:
+                self._reserved -= reserved
+            raise
+        with self._lock:
+            # Replace the estimate with the real size until the bytes are taken
+            self._reserved += len(data) - reserved
+            self._read_bytes += len(data)
+            self._read_count += 1
+        return data
+
+    def submit(self, paths: List[str]):
+        if self._pid != os.getpid():
+            self._reset()
+        with self._lock:
+            if self._pool is None:
+                self._pool = ThreadPoolExecutor(
+                    max_workers=self.num_threads, thread_name_prefix="prefetch"
+                )
+            for path in paths:
+                estimate = self._estimate()
+                if path in self._pending:
+                    continue
+                if self._reserved + estimate > self.max_inflight_bytes:
+                    break
+                self._reserved += estimate
+                self._pending[path] = (
+                    self._pool.submit(self._read, path, estimate),
+                    estimate,
+                )
+
+    def take(self, path: str) -> Optional[bytes]:
+        """The prefetched bytes of `path`, or None if it was not submitted."""
+        if self._pid != os.getpid():
+            return None
+        with self._lock:
+            pending = self._pending.pop(path, None)
+        if pending is None:
+            return None
+        data = pending[0].result()
+        with self._lock:
+            self._reserved -= len(data)
+        return data
+
+    def discard(self):
+        """Forget reads nobody took (e.g. a datapoint skipped by a retry)."""
+        with self._lock:
+            pending, self._pending = self._pending, {}
+        for path, (future, _) in pending.items():
+            if future.cancel():
+                with self._lock:
+                    self._reserved -= pending[path][1]
+            else:
+                try:
+                    data = future.result()
+                except Exception:
+                    continue
+                with self._lock:
+                    self._reserved -= len(data)
+
+
+ANNOTATION_INDEX_MAGIC = b"SAM3COL1"
+ANNOTATION_INDEX_VERSION = 2
+_INDEX_ALIGN = 64
+# Stand-in for an absent optional integer field
+_MISSING = np.iinfo(np.int64).min
+
+
+class _ColumnBuilder:
+    """Accumulates the columns of a ColumnarAnnotationIndex while compiling it."""
+
+    def __init__(self):
+        self.values = {}
+        self.dtypes = {}
+
+    def add(self, name: str, value, dtype):
+        self.dtypes[name] = dtype
+        self.values.setdefault(name, []).append(value)
+
+    def extend(self, name: str, values, dtype):
+        self.dtypes[name] = dtype
+        self.values.setdefault(name, []).extend(values)
+
+    def add_string(self, name: str, value: Optional[Union[str, bytes]]):
+        # Strings are one flat uint8 column plus CSR offsets and a null flag
+        if isinstance(value, str):
+            value = value.encode("utf-8")
+        self.add(name + "_null", value is None, np.uint8)
+        data = self.values.setdefault(name + "_data", [])
+        self.dtypes[name + "_data"] = np.uint8
+        data.append(value or b"")
+
+    def finish(self) -> Dict[str, np.ndarray]:
+        columns = {}
+        for name, values in self.values.items():
+            if name.endswith("_data"):
+                columns[name[: -len("_data")] + "_offsets"] = np.concatenate(
+                    [[0], np.cumsum([len(v) for v in values])]
+                ).astype(np.int64)
+                columns[name] = np.frombuffer(b"".join(values), dtype=np.uint8)
+            else:
+                columns[name] = np.asarray(values, dtype=self.dtypes[name])
+        return columns
+
+
+def compile_annotation_index(loader, out_path: str, ids: Optional[List[int]] = None):
+    """Flatten everything `loader` returns into the single-file columnar format.
+
+    `loader` is any object with the COCO_FROM_JSON API (getDatapointIds,
+    loadImagesFromDatapoint, loadQueriesAndAnnotationsFromDatapoint). Per
+    datapoint rows of the image, annotation and query tables are found through
+    CSR offsets; ragged fields (object_ids_output, input boxes, points, strings)
+    use their own offsets into flat columns.
+
+    File layout: magic, uint64 header length, JSON header describing every
+    column (dtype, shape, byte offset), then the columns, each 64-byte aligned.
+    """
+    ids = sorted(loader.getDatapointIds()) if ids is None else sorted(ids)
+    cols = _ColumnBuilder()
+    img_rows = ann_rows = query_rows = 0
+    num_object_ids = num_boxes = num_points = 0
+    for datapoint_id in ids:
+        images = loader.loadImagesFromDatapoint(datapoint_id)
+        queries, annotations = loader.loadQueriesAndAnnotationsFromDatapoint(
+            datapoint_id
+        )
+        cols.add("datapoint_id", datapoint_id, np.int64)
+        for meta in images:
+            cols.add("img_id", meta["id"], np.int64)
+            cols.add_string("img_file_name", meta["file_name"])
+            for key in ("original_img_id", "coco_img_id"):
+                value = meta.get(key)
+                cols.add("img_" + key + "_is_int", isinstance(value, int), np.uint8)
+                cols.add_string("img_" + key, None if value is None else str(value))
+        for ann in annotations:
+            cols.add("ann_id", ann["id"], np.int64)
+            cols.add("ann_image_id", ann["image_id"], np.int64)
+            cols.add(
+                "ann_bbox",
+                np.asarray(ann["bbox"], dtype=np.float32).reshape(4),
+                np.float32,
+            )
+            cols.add("ann_area", float(ann["area"]), np.float64)
+            cols.add("ann_object_id", ann.get("object_id", _MISSING), np.int64)
+            cols.add("ann_frame_index", ann.get("frame_index", _MISSING), np.int64)
+            is_crowd = ann.get("is_crowd")
+            cols.add("ann_is_crowd", -1 if is_crowd is None else int(is_crowd), np.int8)
+            cols.add_string("ann_source", ann.get("source"))
+            segment = ann.get("segmentation")
+            if segment is not None and not isinstance(
+                segment.get("counts"), (str, bytes)
+            ):
+                raise ValueError(
+                    f"Datapoint {datapoint_id}: only compressed RLE segmentations are supported"
+                )
+            cols.add(
+                "ann_segment_size", segment["size"] if segment else [0, 0], np.int32
+            )
+            cols.add_string(
+                "ann_segment_counts", segment["counts"] if segment else None
+            )
+            cols.add(
+                "ann_segment_counts_is_str",
+                bool(segment) and isinstance(segment["counts"], str),
+                np.uint8,
+            )
+        for query in queries:
+            cols.add("q_id", query["id"], np.int64)
+            cols.add("q_image_id", query["image_id"], np.int64)
+            original_cat_id = query.get("original_cat_id")
+            cols.add(
+                "q_original_cat_id",
+                _MISSING if original_cat_id is None else original_cat_id,
+                np.int64,
+            )
+            # Resolved like lvis_repeat_factors does for the JSON loader
+            category = _query_category(query)
+            cols.add("q_category", _MISSING if category is None else category, np.int64)
+            cols.add("q_processing_order", query["query_processing_order"], np.int64)
+            cols.add("q_is_exhaustive", bool(query["is_exhaustive"]), np.uint8)
+            pixel = query.get("is_pixel_exhaustive", ...)
+            cols.add(
+                "q_is_pixel_exhaustive",
+                -2 if pixel is ... else (-1 if pixel is None else int(pixel)),
+                np.int8,
+            )
+            cols.add_string("q_text", query["query_text"])
+
+            object_ids = list(query["object_ids_output"] or [])
+            cols.extend("q_object_ids", object_ids, np.int64)
+            num_object_ids += len(object_ids)
+            cols.add("q_object_ids_end", num_object_ids, np.int64)
+
+            boxes = query.get("input_box")
+            boxes = (
+                np.zeros((0, 4), np.float32)
+                if boxes is None
+                else np.asarray(boxes, np.float32).reshape(-1, 4)
+            )
+            labels = query.get("input_box_label")
+            cols.add("q_has_box_label", labels is not None, np.uint8)
+            labels = (
+                np.ones(len(boxes), np.int64)
+                if labels is None
+                else np.asarray(labels, np.int64).reshape(-1)
+            )
+            cols.extend("q_boxes", boxes, np.float32)
+            cols.extend("q_box_labels", labels, np.int64)
+            num_boxes += len(boxes)
+            cols.add("q_boxes_end", num_boxes, np.int64)
+
+            points = query.get("input_points")
+            cols.add("q_has_points", points is not None, np.uint8)
+            points = (
+                np.zeros((0, 3), np.float32)
+                if points is None
+                else np.asarray(points, np.float32).reshape(-1, 3)
+            )
+            cols.extend("q_points", points, np.float32)
+            num_points += len(points)
+            cols.add("q_points_end", num_points, np.int64)
+
+        img_rows += len(images)
+        ann_rows += len(annotations)
+        query_rows += len(queries)
+        cols.add("img_end", img_rows, np.int64)
+        cols.add("ann_end", ann_rows, np.int64)
+        cols.add("q_end", query_rows, np.int64)
+
+    columns = cols.finish()
+    # Empty tables still need correctly shaped columns
+    columns.setdefault("ann_bbox", np.zeros((0, 4), np.float32)).shape = (-1, 4)
+    columns.setdefault("ann_segment_size", np.zeros((0, 2), np.int32)).shape = (-1, 2)
+    columns.setdefault("q_boxes", np.zeros((0, 4), np.float32)).shape = (-1, 4)
+    columns.setdefault("q_points", np.zeros((0, 3), np.float32)).shape = (-1, 3)
+    for name in (
+        "img_end",
+        "ann_end",
+        "q_end",
+        "q_object_ids_end",
+        "q_boxes_end",
+        "q_points_end",
+    ):
+        # CSR offsets with a leading zero: rows of item i are [offsets[i], offsets[i + 1])
+        columns[name[: -len("_end")] + "_offsets"] = np.concatenate(
+            [[0], columns.pop(name, np.zeros(0, np.int64))]
+        ).astype(np.int64)
+    for name in ("q_object_ids", "q_box_labels"):
+        columns.setdefault(name, np.zeros(0, np.int64))
+
+    header = {"version": ANNOTATION_INDEX_VERSION, "num_datapoints": len(ids)}
+    _write_column_file(out_path, ANNOTATION_INDEX_MAGIC, header, columns)
+
+
+def _write_column_file(
+    out_path: str, magic: bytes, header: Dict[str, Any], columns: Dict[str, np.ndarray]
+):
+    """Write magic, uint64 header length, the JSON header (extended with the
+    dtype, shape and byte offset of every column), then the 64-byte aligned
+    columns. The file is written next to out_path and renamed into place."""
+    header = dict(header, columns={})
+    offset = 0
+    for name, array in columns.items():
+        offset = -(-offset // _INDEX_ALIGN) * _INDEX_ALIGN
+        header["columns"][name] = {
+            "dtype": array.dtype.str,
+            "shape": list(array.shape),
+            "offset": offset,
+        }
+        offset += array.nbytes
+    header_bytes = json.dumps(header).encode("utf-8")
+    data_start = -(-(len(magic) + 8 + len(header_bytes)) // _INDEX_ALIGN) * _INDEX_ALIGN
+
+    tmp_path = out_path + ".tmp"
+    with open(tmp_path, "wb") as fopen:
+        fopen.write(magic)
+        fopen.write(struct.pack("<Q", len(header_bytes)))
+        fopen.write(header_bytes)
+        for name, array in columns.items():
+            fopen.seek(data_start + header["columns"][name]["offset"])
+            fopen.write(np.ascontiguousarray(array).tobytes())
+    os.replace(tmp_path, out_path)
+
+
+def _map_column_file(
+    path: str, magic: bytes, version: int, kind: str
+) -> Tuple[Dict[str, Any], Dict[str, np.ndarray]]:
+    """Memory-map a file written by _write_column_file: (header, columns)."""
+    with open(path, "rb") as fopen:
+        if fopen.read(len(magic)) != magic:
+            raise ValueError(f"{path} is not a {kind}")
+        (header_len,) = struct.unpack("<Q", fopen.read(8))
+        header = json.loads(fopen.read(header_len))
+    if header["version"] != version:
+        raise ValueError(f"Unsupported {kind} version {header['version']} in {path}")
+    data_start = -(-(len(magic) + 8 + header_len) // _INDEX_ALIGN) * _INDEX_ALIGN
+    buffer = np.memmap(path, dtype=np.uint8, mode="r")
+    columns = {}
+    for name, spec in header["columns"].items():
+        dtype = np.dtype(spec["dtype"])
+        count = int(np.prod(spec["shape"]))
+        start = data_start + spec["offset"]
+        columns[name] = (
+            buffer[start : start + count * dtype.itemsize]
+            .view(dtype)
+            .reshape(spec["shape"])
+        )
+    return header, columns
+
+
+class ColumnarAnnotationIndex:
+    """Read-only, memory-mapped annotation index written by compile_annotation_index.
+
+    Implements the COCO_FROM_JSON loader API, so it can be passed as
+    `coco_json_loader` with `annFile` pointing to the compiled file. Only the
+    rows of the requested datapoint are turned into Python objects; all other
+    data stays in the page cache, shared by every DataLoader worker, so worker
+    RSS and startup time do not grow with the size of the annotation file.
+    """
+
+    def __init__(self, annotation_file: str):
+        self.annotation_file = annotation_file
+        self._open()
+
+    def _open(self):
+        _, self.columns = _map_column_file(
+            self.annotation_file,
+            ANNOTATION_INDEX_MAGIC,
+            ANNOTATION_INDEX_VERSION,
+            "columnar annotation index",
+        )
+
+    def __getstate__(self):
+        # np.memmap would pickle its whole contents; reopen the file instead
+        return {"annotation_file": self.annotation_file}
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._open()
+
+    def getDatapointIds(self):
+        return self.columns["datapoint_id"].tolist()
+
+    def _row(self, idx: int) -> int:
+        ids = self.columns["datapoint_id"]
+        row = int(np.searchsorted(ids, idx))
+        if row >= len(ids) or ids[row] != idx:
+            raise KeyError(f"Datapoint {idx} not in {self.annotation_file}")
+        return row
+
+    def _range(self, name: str, i: int) -> Tuple[int, int]:
+        offsets = self.columns[name + "_offsets"]
+        return int(offsets[i]), int(offsets[i + 1])
+
+    def _string(self, name: str, i: int) -> Optional[str]:
+        if self.columns[name + "_null"][i]:
+            return None
+        start, end = self._range(name, i)
+        return self.columns[name + "_data"][start:end].tobytes().decode("utf-8")
+
+    def _query_rows(self, rows: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+        # (datapoint position, query row) pairs of the requested rows, in
+        # order, without a Python loop; rows may come in any order
+        q_offsets = self.columns["q_offsets"]
+        counts = q_offsets[rows + 1] - q_offsets[rows]
+        positions = np.repeat(np.arange(len(rows)), counts)
+        starts = np.repeat(q_offsets[rows] - np.cumsum(counts) + counts, counts)
+        return positions, starts + np.arange(counts.sum())
+
+    def getQueryStats(self, ids: List[int]) -> Tuple[np.ndarray, np.ndarray]:
+        """Number of queries and largest number of outputs of a query, per datapoint.
+
+        Computed from the offset columns alone, without building any dict.
+        """
+        rows = np.searchsorted(self.columns["datapoint_id"], ids)
+        positions, query_rows = self._query_rows(rows)
+        outputs = np.diff(self.columns["q_object_ids_offsets"])
+        num_queries = np.bincount(positions, minlength=len(rows)).astype(np.int64)
+        # 0 where a datapoint has no query
+        max_outputs = np.zeros(len(rows), dtype=np.int64)
+        np.maximum.at(max_outputs, positions, outputs[query_rows])
+        return num_queries, max_outputs
+
+    def getPositiveCategories(self, ids: List[int]) -> Tuple[np.ndarray, np.ndarray]:
+        """(datapoint position, category) of every query with at least one output."""
+        rows = np.searchsorted(self.columns["datapoint_id"], ids)
+        positions, query_rows = self._query_rows(rows)
+        positive = np.diff(self.columns["q_object_ids_offsets"])[query_rows] > 0
+        categories = self.columns["q_category"][query_rows]
+        return positions[positive], categories[positive]
+
+    def loadImagesFromDatapoint(self, idx):
+        images = []
+        start, end = self._range("img", self._row(idx))
+        for i in range(start, end):
+            meta = {
+                "id": int(self.columns["img_id"][i]),
+                "file_name": self._string("img_file_name", i),
+            }
+            for key in ("original_img_id", "coco_img_id"):
+                value = self._string("img_" + key, i)
+                if value is not None:
+                    is_int = self.columns["img_" + key + "_is_int"][i]
+                    meta[key] = int(value) if is_int else value
+            images.append(meta)
+        return images
+
+    def loadQueriesAndAnnotationsFromDatapoint(self, idx):
+        row = self._row(idx)
+        c = self.columns
+
+        annotations = []
+        start, end = self._range("ann", row)
+        # One copy per datapoint; each annotation gets a row view of it
+        bboxes = torch.from_numpy(np.array(c["ann_bbox"][start:end]))
+        for j, i in enumerate(range(start, end)):
+            annotation = {
+                "id": int(c["ann_id"][i]),
+                "image_id": int(c["ann_image_id"][i]),
+                "bbox": bboxes[j],
+                "area": float(c["ann_area"][i]),
+                "segmentation": None,
+                "is_crowd": (
+                    None if c["ann_is_crowd"][i] < 0 else int(c["ann_is_crowd"][i])
+                ),
+            }
+            for key in ("object_id", "frame_index"):
+                value = int(c["ann_" + key][i])
+                if value != _MISSING:
+                    annotation[key] = value
+            source = self._string("ann_source", i)
+            if source is not None:
+                annotation["source"] = source
+            if not c["ann_segment_counts_null"][i]:
+                counts_start, counts_end = self._range("ann_segment_counts", i)
+                counts = c["ann_segment_counts_data"][counts_start:counts_end].tobytes()
+                if c["ann_segment_counts_is_str"][i]:
+                    counts = counts.decode("ascii")
+                annotation["segmentation"] = {
+                    "size": c["ann_segment_size"][i].tolist(),
+                    "counts": counts,
+                }
+            annotations.append(annotation)
+
+        queries = []
+        start, end = self._range("q", row)
+        for i in range(start, end):
+            original_cat_id = int(c["q_original_cat_id"][i])
+            ids_start, ids_end = self._range("q_object_ids", i)
+            box_start, box_end = self._range("q_boxes", i)
+            point_start, point_end = self._range("q_points", i)
+            query = {
+                "id": int(c["q_id"][i]),
+                "original_cat_id": (
+                    None if original_cat_id == _MISSING else original_cat_id
+                ),
+                "object_ids_output": c["q_object_ids"][ids_start:ids_end].tolist(),
+                "query_text": self._string("q_text", i),
+                "query_processing_order": int(c["q_processing_order"][i]),
+                "ptr_x_query_id": None,
+                "ptr_y_query_id": None,
+                "image_id": int(c["q_image_id"][i]),
+                "input_box": None,
+                "input_box_label": None,
+                "input_points": None,
+                "is_exhaustive": bool(c["q_is_exhaustive"][i]),
+            }
+            if box_end > box_start:
+                query["input_box"] = np.array(c["q_boxes"][box_start:box_end])
+                if c["q_has_box_label"][i]:
+                    query["input_box_label"] = np.array(
+                        c["q_box_labels"][box_start:box_end]
+                    )
+            if c["q_has_points"][i]:
+                query["input_points"] = np.array(c["q_points"][point_start:point_end])
+            pixel = int(c["q_is_pixel_exhaustive"][i])
+            if pixel != -2:
+                query["is_pixel_exhaustive"] = None if pixel == -1 else bool(pixel)
+            queries.append(query)
+        return queries, annotations
+
+
+SAMPLE_PACK_MAGIC = b"SAM3ZPK1"
+SAMPLE_PACK_VERSION = 1
+
+
+def _require_zstd():
+    if zstd is None:
+        raise ImportError(
+            "zstd_dict_path / sample packs need the zstandard package (pip install zstandard)"
+        )
+
+
+def _record_default(value):
+    # Tensors and arrays keep dtype and shape (an empty (0, 4) box list included)
+    if isinstance(value, torch.Tensor):
+        return {
+            "__tensor__": value.reshape(-1).tolist(),
+            "dtype": str(value.dtype).split(".")[-1],
+            "shape": list(value.shape),
+        }
+    if isinstance(value, np.ndarray):
+        return {
+            "__ndarray__": value.reshape(-1).tolist(),
+            "dtype": value.dtype.str,
+            "shape": list(value.shape),
+        }
+    if isinstance(value, np.generic):
+        return value.item()
+    if isinstance(value, bytes):
+        # RLE counts are ASCII
+        return {"__bytes__": value.decode("latin-1")}
+    raise TypeError(f"Cannot serialize {type(value).__name__} in a sample record")
+
+
+def _record_object_hook(obj):
+    if "__tensor__" in obj:
+        dtype = getattr(torch, obj["dtype"])
+        return torch.tensor(obj["__tensor__"], dtype=dtype).view(obj["shape"])
+    if "__ndarray__" in obj:
+        return np.array(obj["__ndarray__"], dtype=obj["dtype"]).reshape(obj["shape"])
+    if "__bytes__" in obj:
+        return obj["__bytes__"].encode("latin-1")
+    return obj
+
+
+def _loader_record(loader, datapoint_id: int) -> Dict[str, Any]:
+    queries, annotations = loader.loadQueriesAndAnnotationsFromDatapoint(datapoint_id)
+    return {
+        "images": loader.loadImagesFromDatapoint(datapoint_id),
+        "queries": queries,
+        "annotations": annotations,
+    }
+
+
+def encode_sample_record(record: Dict[str, Any]) -> bytes:
+    """Serialize one datapoint (image metadata, queries, annotations with their
+    RLE masks) as compact JSON; tensors and arrays keep dtype and shape."""
+    return json.dumps(record, separators=(",", ":"), default=_record_default).encode(
+        "utf-8"
+    )
+
+
+def train_sample_dictionary(
+    loader,
+    out_path: str,
+    dict_size: int = 112 << 10,
+    num_samples: int = 20000,
+    seed: int = 0,
+) -> int:
+    """Train a zstd dictionary on up to `num_samples` random records of `loader`
+    and write it to out_path. Returns the dictionary id.
+
+    Records of one dataset share most of their bytes (key names, category
+    texts, RLE prefixes); a dictionary lets each small record be compressed
+    against that shared content instead of on its own.
+    """
+    _require_zstd()
+    ids = sorted(loader.getDatapointIds())
+    if len(ids) > num_samples:
+        ids = random.Random(seed).sample(ids, num_samples)
+    samples = [
+        encode_sample_record(_loader_record(loader, datapoint_id))
+        for datapoint_id in ids
+    ]
+    dictionary = zstd.train_dictionary(dict_size, samples)
+    tmp_path = out_path + ".tmp"
+    with open(tmp_path, "wb") as fopen:
+        fopen.write(dictionary.as_bytes())
+    os.replace(tmp_path, out_path)
+    return dictionary.dict_id()
+
+
+def _load_dictionary(dict_path: str):
+    with g_pathmgr.open(dict_path, "rb") as fopen:
+        return zstd.ZstdCompressionDict(fopen.read())
+
+
+def build_sample_pack(
+    loader,
+    out_path: str,
+    dict_path: str,
+    level: int = 10,
+    ids: Optional[List[int]] = None,
+) -> Dict[str, int]:
+    """Compress every record of `loader` with the dictionary at dict_path into
+    an indexed pack file read by ZstdSamplePack.
+
+    Same file layout as compile_annotation_index, with the columns
+    datapoint_id (sorted), record_offsets (CSR into the `records` blob of
+    independent zstd frames), the per-datapoint query stats used by the
+    prefilter and the positive categories used by lvis_repeat_factors, so
+    neither has to decompress anything. Returns the raw / compressed sizes.
+    """
+    _require_zstd()
+    dictionary = _load_dictionary(dict_path)
+    compressor = zstd.ZstdCompressor(level=level, dict_data=dictionary)
+    ids = sorted(loader.getDatapointIds()) if ids is None else sorted(ids)
+    cols = _ColumnBuilder()
+    frames = []
+    raw_bytes = 0
+    record_end = category_end = 0
+    for datapoint_id in ids:
+        record = _loader_record(loader, datapoint_id)
+        queries = record["queries"]
+        encoded = encode_sample_record(record)
+        raw_bytes += len(encoded)
+        frame = compressor.compress(encoded)
+        frames.append(frame)
+        cols.add("datapoint_id", datapoint_id, np.int64)
+        record_end += len(frame)
+        cols.add("record_end", record_end, np.int64)
+        cols.add("num_queries", len(queries), np.int64)
+        cols.add(
+            "max_outputs",
+            max((len(q["object_ids_output"] or []) for q in queries), default=0),
+            np.int64,
+        )
+        for query in queries:
+            if query["object_ids_output"]:
+                category = _query_category(query)
+                cols.add(
+                    "positive_category",
+                    _MISSING if category is None else category,
+                    np.int64,
+                )
+                category_end += 1
+        cols.add("positive_category_end", category_end, np.int64)
+
+    columns = cols.finish()
+    columns["records"] = np.frombuffer(b"".join(frames), np.uint8)
+    columns.setdefault("positive_category", np.zeros(0, np.int64))
+    for name in ("record_end", "positive_category_end"):
+        columns[name[: -len("_end")] + "_offsets"] = np.concatenate(
+            [[0], columns.pop(name, np.zeros(0, np.int64))]
+        ).astype(np.int64)
+    columns.setdefault("datapoint_id", np.zeros(0, np.int64))
+    for name in ("num_queries", "max_outputs"):
+        columns.setdefault(name, np.zeros(0, np.int64))
+
+    header = {
+        "version": SAMPLE_PACK_VERSION,
+        "num_datapoints": len(ids),
+        "dict_id": dictionary.dict_id(),
+    }
+    _write_column_file(out_path, SAMPLE_PACK_MAGIC, header, columns)
+    return {"raw_bytes": raw_bytes, "compressed_bytes": record_end}
+
+
+class ZstdSamplePack:
+    """Read-only pack of dictionary-compressed datapoint records written by
+    build_sample_pack.
+
+    Implements the COCO_FROM_JSON loader API; CustomCocoDetectionAPI uses it
+    when zstd_dict_path is set, with annFile pointing to the pack. The pack is
+    memory-mapped and only the requested record is decompressed, so page
+    cache and worker memory hold compressed bytes only.
+    """
+
+    def __init__(self, annotation_file: str, dict_path: str):
+        _require_zstd()
+        self.annotation_file = annotation_file
+        self.dict_path = dict_path
+        self._open()
+
+    def _open(self):
+        header, self.columns = _map_column_file(
+            self.annotation_file, SAMPLE_PACK_MAGIC, SAMPLE_PACK_VERSION, "sample pack"
+        )
+        dictionary = _load_dictionary(self.dict_path)
+        if dictionary.dict_id() != header["dict_id"]:
+            raise ValueError(
+                f"{self.annotation_file} was compressed with dictionary "
+                f"{header['dict_id']}, {self.dict_path} is {dictionary.dict_id()}"
+            )
+        self._decompressor = zstd.ZstdDecompressor(dict_data=dictionary)
+        # Images and annotations of a datapoint are requested back to back
+        self._last = (None, None)
+
+    def __getstate__(self):
+        # Neither np.memmap nor the decompressor should travel to workers
+        return {"annotation_file": self.annotation_file, "dict_path": self.dict_path}
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._open()
+
+    def getDatapointIds(self):
+        return self.columns["datapoint_id"].tolist()
+
+    def _rows(self, ids: List[int]) -> np.ndarray:
+        return np.searchsorted(self.columns["datapoint_id"], ids)
+
+    def _record(self, idx: int) -> Dict[str, Any]:
+        if self._last[0] == idx:
+            return self._last[1]
+        ids = self.columns["datapoint_id"]
+        row = int(np.searchsorted(ids, idx))
+        if row >= len(ids) or ids[row] != idx:
+            raise KeyError(f"Datapoint {idx} not in {self.annotation_file}")
+        offsets = self.columns["record_offsets"]
+        frame = self.columns["records"][offsets[row] : offsets[row + 1]]
+        record = json.loads(
+            self._decompressor.decompress(frame), object_hook=_record_object_hook
+        )
+        self._last = (idx, record)
+        return record
+
+    def getQueryStats(self, ids: List[int]) -> Tuple[np.ndarray, np.ndarray]:
+        rows = self._rows(ids)
+        return self.columns["num_queries"][rows], self.columns["max_outputs"][rows]
+
+    def getPositiveCategories(self, ids: List[int]) -> Tuple[np.ndarray, np.ndarray]:
+        rows = self._rows(ids)
+        offsets = self.columns["positive_category_offsets"]
+        counts = offsets[rows + 1] - offsets[rows]
+        positions = np.repeat(np.arange(len(rows)), counts)
+        starts = np.repeat(offsets[rows] - np.cumsum(counts) + counts, counts)
+        return (
+            positions,
+            self.columns["positive_category"][starts + np.arange(counts.sum())],
+        )
+
+    def loadImagesFromDatapoint(self, idx):
+        return self._record(idx)["images"]
+
+    def loadQueriesAndAnnotationsFromDatapoint(self, idx):
+        record = self._record(idx)
+        return record["queries"], record["annotations"]
+
+
+def _code_fingerprint(code) -> bytes:
+    """Bytecode, names and constants of `code`, nested code objects included.
+
+    repr() of a nested code object (a lambda, comprehension or inner function)
+    contains its memory address, so those are walked instead of repr'd.
+    """
+    consts = [
+        (
+            _code_fingerprint(const)
+            if isinstance(const, types.CodeType)
+            else repr(const).encode("utf-8")
+        )
+        for const in code.co_consts
+    ]
+    return b"\0".join([code.co_code, repr(code.co_names).encode("utf-8"), *consts])
+
+
+def query_filter_signature(query_filter: Callable) -> str:
+    """Text identifying a filter_query predicate across processes and runs.
+
+    Functions are identified by name, bytecode, constants and closure values,
+    partials by their function and arguments, other callables by their class
+    and pickled state, so editing a filter invalidates its cached results.
+    """
+    if isinstance(query_filter, functools.partial):
+        return (
+            f"partial({query_filter_signature(query_filter.func)}, "
+            f"{query_filter.args!r}, {sorted(query_filter.keywords.items())!r})"
+        )
+    code = getattr(query_filter, "__code__", None)
+    if code is not None:
+        closure = [
+            # Functions in the closure by their own signature, not their address
+            (
+                query_filter_signature(value)
+                if isinstance(value, (types.FunctionType, functools.partial))
+                else value
+            )
+            for value in (cell.cell_contents for cell in query_filter.__closure__ or ())
+        ]
+        digest = hashlib.sha256(
+            _code_fingerprint(code) + repr(closure).encode("utf-8")
+        ).hexdigest()[:16]
+        return f"{query_filter.__module__}.{query_filter.__qualname__}:{digest}"
+    cls = type(query_filter)
+    # __getstate__ lets a filter leave out derived state such as sets, whose
+    # repr order changes between runs
+    state = (
+        query_filter.__getstate__()
+        if hasattr(query_filter, "__getstate__")
+        else vars(query_filter)
+    )
+    if isinstance(state, dict):
+        state = sorted(state.items())
+    return f"{cls.__module__}.{cls.__qualname__}({state!r})"
+
+
+class QueryTextFilter:
+    """filter_query predicate keeping queries by their text.
+
+    Args:
+        keep: If given, only queries whose text is in it survive.
+        exclude: Queries whose text is in it are dropped.
+    """
+
+    def __init__(
+        self, keep: Optional[List[str]] = None, exclude: Optional[List[str]] = None
+    ):
+        self.keep = sorted(keep) if keep is not None else None
+        self.exclude = sorted(exclude or [])
+        self._keep = set(self.keep) if keep is not None else None
+        self._exclude = set(self.exclude)
+
+    def __getstate__(self):
+        return {"keep": self.keep, "exclude": self.exclude}
+
+    def __setstate__(self, state):
+        self.__init__(**state)
+
+    def __call__(self, query: Dict[str, Any]) -> bool:
+        text = query["query_text"]
+        if self._keep is not None and text not in self._keep:
+            return False
+        return text not in self._exclude
+
+
+class FilteredAnnotationIndex:
+    """View of a loader restricted to the queries a filter_query predicate kept.
+
+    Built by CustomCocoDetectionAPI from the cached filter results: the
+    surviving datapoint ids (sorted), CSR offsets into the kept query
+    positions, and the number of outputs and the category of every kept
+    query. Queries are pruned before load_queries sees them; annotations
+    are passed through untouched.
+    """
+
+    def __init__(self, loader, columns: Dict[str, np.ndarray]):
+        self.loader = loader
+        self.columns = columns
+
+    def getDatapointIds(self):
+        return self.columns["datapoint_id"].tolist()
+
+    def _row(self, idx: int) -> int:
+        ids = self.columns["datapoint_id"]
+        row = int(np.searchsorted(ids, idx))
+        if row >= len(ids) or ids[row] != idx:
+            raise KeyError(f"Datapoint {idx} has no query left after filter_query")
+        return row
+
+    def _query_rows(self, rows: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+        # (datapoint position, kept query row) pairs of the requested rows
+        offsets = self.columns["offsets"]
+        counts = offsets[rows + 1] - offsets[rows]
+        positions = np.repeat(np.arange(len(rows)), counts)
+        starts = np.repeat(offsets[rows] - np.cumsum(counts) + counts, counts)
+        return positions, starts + np.arange(counts.sum())
+
+    def getQueryStats(self, ids: List[int]) -> Tuple[np.ndarray, np.ndarray]:
+        rows = np.searchsorted(self.columns["datapoint_id"], ids)
+        positions, query_rows = self._query_rows(rows)
+        num_queries = np.bincount(positions, minlength=len(rows)).astype(np.int64)
+        max_outputs = np.zeros(len(rows), dtype=np.int64)
+        np.maximum.at(max_outputs, positions, self.columns["outputs"][query_rows])
+        return num_queries, max_outputs
+
+    def getPositiveCategories(self, ids: List[int]) -> Tuple[np.ndarray, np.ndarray]:
+        rows = np.searchsorted(self.columns["datapoint_id"], ids)
+        positions, query_rows = self._query_rows(rows)
+        positive = self.columns["outputs"][query_rows] > 0
+        return positions[positive], self.columns["category"][query_rows][positive]
+
+    def loadImagesFromDatapoint(self, idx):
+        return self.loader.loadImagesFromDatapoint(idx)
+
+    def loadQueriesAndAnnotationsFromDatapoint(self, idx):
+        row = self._row(idx)
+        start, end = self.columns["offsets"][row : row + 2]
+        queries, annotations = self.loader.loadQueriesAndAnnotationsFromDatapoint(idx)
+        return [queries[i] for i in self.columns["positions"][start:end]], annotations
+
+
+def _stack_rows(values: List[Any], width: int) -> torch.Tensor:
+    """Stack per-item lists/arrays/tensors into one (N, width) tensor with a single copy."""
+    if isinstance(values[0], torch.Tensor):
+        return torch.cat([value.reshape(-1, width) for value in values])
+    if isinstance(values[0], np.ndarray):
+        return torch.from_numpy(
+            np.concatenate([value.reshape(-1, width) for value in values])
+        )
+    return torch.as_tensor(values).view(-1, width)
+
+
+def _denormalize_(
+    rows: torch.Tensor, sizes: torch.Tensor, x_cols: slice, y_cols: slice
+) -> torch.Tensor:
+    """Scale the normalized x/y columns of `rows` in place by the per-row
+    (h, w) in `sizes` and clamp them to the image."""
+    sizes = sizes.to(rows.dtype)
+    for cols, limit in ((x_cols, sizes[:, 1:2]), (y_cols, sizes[:, 0:1])):
+        part = rows[:, cols]
+        part.mul_(limit).clamp_(min=0)
+        torch.minimum(part, limit, out=part)
+    return rows
+
+
 class CustomCocoDetectionAPI(VisionDataset):
-    ""`MS Coco Detection <https://cocodataset.org/#detection-2016>`_ Dataset.
+    """`MS Coco Detection <https://cocodataset.org/#detection-2016>`_ Dataset.
 
     Args:
         root (string): Root directory where images are downloaded to.
@@ -156,6 +1612,29 @@ class CustomCocoDetectionAPI(VisionDataset):
             target and transforms it.
         transforms (callable, optional): A function/transform that takes input sample and its target as entry
             and returns a transformed version.
+        filter_query (callable, optional): Predicate over the query dicts of the
+            loader; only queries it returns True for are loaded, and datapoints
+            left without queries are dropped. Evaluated once per annotation
+            file and cached next to it, keyed by ``query_filter_signature``.
+        zstd_dict_path (string, optional): zstd dictionary (see
+            ``train_sample_dictionary``). When set, ``annFile`` is a sample pack
+            built with it (see ``build_sample_pack``), read with ZstdSamplePack.
+        use_caching (bool): Read images from the decoded shard cache in
+            ``image_cache_dir`` (see ``build_image_cache``) when it exists.
+        image_cache_dir (string, optional): Defaults to ``annFile + ".imgcache"``.
+        video_frames_as_numpy (bool): Return mp4 frames as HxWx3 uint8 arrays
+            instead of PIL images. Only for transforms that accept arrays.
+        max_open_videos (int): Size of the per-worker pool of open video readers.
+        prefetch_threads (int): Threads reading the image files of a batch ahead
+            of decoding (see ``__getitems__``); 0 disables prefetching.
+        prefetch_max_bytes (int): Bound on the bytes being prefetched or
+            waiting to be decoded, per worker.
+        is_sharded_annotation_dir (bool): ``annFile`` is a directory of annotation
+            shards (files ending in ``shard_suffix``). Only one shard is loaded
+            at a time, picked by ``set_sharded_annotation_file(data_epoch)``.
+        shard_by_rank (bool): Give every distributed rank its own shard in each
+            data epoch instead of all ranks sharing one. Ranks then see
+            different lengths, so pair it with a per-rank sampler.
     """
 
     def __init__(
@@ -171,11 +1650,20 @@ class CustomCocoDetectionAPI(VisionDataset):
         filter_query=None,
         coco_json_loader: Callable = COCO_FROM_JSON,
         limit_ids: int = None,
+        image_cache_dir: Optional[str] = None,
+        video_frames_as_numpy: bool = False,
+        max_open_videos: int = 8,
+        prefetch_threads: int = 8,
+        prefetch_max_bytes: int = 256 << 20,
+        is_sharded_annotation_dir: bool = False,
+        shard_by_rank: bool = False,
+        shard_suffix: str = ".json",
     ) -> None:
         super().__init__(root)
 
         self.annFile = annFile
         self.use_caching = use_caching
+        self.image_cache_dir = image_cache_dir or f"{annFile}.imgcache"
         self.zstd_dict_path = zstd_dict_path
 
         self.curr_epoch = 0  # Used in case data loader behavior changes across epochs
@@ -184,12 +1672,136 @@ class CustomCocoDetectionAPI(VisionDataset):
         self.filter_query = filter_query
 
         self.coco = None
+        if zstd_dict_path is not None:
+            coco_json_loader = functools.partial(
+                ZstdSamplePack, dict_path=zstd_dict_path
+            )
         self.coco_json_loader = coco_json_loader
         self.limit_ids = limit_ids
+        self.is_sharded_annotation_dir = is_sharded_annotation_dir
+        self.shard_by_rank = shard_by_rank
+        self.shard_suffix = shard_suffix
+        self._annotation_shards = None
+        # The annotation file currently loaded (one of the shards when sharded)
+        self.annotation_path = None
         self.set_sharded_annotation_file(0)
         self.training = training
         self.blurring_masks_path = blurring_masks_path
 
+        self.video_frames_as_numpy = video_frames_as_numpy
+        self.video_readers = VideoReaderPool(max_open_videos)
+        self.prefetcher = (
+            ImagePrefetcher(prefetch_threads, prefetch_max_bytes)
+            if prefetch_threads > 0
+            else None
+        )
+        # mask path -> parsed blurring mask JSON (None if there is no file)
+        self._blurring_masks: Dict[str, Optional[Dict[str, Any]]] = {}
+
+        self.image_cache = None
+        if use_caching and ImageShardCache.exists(self.image_cache_dir):
+            image_cache = ImageShardCache(self.image_cache_dir)
+            if image_cache.max_size is not None and load_segmentation:
+                print(
+                    f"Not using resized image cache {self.image_cache_dir}: "
+                    "segmentation masks are stored at the original resolution"
+                )
+            else:
+                self.image_cache = image_cache
+
+    def _file_name(self, meta: Dict[str, Any]) -> str:
+        if self.fix_fname:
+            return meta["file_name"].split("/")[-1]
+        return meta["file_name"]
+
+    def _video_frame(self, frame: np.ndarray) -> Union[np.ndarray, PILImage.Image]:
+        if self.video_frames_as_numpy:
+            return frame
+        return PILImage.fromarray(frame)
+
+    def _read_image(self, path: str) -> Union[np.ndarray, PILImage.Image]:
+        """Decode one image, or one frame of an mp4 video, from storage."""
+        try:
+            if is_video_frame_path(path):
+                # Going to load a video frame
+                video_path, frame = split_video_frame_path(path)
+                return self._video_frame(
+                    self.video_readers.read_frames(video_path, [frame])[0]
+                )
+            data = self.prefetcher.take(path) if self.prefetcher is not None else None
+            if data is not None:
+                return PILImage.open(io.BytesIO(data)).convert("RGB")
+            with g_pathmgr.open(path, "rb") as fopen:
+                return PILImage.open(fopen).convert("RGB")
+        except FileNotFoundError as e:
+            print(f"File not found: {path} from dataset: {self.annFile}")
+            raise e
+
+    def _read_video_frames(self, paths: List[str]) -> List[Any]:
+        """Frames for several "@"-paths, one batched get_batch call per video."""
+        by_video = {}
+        for i, path in enumerate(paths):
+            video_path, frame = split_video_frame_path(path)
+            by_video.setdefault(video_path, []).append((i, frame))
+
+        frames = [None] * len(paths)
+        for video_path, items in by_video.items():
+            try:
+                decoded = self.video_readers.read_frames(
+                    video_path, [frame for _, frame in items]
+                )
+            except FileNotFoundError as e:
+                print(f"File not found: {video_path} from dataset: {self.annFile}")
+                raise e
+            for (i, _), frame in zip(items, decoded):
+                frames[i] = self._video_frame(frame)
+        return frames
+
+    def _blurring_mask(self, path: str) -> Optional[Dict[str, Any]]:
+        mask_fname = os.path.basename(path).replace(".jpg", "-mask.json")
+        mask_path = os.path.join(self.blurring_masks_path, mask_fname)
+        if mask_path not in self._blurring_masks:
+            blurring_mask = None
+            if os.path.exists(mask_path):
+                with open(mask_path, "r") as fopen:
+                    blurring_mask = json.load(fopen)
+            self._blurring_masks[mask_path] = blurring_mask
+        return self._blurring_masks[mask_path]
+
+    def _image_paths(self, datapoint_id: int) -> List[str]:
+        """Paths _load_images would read from storage for this datapoint."""
+        paths = []
+        for meta in self.coco.loadImagesFromDatapoint(datapoint_id):
+            file_name = self._file_name(meta)
+            if is_video_frame_path(file_name) or (
+                self.image_cache is not None and file_name in self.image_cache
+            ):
+                continue
+            paths.append(os.path.join(self.root, file_name))
+        return paths
+
+    def prefetch(self, indices: List[int]):
+        """Start reading the image files of the datapoints at `indices`."""
+        if self.prefetcher is None:
+            return
+        self.prefetcher.submit(
+            [
+                path
+                for index in indices
+                for path in self._image_paths(self.ids[index].item())
+            ]
+        )
+
+    def __getitems__(self, indices: List[int]) -> List[Any]:
+        # Called by DataLoader with a whole batch: read all its files
+        # concurrently while the first datapoints are decoded and transformed
+        self.prefetch(indices)
+        try:
+            return [self[index] for index in indices]
+        finally:
+            if self.prefetcher is not None:
+                self.prefetcher.discard()
+
     def _load_images(
         self,
         datapoint_id: int,
@@ -197,42 +1809,34 @@ class CustomCocoDetectionAPI(VisionDataset):
     ) -> Tuple[List[Tuple[int, PILImage.Image]], List[Dict[str, Any]]]:
         all_images = []
         all_img_metadata = []
+        video_slots = []
         for current_meta in self.coco.loadImagesFromDatapoint(datapoint_id):
             img_id = current_meta["id"]
             if img_ids_to_load is not None and img_id not in img_ids_to_load:
                 continue
-            if self.fix_fname:
-                current_meta["file_name"] = current_meta["file_name"].split("/")[-1]
+            current_meta["file_name"] = self._file_name(current_meta)
             path = current_meta["file_name"]
             if self.blurring_masks_path is not None:
-                mask_fname = os.path.basename(path).replace(".jpg", "-mask.json")
-                mask_path = os.path.join(self.blurring_masks_path, mask_fname)
-                if os.path.exists(mask_path):
-                    with open(mask_path, "r") as fopen:
-                        current_meta["blurring_mask"] = json.load(fopen)
+                blurring_mask = self._blurring_mask(path)
+                if blurring_mask is not None:
+                    current_meta["blurring_mask"] = blurring_mask
 
             all_img_metadata.append(current_meta)
-            path = os.path.join(self.root, path)
-            try:
-                if ".mp4" in path and path[-4:] == ".mp4":
-                    # Going to load a video frame
-                    video_path, frame = path.split("@")
-                    video = VideoReader(video_path, ctx=cpu(0))
-                    # Convert to PIL image
-                    all_images.append(
-                        (
-                            img_id,
-                            torchvision.transforms.ToPILImage()(
-                                video[int(frame)].asnumpy()
-                            ),
-                        )
-                    )
-                else:
-                    with g_pathmgr.open(path, "rb") as fopen:
-                        all_images.append((img_id, PILImage.open(fopen).convert("RGB")))
-            except FileNotFoundError as e:
-                print(f"File not found: {path} from dataset: {self.annFile}")
-                raise e
+            if self.image_cache is not None and path in self.image_cache:
+                all_images.append((img_id, self.image_cache.get(path)))
+            elif is_video_frame_path(path):
+                # Filled in below, grouped per video
+                video_slots.append((len(all_images), os.path.join(self.root, path)))
+                all_images.append((img_id, None))
+            else:
+                all_images.append(
+                    (img_id, self._read_image(os.path.join(self.root, path)))
+                )
+
+        if video_slots:
+            frames = self._read_video_frames([path for _, path in video_slots])
+            for (slot, _), frame in zip(video_slots, frames):
+                all_images[slot] = (all_images[slot][0], frame)
 
         return all_images, all_img_metadata
 
@@ -240,20 +1844,50 @@ class CustomCocoDetectionAPI(VisionDataset):
         self.curr_epoch = epoch
 
     def set_epoch(self, epoch: int):
-        pass
+        if self.is_sharded_annotation_dir:
+            self.set_sharded_annotation_file(epoch)
+
+    def annotation_shards(self) -> List[str]:
+        if self._annotation_shards is None:
+            assert g_pathmgr.isdir(
+                self.annFile
+            ), f"please provide valid annotation shard directory. Missing: {self.annFile}"
+            self._annotation_shards = sorted(
+                os.path.join(self.annFile, name)
+                for name in g_pathmgr.ls(self.annFile)
+                if name.endswith(self.shard_suffix)
+            )
+            assert (
+                self._annotation_shards
+            ), f"No *{self.shard_suffix} annotation shards in {self.annFile}"
+        return self._annotation_shards
 
     def set_sharded_annotation_file(self, data_epoch: int):
-        if self.coco is not None:
+        if self.is_sharded_annotation_dir:
+            shards = self.annotation_shards()
+            shard = data_epoch
+            if self.shard_by_rank:
+                num_replicas, rank = _world_size_and_rank()
+                shard = data_epoch * num_replicas + rank
+            path = shards[shard % len(shards)]
+        else:
+            path = self.annFile
+        if self.coco is not None and path == self.annotation_path:
             return
 
         assert g_pathmgr.isfile(
-            self.annFile
-        ), f"please provide valid annotation file. Missing: {self.annFile}"
-        annFile = g_pathmgr.get_local_path(self.annFile)
+            path
+        ), f"please provide valid annotation file. Missing: {path}"
+        annFile = g_pathmgr.get_local_path(path)
 
         if self.coco is not None:
-            del self.coco
+            # Free the previous shard before loading the next one, so peak
+            # memory stays at a single shard
+            self.coco = None
+            self.ids = None
+            gc.collect()
 
+        self.annotation_path = path
         self.coco = self.coco_json_loader(annFile)
         # Use a torch tensor here to optimize memory usage when using several dataloaders
         ids_list = list(sorted(self.coco.getDatapointIds()))
@@ -262,6 +1896,97 @@ class CustomCocoDetectionAPI(VisionDataset):
             local_random.shuffle(ids_list)
             ids_list = ids_list[: self.limit_ids]
         self.ids = torch.as_tensor(ids_list, dtype=torch.long)
+        self._on_annotations_loaded()
+
+    def _on_annotations_loaded(self):
+        """Hook to recompute state derived from self.coco and self.ids, run after every load."""
+        if self.filter_query is not None:
+            self._apply_query_filter()
+
+    def _cache_signature(self, ids: np.ndarray, *key) -> str:
+        """Key of results derived from the loaded annotation file: the file, the
+        loader, the query filter, the candidate ids and `key`."""
+        annFile = g_pathmgr.get_local_path(self.annotation_path)
+        stat = os.stat(annFile)
+        key = json.dumps(
+            [
+                annFile,
+                stat.st_size,
+                stat.st_mtime_ns,
+                type(self.coco).__qualname__,
+                (
+                    None
+                    if self.filter_query is None
+                    else query_filter_signature(self.filter_query)
+                ),
+                *key,
+            ]
+        ).encode("utf-8")
+        return hashlib.sha256(key + ids.tobytes()).hexdigest()[:16]
+
+    def _evaluate_query_filter(self, ids: np.ndarray) -> Dict[str, np.ndarray]:
+        kept_ids, offsets, positions, outputs, categories = [], [0], [], [], []
+        dropped = np.zeros(2, dtype=np.int64)
+        for datapoint_id in ids.tolist():
+            queries, _ = self.coco.loadQueriesAndAnnotationsFromDatapoint(datapoint_id)
+            kept = [i for i, query in enumerate(queries) if self.filter_query(query)]
+            stages = Counter(queries[i]["query_processing_order"] for i in kept)
+            if not kept:
+                dropped[0] += 1
+                continue
+            if len(set(stages.values())) > 1:
+                # load_queries requires the same number of queries in every stage
+                dropped[1] += 1
+                continue
+            kept_ids.append(datapoint_id)
+            positions.extend(kept)
+            offsets.append(len(positions))
+            for i in kept:
+                outputs.append(len(queries[i]["object_ids_output"] or []))
+                category = _query_category(queries[i])
+                categories.append(_MISSING if category is None else category)
+        return {
+            "datapoint_id": np.asarray(kept_ids, dtype=np.int64),
+            "offsets": np.asarray(offsets, dtype=np.int64),
+            "positions": np.asarray(positions, dtype=np.int32),
+            "outputs": np.asarray(outputs, dtype=np.int64),
+            "category": np.asarray(categories, dtype=np.int64),
+            "dropped": dropped,
+        }
+
+    def _apply_query_filter(self):
+        """Evaluate filter_query over every query of the loaded datapoints once,
+        drop the datapoints left without queries and wrap self.coco so the
+        others only load their surviving queries. Cached next to the (local
+        copy of the) annotation file, keyed by _cache_signature."""
+        ids = self.ids.numpy()
+        signature = self._cache_signature(ids)
+        cache_path = f"{g_pathmgr.get_local_path(self.annotation_path)}.queryfilter-{signature}.npz"
+        if os.path.isfile(cache_path):
+            with np.load(cache_path) as cached:
+                columns = dict(cached)
+        else:
+            columns = self._evaluate_query_filter(ids)
+            try:
+                tmp_path = cache_path + ".tmp"
+                with open(tmp_path, "wb") as fopen:
+                    np.savez(fopen, **columns)
+                os.replace(tmp_path, cache_path)
+            except OSError as e:
+                print(f"Could not cache query filter results at {cache_path}: {e}")
+
+        dropped = columns.pop("dropped")
+        self.query_filter_report = {
+            "no_queries_left": int(dropped[0]),
+            "unbalanced_stages": int(dropped[1]),
+        }
+        print(
+            f"Query filter on {self.annotation_path}: kept {len(columns['positions'])} "
+            f"queries in {len(columns['datapoint_id'])} of {len(ids)} datapoints, "
+            f"dropped {self.query_filter_report}"
+        )
+        self.coco = FilteredAnnotationIndex(self.coco, columns)
+        self.ids = torch.as_tensor(columns["datapoint_id"], dtype=torch.long)
 
     def __getitem__(self, index: int) -> Datapoint:
         return self._load_datapoint(index)
@@ -273,6 +1998,58 @@ class CustomCocoDetectionAPI(VisionDataset):
         queries, annotations = self.coco.loadQueriesAndAnnotationsFromDatapoint(id)
         return self.load_queries(pil_images, annotations, queries, img_metadata)
 
+    def _annotation_boxes(
+        self, annotations: List[Dict[str, Any]], id2imsize: Dict[int, Tuple[int, int]]
+    ) -> torch.Tensor:
+        """(N, 4) denormalized XYXY boxes of all annotations, converted in one go.
+
+        The objects get row views of this tensor.
+        """
+        if not annotations:
+            return torch.zeros(0, 4)
+        bboxes = box_xywh_to_xyxy(
+            _stack_rows([annotation["bbox"] for annotation in annotations], 4)
+        )
+        sizes = torch.tensor(
+            [id2imsize[annotation["image_id"]] for annotation in annotations]
+        )
+        return _denormalize_(bboxes, sizes, slice(0, None, 2), slice(1, None, 2))
+
+    def _query_geometry(
+        self, queries: List[Dict[str, Any]], id2imsize: Dict[int, Tuple[int, int]]
+    ) -> Tuple[List[Optional[torch.Tensor]], List[Optional[torch.Tensor]]]:
+        """Denormalized XYXY input boxes and input points of every query.
+
+        The boxes (and points) of all queries are concatenated, converted and
+        clamped with single tensor ops, then split back per query.
+        """
+        boxes = [None] * len(queries)
+        points = [None] * len(queries)
+        for key, width, out in (("input_box", 4, boxes), ("input_points", 3, points)):
+            selected = [
+                i
+                for i, query in enumerate(queries)
+                if key in query
+                and query[key] is not None
+                and (key != "input_box" or len(query[key]) > 0)
+            ]
+            if not selected:
+                continue
+            per_query = [_stack_rows([queries[i][key]], width) for i in selected]
+            rows = torch.cat(per_query)
+            sizes = torch.tensor(
+                [id2imsize[queries[i]["image_id"]] for i in selected]
+            ).repeat_interleave(torch.tensor([len(q) for q in per_query]), dim=0)
+            if key == "input_box":
+                rows = _denormalize_(
+                    box_xywh_to_xyxy(rows), sizes, slice(0, None, 2), slice(1, None, 2)
+                )
+            else:
+                rows = _denormalize_(rows, sizes, slice(0, 1), slice(1, 2))
+            for i, part in zip(selected, rows.split([len(q) for q in per_query])):
+                out[i] = part if key == "input_box" else part.view(1, -1, 3)
+        return boxes, points
+
     def load_queries(self, pil_images, annotations, queries, img_metadata):
         """Transform the raw image and queries into a Datapoint sample."""
         images: List[Image] = []
@@ -282,7 +2059,10 @@ class CustomCocoDetectionAPI(VisionDataset):
         id2imsize = {}
         assert len(pil_images) == len(img_metadata)
         for i in range(len(pil_images)):
-            w, h = pil_images[i][1].size
+            if isinstance(pil_images[i][1], np.ndarray):
+                h, w = pil_images[i][1].shape[:2]
+            else:
+                w, h = pil_images[i][1].size
             blurring_mask = None
             if "blurring_mask" in img_metadata[i]:
                 blurring_mask = img_metadata[i]["blurring_mask"]
@@ -297,19 +2077,18 @@ class CustomCocoDetectionAPI(VisionDataset):
             id2index_img[pil_images[i][0]] = i
             id2imsize[pil_images[i][0]] = (h, w)
 
-        for annotation in annotations:
+        bboxes = self._annotation_boxes(annotations, id2imsize)
+        for annotation, bbox in zip(annotations, bboxes):
             image_id = id2index_img[annotation["image_id"]]
-            bbox = box_xywh_to_xyxy(torch.as_tensor(annotation["bbox"])).view(1, 4)
-            h, w = id2imsize[annotation["image_id"]]
-            bbox[:, 0::2].mul_(w).clamp_(min=0, max=w)
-            bbox[:, 1::2].mul_(h).clamp_(min=0, max=h)
             segment = None
             if self.load_segmentation and "segmentation" in annotation:
                 # We're not decoding the RLE here, a transform will do it lazily later
                 segment = annotation["segmentation"]
+                if isinstance(segment, dict):
+                    segment = LazyRLEMask(segment)
             images[image_id].objects.append(
                 Object(
-                    bbox=bbox[0],
+                    bbox=bbox,
                     area=annotation["area"],
                     object_id=(
                         annotation["object_id"] if "object_id" in annotation else -1
@@ -342,16 +2121,11 @@ class CustomCocoDetectionAPI(VisionDataset):
                 num_queries == num_queries_per_stage
             ), f"Number of queries in stage {stage} is {num_queries}, expected {num_queries_per_stage}"
 
+        query_boxes, query_points = self._query_geometry(queries, id2imsize)
         for query_id, query in enumerate(queries):
             h, w = id2imsize[query["image_id"]]
-            if (
-                "input_box" in query
-                and query["input_box"] is not None
-                and len(query["input_box"]) > 0
-            ):
-                bbox = box_xywh_to_xyxy(torch.as_tensor(query["input_box"])).view(-1, 4)
-                bbox[:, 0::2].mul_(w).clamp_(min=0, max=w)
-                bbox[:, 1::2].mul_(h).clamp_(min=0, max=h)
+            bbox = query_boxes[query_id]
+            if bbox is not None:
                 if "input_box_label" in query and query["input_box_label"] is not None:
                     bbox_label = torch.as_tensor(
                         query["input_box_label"], dtype=torch.long
@@ -361,19 +2135,13 @@ class CustomCocoDetectionAPI(VisionDataset):
                     # assume the boxes are positives
                     bbox_label = torch.ones(len(bbox), dtype=torch.long)
             else:
-                bbox = None
                 bbox_label = None
 
-            if "input_points" in query and query["input_points"] is not None:
-                points = torch.as_tensor(query["input_points"]).view(1, -1, 3)
-                points[:, :, 0:1].mul_(w).clamp_(min=0, max=w)
-                points[:, :, 1:2].mul_(h).clamp_(min=0, max=h)
-            else:
-                points = None
+            points = query_points[query_id]
 
             try:
                 original_image_id = int(
-                    img_metadata[id2index_img[query["image_id"]]["original_img_id"]
+                    img_metadata[id2index_img[query["image_id"]]]["original_img_id"]
                 )
             except ValueError:
                 original_image_id = -1
@@ -437,7 +2205,6 @@ class CustomCocoDetectionAPI(VisionDataset):
                     ),
                 )
             )
-            )
 
         return Datapoint(
             find_queries=find_queries,
@@ -469,7 +2236,35 @@ class Sam3ImageDataset(CustomCocoDetectionAPI):
         filter_query=None,
         coco_json_loader: Callable = COCO_FROM_JSON,
         limit_ids: int = None,
+        image_cache_dir: Optional[str] = None,
+        video_frames_as_numpy: bool = False,
+        max_open_videos: int = 8,
+        prefetch_threads: int = 8,
+        prefetch_max_bytes: int = 256 << 20,
+        prefilter_ids: bool = True,
+        repeat_factor_threshold: Optional[float] = None,
+        decoded_mask_cache_bytes: Optional[int] = None,
+        # Last, so positional callers of the upstream signature are unaffected
+        shard_by_rank: bool = False,
+        shard_suffix: str = ".json",
     ):
+        # Set before the base __init__, which loads the first annotation file
+        # and so calls _on_annotations_loaded
+        # Decoded masks of this dataset, bounded per worker process
+        self.decoded_mask_cache = DecodedMaskCache(
+            DEFAULT_DECODED_MASK_CACHE_BYTES
+            if decoded_mask_cache_bytes is None
+            else decoded_mask_cache_bytes
+        )
+        self._transforms = _with_lazy_rle_decoding(transforms, self.decoded_mask_cache)
+        self.training = training
+        self.max_ann_per_img = max_ann_per_img
+        self.max_train_queries = max_train_queries
+        self.max_val_queries = max_val_queries
+        self.multiplier = multiplier
+        self.prefilter = prefilter_ids
+        self.repeat_factor_threshold = repeat_factor_threshold
+
         super(Sam3ImageDataset, self).__init__(
             img_folder,
             ann_file,
@@ -482,20 +2277,91 @@ class Sam3ImageDataset(CustomCocoDetectionAPI):
             filter_query=filter_query,
             coco_json_loader=coco_json_loader,
             limit_ids=limit_ids,
+            image_cache_dir=image_cache_dir,
+            video_frames_as_numpy=video_frames_as_numpy,
+            max_open_videos=max_open_videos,
+            prefetch_threads=prefetch_threads,
+            prefetch_max_bytes=prefetch_max_bytes,
+            is_sharded_annotation_dir=is_sharded_annotation_dir,
+            shard_by_rank=shard_by_rank,
+            shard_suffix=shard_suffix,
         )
 
-        self._transforms = transforms
-        self.training = training
-        self.max_ann_per_img = max_ann_per_img
-        self.max_train_queries = max_train_queries
-        self.max_val_queries = max_val_queries
+        self._MAX_RETRIES = 100
+
+    def _on_annotations_loaded(self):
+        super(Sam3ImageDataset, self)._on_annotations_loaded()
+        if self.prefilter:
+            self._prefilter_ids()
 
-        self.repeat_factors = torch.ones(len(self.ids), dtype=torch.float32)
+        if self.repeat_factor_threshold is not None:
+            self.repeat_factors = lvis_repeat_factors(
+                self.coco, self.ids.tolist(), self.repeat_factor_threshold
+            )
+        else:
+            self.repeat_factors = torch.ones(len(self.ids), dtype=torch.float32)
 
-        self.repeat_factors *= multiplier
+        self.repeat_factors *= self.multiplier
         print(f"Raw dataset length = {len(self.ids)}")
 
-        self._MAX_RETRIES = 100
+    # Reasons a datapoint can be rejected, in the order __orig_getitem__ checks them
+    PREFILTER_REASONS = ("too_many_outputs", "too_many_queries", "no_queries")
+
+    def _query_stats(self, ids: List[int]) -> Tuple[np.ndarray, np.ndarray]:
+        if hasattr(self.coco, "getQueryStats"):
+            return self.coco.getQueryStats(ids)
+        num_queries = np.zeros(len(ids), dtype=np.int64)
+        max_outputs = np.zeros(len(ids), dtype=np.int64)
+        for i, datapoint_id in enumerate(ids):
+            queries, _ = self.coco.loadQueriesAndAnnotationsFromDatapoint(datapoint_id)
+            num_queries[i] = len(queries)
+            max_outputs[i] = max(
+                (len(q["object_ids_output"]) for q in queries), default=0
+            )
+        return num_queries, max_outputs
+
+    def _prefilter_ids(self):
+        """Restrict self.ids to the datapoints __orig_getitem__ would accept.
+
+        The limits are checked from annotation metadata only, without decoding
+        any image. The result is cached next to the (local copy of the)
+        annotation file, keyed by _cache_signature and the limits.
+        """
+        max_queries = self.max_train_queries if self.training else self.max_val_queries
+        ids = self.ids.numpy()
+        signature = self._cache_signature(ids, self.max_ann_per_img, max_queries)
+        cache_path = f"{g_pathmgr.get_local_path(self.annotation_path)}.prefilter-{signature}.npz"
+        if os.path.isfile(cache_path):
+            with np.load(cache_path) as cached:
+                valid, dropped = cached["valid"], cached["dropped"]
+        else:
+            num_queries, max_outputs = self._query_stats(ids.tolist())
+            rejected = np.zeros(len(ids), dtype=bool)
+            dropped = np.zeros(len(self.PREFILTER_REASONS), dtype=np.int64)
+            for i, mask in enumerate(
+                (
+                    max_outputs > self.max_ann_per_img,
+                    num_queries > max_queries,
+                    num_queries == 0,
+                )
+            ):
+                dropped[i] = (mask & ~rejected).sum()
+                rejected |= mask
+            valid = ids[~rejected]
+            try:
+                tmp_path = cache_path + ".tmp"
+                with open(tmp_path, "wb") as fopen:
+                    np.savez(fopen, valid=valid, dropped=dropped)
+                os.replace(tmp_path, cache_path)
+            except OSError as e:
+                print(f"Could not cache prefiltered ids at {cache_path}: {e}")
+
+        self.prefilter_report = dict(zip(self.PREFILTER_REASONS, dropped.tolist()))
+        print(
+            f"Prefiltered {self.annotation_path}: kept {len(valid)} of {len(ids)} datapoints, "
+            f"dropped {self.prefilter_report}"
+        )
+        self.ids = torch.as_tensor(valid, dtype=torch.long)
 
     def __getitem__(self, idx):
         return self.__orig_getitem__(idx)
@@ -533,11 +2399,178 @@ class Sam3ImageDataset(CustomCocoDetectionAPI):
             except (DecompressionBombError, OSError, ValueError) as error:
                 sys.stderr.write(f"ERROR: got loading error on datapoint {idx}\n")
                 sys.stderr.write(f"Exception: {error}\n")
-                sys.stderr.write(traceback.format_exc())
+                if not isinstance(error, DecompressionBombError):
+                    # The size limits are expected to trip now and then (e.g. with
+                    # prefilter_ids=False); anything else deserves a traceback
+                    sys.stderr.write(traceback.format_exc())
                 idx = (idx + 1) % len(self)
         else:
             raise RuntimeError(
                 f"Failed {self._MAX_RETRIES} times trying to load an image."
             )
 
-        return datapoint
\ No newline at end of file
+        return datapoint
+
+
+def _query_category(query: Dict[str, Any]) -> Optional[int]:
+    """Category of a query for repeat factors: original_cat_id, else category_id."""
+    category = query.get("original_cat_id")
+    return query.get("category_id") if category is None else category
+
+
+def lvis_repeat_factors(coco, ids: List[int], threshold: float) -> torch.Tensor:
+    """LVIS-style repeat factor of every datapoint (Gupta et al., 2019).
+
+    A category present in a fraction f(c) of the datapoints gets
+    r(c) = max(1, sqrt(threshold / f(c))); a datapoint is repeated by the
+    largest r(c) among the categories its queries have outputs for.
+    """
+    if hasattr(coco, "getPositiveCategories"):
+        positions, categories = coco.getPositiveCategories(ids)
+    else:
+        positions, categories = [], []
+        for i, datapoint_id in enumerate(ids):
+            queries, _ = coco.loadQueriesAndAnnotationsFromDatapoint(datapoint_id)
+            for query in queries:
+                category = _query_category(query)
+                if query["object_ids_output"] and category is not None:
+                    positions.append(i)
+                    categories.append(category)
+        positions = np.asarray(positions, dtype=np.int64)
+        categories = np.asarray(categories, dtype=np.int64)
+    # Queries without any category id don't count towards a category
+    known = categories != _MISSING
+    positions, categories = positions[known], categories[known]
+
+    # Count each category once per datapoint
+    pairs = np.unique(np.stack([positions, categories], axis=1), axis=0)
+    _, inverse, counts = np.unique(pairs[:, 1], return_inverse=True, return_counts=True)
+    category_factors = np.maximum(1.0, np.sqrt(threshold * len(ids) / counts))
+    factors = np.ones(len(ids), dtype=np.float64)
+    np.maximum.at(factors, pairs[:, 0], category_factors[inverse.reshape(-1)])
+    return torch.as_tensor(factors, dtype=torch.float32)
+
+
+_FEISTEL_ROUNDS = 4
+_MASK64 = (1 << 64) - 1
+
+
+def _feistel_permute(values: np.ndarray, half_bits: int, keys: List[int]) -> np.ndarray:
+    """Bijection on [0, 2 ** (2 * half_bits)) as a balanced Feistel network."""
+    mask = np.uint64((1 << half_bits) - 1)
+    shift = np.uint64(half_bits)
+    left = (values >> shift) & mask
+    right = values & mask
+    for key in keys:
+        mixed = (right * np.uint64(0x9E3779B97F4A7C15)) ^ np.uint64(key)
+        mixed ^= mixed >> np.uint64(29)
+        left, right = right, (left ^ mixed) & mask
+    return (left << shift) | right
+
+
+def _world_size_and_rank() -> Tuple[int, int]:
+    if torch.distributed.is_available() and torch.distributed.is_initialized():
+        return torch.distributed.get_world_size(), torch.distributed.get_rank()
+    return 1, 0
+
+
+class RepeatFactorSampler(torch.utils.data.Sampler):
+    """Samples dataset indices according to per-datapoint repeat factors.
+
+    Each epoch, a datapoint with factor r is drawn floor(r) times plus once
+    more with probability frac(r) (stochastic rounding), so rare categories
+    are oversampled without duplicating anything on disk. Everything is a
+    function of (seed, epoch): call set_epoch() at the start of every epoch.
+
+    The epoch is never materialized as an index list. Position p of the
+    (optionally shuffled) epoch goes through a keyed Feistel permutation of
+    the virtual sample space, and the dataset index is found by binary
+    search in the cumulative repeat counts. Ranks take every
+    num_replicas-th position, padding by wrap-around like DistributedSampler.
+
+    Given a dataset, its repeat_factors are re-read whenever the dataset
+    replaces them, e.g. when a sharded dataset moves to the next annotation
+    shard (the trainer calls sampler.set_epoch before dataset.set_epoch).
+    """
+
+    def __init__(
+        self,
+        dataset_or_factors,
+        shuffle: bool = True,
+        seed: int = 0,
+        num_replicas: Optional[int] = None,
+        rank: Optional[int] = None,
+        chunk_size: int = 1 << 16,
+    ):
+        if hasattr(dataset_or_factors, "repeat_factors"):
+            self.dataset = dataset_or_factors
+        else:
+            self.dataset = None
+            self.repeat_factors = torch.as_tensor(
+                dataset_or_factors, dtype=torch.float64
+            ).numpy()
+        self._factors_source = None
+        if num_replicas is None or rank is None:
+            world_size, world_rank = _world_size_and_rank()
+            num_replicas = world_size if num_replicas is None else num_replicas
+            rank = world_rank if rank is None else rank
+        self.shuffle = shuffle
+        self.seed = seed
+        self.num_replicas = num_replicas
+        self.rank = rank
+        self.chunk_size = chunk_size
+        self.set_epoch(0)
+
+    def set_epoch(self, epoch: int):
+        self.epoch = epoch
+        if self.dataset is not None:
+            self._factors_source = self.dataset.repeat_factors
+            self.repeat_factors = torch.as_tensor(
+                self._factors_source, dtype=torch.float64
+            ).numpy()
+        rng = np.random.default_rng([self.seed, epoch])
+        whole = np.floor(self.repeat_factors)
+        counts = whole + (rng.random(len(whole)) < self.repeat_factors - whole)
+        self._cumsum = np.cumsum(counts.astype(np.int64))
+        self.total_size = int(self._cumsum[-1]) if len(self._cumsum) else 0
+        self.num_samples = -(-self.total_size // self.num_replicas)
+        bits = max(2, (max(self.total_size, 1) - 1).bit_length())
+        self._half_bits = (bits + 1) // 2
+        self._keys = rng.integers(0, 1 << 63, size=_FEISTEL_ROUNDS).tolist()
+
+    def set_curr_epoch(self, epoch: int):
+        self.set_epoch(epoch)
+
+    def _virtual_indices(self, positions: np.ndarray) -> np.ndarray:
+        if not self.shuffle:
+            return positions
+        values = positions.astype(np.uint64)
+        out_of_range = np.ones(len(values), dtype=bool)
+        while out_of_range.any():
+            # Cycle walking: re-apply the permutation until it lands in range
+            values[out_of_range] = _feistel_permute(
+                values[out_of_range], self._half_bits, self._keys
+            )
+            out_of_range = values >= self.total_size
+        return values.astype(np.int64)
+
+    def _refresh(self):
+        if (
+            self.dataset is not None
+            and self.dataset.repeat_factors is not self._factors_source
+        ):
+            self.set_epoch(self.epoch)
+
+    def __iter__(self):
+        self._refresh()
+        if self.total_size == 0:
+            return
+        for start in range(0, self.num_samples, self.chunk_size):
+            local = np.arange(start, min(start + self.chunk_size, self.num_samples))
+            positions = (local * self.num_replicas + self.rank) % self.total_size
+            virtual = self._virtual_indices(positions)
+            yield from np.searchsorted(self._cumsum, virtual, side="right").tolist()
+
+    def __len__(self) -> int:
+        self._refresh()
+        return self.num_samples
\ No newline at end of file
@@ -0,0 +1,196 @@
+"""
+Benchmark and validation harness for the CPU EDT replacement in edt_patch.py.
+
+Times edt_triton over a grid of batch sizes and image sizes for every mode,
+next to the original per-image cv2 loop (5x5 mask + torch.stack), and
+reports max / mean error against a reference EDT together with the time
+per megapixel, so a production mode (SAM3_EDT_MODE) can be picked on
+purpose. The reference is a brute-force nearest-background search for
+small images and the "precise" mode otherwise, so "precise" itself is only
+checked at the brute-force sizes.
+
+With --validate the exit status is non-zero if a mode that claims to be
+exact ("precise") is off by more than --tolerance.
+
+With --scaling the grid is followed by a thread scaling curve: every mode
+is timed with num_threads = 1, 2, 4, ... up to the available cores (or the
+--threads list) on a --scaling-batch sized batch.
+
+Usage:
+    python src/scripts/edt_benchmark.py --batch-sizes 1,8,32 --sizes 256x256,1024x1024
+    python src/scripts/edt_benchmark.py --scaling --scaling-batch 64 --sizes 512x512
+"""
+
+import argparse
+import os
+import sys
+import time
+
+import cv2
+import numpy as np
+import torch
+
+from edt_patch import EDT_MODES, NO_BACKGROUND_DISTANCE, edt_triton
+
+
+def legacy_edt(data: torch.Tensor):
+    # The implementation edt_patch.py shipped with, kept as the baseline
+    data_cpu = (data > 0).to(torch.uint8).cpu().numpy()
+    outputs = []
+    for i in range(data.shape[0]):
+        dist = cv2.distanceTransform(data_cpu[i], cv2.DIST_L2, 5)
+        outputs.append(torch.from_numpy(dist))
+    return torch.stack(outputs).to(data.device)
+
+
+# Modes expected to reproduce the Triton kernel exactly
+EXACT_MODES = ("precise",)
+
+
+def brute_force_edt(data: torch.Tensor):
+    """Distance from every pixel to the nearest background pixel, by exhaustive search."""
+    B, H, W = data.shape
+    ys, xs = torch.meshgrid(torch.arange(H), torch.arange(W), indexing="ij")
+    coords = torch.stack([ys.flatten(), xs.flatten()], dim=1).double()
+    result = torch.empty((B, H, W), dtype=torch.float32)
+    for i in range(B):
+        background = coords[~data[i].flatten().bool()]
+        if len(background) == 0:
+            result[i] = NO_BACKGROUND_DISTANCE
+            continue
+        result[i] = torch.cdist(coords, background).min(dim=1).values.view(H, W).float()
+    return result
+
+
+def make_masks(batch_size, height, width, seed=0):
+    """Blobby binary masks, roughly what SAM3 post-processing sees."""
+    rng = np.random.default_rng(seed)
+    masks = np.ones((batch_size, height, width), dtype=np.uint8)
+    for i in range(batch_size):
+        for _ in range(rng.integers(1, 6)):
+            center = (int(rng.integers(0, width)), int(rng.integers(0, height)))
+            axes = (int(rng.integers(1, max(2, width // 3))), int(rng.integers(1, max(2, height // 3))))
+            cv2.ellipse(masks[i], center, axes, float(rng.uniform(0, 180)), 0, 360, 0, -1)
+    return torch.from_numpy(masks.astype(bool))
+
+
+def time_call(fn, repeats):
+    fn()  # warmup
+    best = float("inf")
+    for _ in range(repeats):
+        start = time.perf_counter()
+        fn()
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+def parse_sizes(text):
+    sizes = []
+    for item in text.split(","):
+        height, width = item.lower().split("x")
+        sizes.append((int(height), int(width)))
+    return sizes
+
+
+def available_cores():
+    try:
+        return len(os.sched_getaffinity(0))
+    except AttributeError:
+        return os.cpu_count() or 1
+
+
+def default_thread_counts():
+    cores = available_cores()
+    counts = []
+    n = 1
+    while n < cores:
+        counts.append(n)
+        n *= 2
+    return counts + [cores]
+
+
+def scaling_curve(modes, sizes, batch_size, thread_counts, repeats):
+    print(f"\nThread scaling, B={batch_size}")
+    print(f"{'H':>5} {'W':>5} {'mode':>9} {'threads':>8} {'ms/batch':>10} {'ms/MP':>8} {'speedup':>8}")
+    for height, width in sizes:
+        data = make_masks(batch_size, height, width)
+        megapixels = batch_size * height * width / 1e6
+        for mode in modes:
+            baseline = None
+            for threads in thread_counts:
+                seconds = time_call(lambda: edt_triton(data, mode=mode, num_threads=threads), repeats)
+                baseline = baseline or seconds
+                print(
+                    f"{height:>5} {width:>5} {mode:>9} {threads:>8} {seconds * 1000:>10.2f} "
+                    f"{seconds * 1000 / megapixels:>8.2f} {baseline / seconds:>7.2f}x"
+                )
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--batch-sizes", default="1,8,32")
+    parser.add_argument("--sizes", default="128x128,256x256,512x512,1024x1024")
+    parser.add_argument("--modes", default=",".join(EDT_MODES))
+    parser.add_argument("--repeats", type=int, default=3)
+    parser.add_argument(
+        "--brute-force-max-pixels",
+        type=int,
+        default=128 * 128,
+        help="Use the brute-force reference for images up to this many pixels.",
+    )
+    parser.add_argument(
+        "--threads",
+        default=None,
+        help="num_threads for the grid (default: edt_patch default) and, comma separated, the scaling curve.",
+    )
+    parser.add_argument("--scaling", action="store_true", help="Also print a 1..N thread scaling curve.")
+    parser.add_argument("--scaling-batch", type=int, default=32)
+    parser.add_argument("--validate", action="store_true")
+    parser.add_argument("--tolerance", type=float, default=1e-3)
+    args = parser.parse_args()
+
+    batch_sizes = [int(b) for b in args.batch_sizes.split(",")]
+    modes = args.modes.split(",")
+    thread_counts = [int(t) for t in args.threads.split(",")] if args.threads else default_thread_counts()
+    grid_threads = thread_counts[-1] if args.threads else None
+    failures = []
+    print(
+        f"{'B':>4} {'H':>5} {'W':>5} {'impl':>9} {'ms/batch':>10} {'img/s':>9} "
+        f"{'ms/MP':>8} {'max err':>9} {'mean err':>9}  reference"
+    )
+    for height, width in parse_sizes(args.sizes):
+        for batch_size in batch_sizes:
+            data = make_masks(batch_size, height, width)
+            if height * width <= args.brute_force_max_pixels:
+                reference, reference_name = brute_force_edt(data), "brute-force"
+            else:
+                reference, reference_name = edt_triton(data, mode="precise"), "precise"
+
+            impls = [("legacy", lambda: legacy_edt(data))]
+            impls += [
+                (mode, lambda mode=mode: edt_triton(data, mode=mode, num_threads=grid_threads))
+                for mode in modes
+            ]
+            for name, fn in impls:
+                seconds = time_call(fn, args.repeats)
+                error = (fn() - reference).abs()
+                max_error = error.max().item()
+                megapixels = batch_size * height * width / 1e6
+                print(
+                    f"{batch_size:>4} {height:>5} {width:>5} {name:>9} {seconds * 1000:>10.2f} "
+                    f"{batch_size / seconds:>9.1f} {seconds * 1000 / megapixels:>8.2f} "
+                    f"{max_error:>9.2e} {error.mean().item():>9.2e}  {reference_name}"
+                )
+                if name in EXACT_MODES and max_error > args.tolerance:
+                    failures.append(f"{name} at B={batch_size} {height}x{width}: max error {max_error:.3g}")
+
+    if args.scaling:
+        scaling_curve(modes, parse_sizes(args.sizes), args.scaling_batch, thread_counts, args.repeats)
+
+    if args.validate and failures:
+        print("\nValidation failed:\n  " + "\n  ".join(failures))
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
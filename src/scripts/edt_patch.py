@@ -5,44 +5,134 @@ CPU-compatible replacement for Triton kernel for euclidean distance transform (E
 Uses OpenCV instead of Triton/CUDA.
 """
 
+import functools
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
 import torch
 import cv2
 import numpy as np
 
-def edt_triton(data: torch.Tensor):
+# Modes accepted by edt_triton:
+#   "precise":  cv2.distanceTransform with DIST_MASK_PRECISE, an exact EDT
+#   "balanced": cv2 5x5 chamfer approximation, what this patch always did (default)
+#   "fast":     cv2 3x3 chamfer approximation, cheapest and least accurate
+# Only "precise" reproduces the Triton kernel's numbers, at roughly 2.5x the
+# cost of "balanced". Since SAM3 calls edt_triton without a mode, production
+# picks one through the SAM3_EDT_MODE environment variable; see
+# edt_benchmark.py for the trade-off.
+EDT_MODES = ("precise", "balanced", "fast")
+DEFAULT_EDT_MODE = os.environ.get("SAM3_EDT_MODE", "balanced")
+
+_OPENCV_MASKS = {
+    "precise": cv2.DIST_MASK_PRECISE,
+    "balanced": cv2.DIST_MASK_5,
+    "fast": cv2.DIST_MASK_3,
+}
+
+
+# Worker threads used to spread a batch over cores. cv2.distanceTransform
+# releases the GIL, so slices really run in parallel. One by default: EDT
+# runs next to torch's own intra-op threads (and inside DataLoader workers),
+# so callers opt in to more with SAM3_EDT_THREADS or num_threads.
+DEFAULT_EDT_THREADS = int(os.environ.get("SAM3_EDT_THREADS", 0)) or 1
+
+_pools = {}
+_pools_lock = threading.Lock()
+
+
+def _get_pool(num_threads):
+    # Keyed by pid as well: threads do not survive a fork into DataLoader workers
+    key = (os.getpid(), num_threads)
+    with _pools_lock:
+        pool = _pools.get(key)
+        if pool is None:
+            pool = ThreadPoolExecutor(max_workers=num_threads, thread_name_prefix="edt")
+            _pools[key] = pool
+        return pool
+
+
+# What the Triton kernel returns for an image without any background pixel:
+# sqrt of its 1e18 "infinity". OpenCV's value depends on the mask size.
+NO_BACKGROUND_DISTANCE = 1e9
+
+
+def _edt_opencv(data_np, out_np, mask_size):
+    for i in range(data_np.shape[0]):
+        # cv2.distanceTransform calculates distance to nearest zero pixel.
+        # We need to ensure that the "background" (what we want distance to) is 0.
+        # If input has 1 for object and 0 for background, this works correctly.
+        # The result is written straight into the preallocated output slice.
+        cv2.distanceTransform(data_np[i], cv2.DIST_L2, mask_size, dst=out_np[i])
+        # With any background pixel no distance comes near H + W
+        if out_np[i, 0, 0] > out_np.shape[1] + out_np.shape[2]:
+            out_np[i].fill(NO_BACKGROUND_DISTANCE)
+
+
+def _run_slices(fn, data_np, out_np, num_threads):
+    """Apply fn(data_slice, out_slice) over contiguous batch slices, in parallel when it pays off."""
+    B = data_np.shape[0]
+    num_slices = min(num_threads, B)
+    if num_slices <= 1:
+        fn(data_np, out_np)
+        return
+
+    bounds = np.linspace(0, B, num_slices + 1).astype(int)
+    pool = _get_pool(num_threads)
+    futures = [
+        # Each slice is a view; results land directly in the shared output buffer
+        pool.submit(fn, data_np[start:end], out_np[start:end])
+        for start, end in zip(bounds[:-1], bounds[1:])
+    ]
+    for future in futures:
+        future.result()
+
+
+def edt_triton(data: torch.Tensor, mode: str = None, num_threads: int = None):
     """
     Computes the Euclidean Distance Transform (EDT) of a batch of binary images.
     CPU fallback implementation using OpenCV.
-    
+
     Args:
         data: A tensor of shape (B, H, W) representing a batch of binary images.
               Expects data to be boolean or 0/1, where 0 is background (target) and 1 is foreground.
+        mode: One of EDT_MODES, defaults to DEFAULT_EDT_MODE. "precise"
+              computes the exact EDT, matching the Triton kernel; "balanced"
+              and "fast" trade accuracy for speed.
+        num_threads: Number of worker threads the batch is split across,
+              defaults to DEFAULT_EDT_THREADS (SAM3_EDT_THREADS, else 1).
+              1 runs everything on the calling thread.
 
     Returns:
-        A tensor of the same shape as data containing the EDT.
+        A tensor of the same shape as data containing the EDT. Images without
+        any background pixel are NO_BACKGROUND_DISTANCE everywhere.
     """
+    if mode is None:
+        mode = DEFAULT_EDT_MODE
+    if mode not in EDT_MODES:
+        raise ValueError(f"Unknown EDT mode {mode!r}, expected one of {EDT_MODES}")
+
     device = data.device
     B, H, W = data.shape
-    
-    # Move to CPU for cv2 processing
+
+    # Move to CPU for processing
     # Ensure data is uint8 (0 and 1)
     if data.dtype == torch.bool:
-        data_uint8 = data.to(torch.uint8)
+        data_uint8 = data.cpu().view(torch.uint8)
     else:
-        data_uint8 = (data > 0).to(torch.uint8)
-        
-    data_cpu = data_uint8.cpu().numpy()
-    
-    outputs = []
-    for i in range(B):
-        img = data_cpu[i]
-        # cv2.distanceTransform calculates distance to nearest zero pixel.
-        # We need to ensure that the "background" (what we want distance to) is 0.
-        # If input has 1 for object and 0 for background, this works correctly.
-        
-        # maskSize=5 is standard for L2
-        dist = cv2.distanceTransform(img, cv2.DIST_L2, 5)
-        outputs.append(torch.from_numpy(dist))
-        
-    result = torch.stack(outputs).to(device)
-    return result
+        data_uint8 = (data > 0).to(torch.uint8).cpu()
+    data_cpu = data_uint8.contiguous().numpy()
+
+    # One output buffer for the whole batch; no per-image tensors, no torch.stack
+    result = torch.empty((B, H, W), dtype=torch.float32)
+    if B == 0 or H == 0 or W == 0:
+        return result.to(device)
+
+    if num_threads is None:
+        num_threads = DEFAULT_EDT_THREADS
+
+    mask_size = _OPENCV_MASKS[mode]
+    fn = functools.partial(_edt_opencv, mask_size=mask_size)
+    _run_slices(fn, data_cpu, result.numpy(), max(1, num_threads))
+    return result.to(device)
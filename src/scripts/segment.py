@@ -1,10 +1,22 @@
 import sys
 import json
 import base64
+import contextlib
+import hashlib
 import io
+import mmap
 import os
+import struct
+import argparse
+import threading
+import time
+import queue
+from collections import OrderedDict, defaultdict, deque
 import numpy as np
 
+# Origin of the startup timings (load, warmup, time to first mask)
+PROCESS_START = time.perf_counter()
+
 # Ensure standard output uses UTF-8
 sys.stdout.reconfigure(encoding='utf-8')
 
@@ -18,120 +30,1842 @@ except ImportError as e:
     print(json.dumps({"error": f"Missing dependency: {str(e)}. Please run: pip install git+https://github.com/facebookresearch/sam3.git torch pillow"}))
     sys.exit(0)
 
-def main():
+try:
+    # Optional: C implementation of COCO RLE encoding
+    from pycocotools import mask as mask_utils
+except ImportError:
+    mask_utils = None
+
+try:
+    # Optional: memory-mapped weights cache for fast startup (--weights-cache)
+    from safetensors import safe_open
+    from safetensors.torch import save_file as save_safetensors
+except ImportError:
+    safe_open = save_safetensors = None
+
+
+# Prompt used when the request does not name anything to look for
+DEFAULT_PROMPT = "objects"
+
+
+def pick_device():
+    device = "cpu"
+    if torch.cuda.is_available():
+        device = "cuda"
+    elif torch.backends.mps.is_available():
+        device = "mps"
+    return device
+
+
+# dtypes the weights cache can store the model in. Anything below float32
+# only runs under autocast to that dtype, which is what --cpu-profile bf16
+# does for bfloat16 weights on the CPU; weights_dtype_error rejects the rest.
+# The int8 profile quantizes from float32 weights.
+WEIGHTS_DTYPES = {
+    "float32": torch.float32,
+    "bfloat16": torch.bfloat16,
+    "float16": torch.float16,
+}
+
+
+def _sam3_version():
     try:
-        # Read input from stdin
-        input_data = sys.stdin.read()
-        if not input_data:
-            return
+        from importlib import metadata
+        return metadata.version("sam3")
+    except Exception:
+        return "unknown"
+
+
+def weights_cache_path(cache_dir, interactive=False, checkpoint=None, dtype="float32"):
+    """One cached file per sam3 version, model head, source checkpoint and dtype."""
+    source = "hf:facebook/sam3"
+    if checkpoint:
+        stat = os.stat(checkpoint)
+        source = f"{os.path.abspath(checkpoint)}:{stat.st_size}:{stat.st_mtime_ns}"
+    key = json.dumps([_sam3_version(), bool(interactive), source, dtype])
+    digest = hashlib.sha256(key.encode("utf-8")).hexdigest()[:16]
+    head = "interactive" if interactive else "image"
+    return os.path.join(cache_dir, f"sam3-{head}-{dtype}-{digest}.safetensors")
+
+
+@contextlib.contextmanager
+def _skip_weight_init():
+    # Random initialization of every parameter is wasted work when all of them
+    # are overwritten from the weights cache right after. A strict load below
+    # guarantees nothing is left uninitialized.
+    names = [name for name in dir(torch.nn.init) if name.endswith("_") and not name.startswith("_")]
+    saved = {name: getattr(torch.nn.init, name) for name in names}
+    try:
+        for name in names:
+            setattr(torch.nn.init, name, lambda tensor, *args, **kwargs: tensor)
+        yield
+    finally:
+        for name, fn in saved.items():
+            setattr(torch.nn.init, name, fn)
+
+
+def save_weights_cache(model, path):
+    """Write the model's state dict as safetensors, storing tied tensors once."""
+    tensors = {}
+    aliases = {}
+    seen = {}
+    storages = set()
+    for name, value in model.state_dict().items():
+        value = value.detach().cpu()
+        key = (value.untyped_storage().data_ptr(), value.storage_offset(), tuple(value.shape), value.stride())
+        if key in seen:
+            aliases[name] = seen[key]
+            continue
+        seen[key] = name
+        if key[0] in storages:
+            # Overlapping views of one storage cannot be saved as they are
+            value = value.clone()
+        storages.add(key[0])
+        tensors[name] = value.contiguous()
+
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    save_safetensors(tensors, tmp_path, metadata={"aliases": json.dumps(aliases)})
+    os.replace(tmp_path, path)
+
+
+def load_weights_cache(model, path):
+    # assign=True makes the (memory-mapped) loaded tensors the parameters
+    # themselves instead of copying them into the initialized ones
+    with safe_open(path, framework="pt") as f:
+        aliases = json.loads((f.metadata() or {}).get("aliases", "{}"))
+        state = {name: f.get_tensor(name) for name in f.keys()}
+    for name, target in aliases.items():
+        state[name] = state[target]
+    model.load_state_dict(state, strict=True, assign=True)
+
+
+class _NoCudaMode(torch.overrides.TorchFunctionMode):
+    # sam3 assumes CUDA in a few places: caches precomputed with a hardcoded
+    # device="cuda" (position encodings, decoder coordinates) and pin_memory()
+    # calls on the prompt path. On hosts without CUDA, inside this mode such
+    # tensors are created on the CPU and pinning is skipped.
+    def __torch_function__(self, func, types, args=(), kwargs=None):
+        kwargs = kwargs or {}
+        if func is torch.Tensor.pin_memory:
+            return args[0]
+        device = kwargs.get("device")
+        if device is not None and torch.device(device).type == "cuda":
+            kwargs = {**kwargs, "device": "cpu"}
+        return func(*args, **kwargs)
+
 
+def no_cuda_context():
+    """_NoCudaMode on hosts without CUDA, nothing otherwise."""
+    return contextlib.nullcontext() if torch.cuda.is_available() else _NoCudaMode()
+
+
+def _build_model(**build_kwargs):
+    with no_cuda_context():
+        return build_sam3_image_model(**build_kwargs)
+
+
+def load_model(device, interactive=False, checkpoint=None, weights_cache=None, weights_dtype="float32"):
+    """
+    Build SAM3 and move it to `device`.
+
+    With `weights_cache` (a directory) the first run saves the loaded weights
+    there as safetensors in `weights_dtype`. Later runs build the module graph
+    without initializing it and map the cached weights straight into the
+    parameters: no checkpoint download check, no unpickling, no conversion.
+    """
+    # Build on the CPU: the model is moved to `device` once its weights are in
+    build_kwargs = {"device": "cpu"}
+    if interactive:
+        # Point prompts need the SAM-style interactive head
+        build_kwargs["enable_inst_interactivity"] = True
+
+    cache_path = None
+    if weights_cache:
+        if save_safetensors is None:
+            print("--weights-cache needs the safetensors package; loading without it", file=sys.stderr)
+        else:
+            cache_path = weights_cache_path(weights_cache, interactive, checkpoint, weights_dtype)
+
+    model = None
+    if cache_path and os.path.exists(cache_path):
         try:
-            request = json.loads(input_data)
-        except json.JSONDecodeError:
-            print(json.dumps({"error": "Invalid JSON input"}))
+            with _skip_weight_init():
+                model = _build_model(load_from_HF=False, **build_kwargs)
+            load_weights_cache(model, cache_path)
+        except Exception:
+            import traceback
+            traceback.print_exc(file=sys.stderr)
+            print(f"Ignoring weights cache {cache_path}", file=sys.stderr)
+            model = None
+
+    if model is None:
+        # This will download the checkpoint on first run if not present
+        model = _build_model(
+            load_from_HF=checkpoint is None,
+            checkpoint_path=checkpoint,
+            **build_kwargs,
+        )
+        model.to(WEIGHTS_DTYPES[weights_dtype])
+        if cache_path:
+            try:
+                save_weights_cache(model, cache_path)
+            except Exception:
+                import traceback
+                traceback.print_exc(file=sys.stderr)
+
+    model.to(device)
+    model.eval()
+    return model
+
+
+# CPU performance profiles (--cpu-profile), applied once the weights are loaded:
+#   "fp32": the model as trained (default)
+#   "bf16": inference under bf16 autocast, where the CPU has native bf16 support
+#   "int8": dynamic int8 quantization of the image encoder's linear layers
+# Both trade some mask accuracy for speed; segment_profile_check.py measures
+# how much against fp32 before a profile goes into production.
+CPU_PROFILES = ("fp32", "bf16", "int8")
+
+
+def cpu_supports_bf16():
+    try:
+        return bool(torch.ops.mkldnn._is_mkldnn_bf16_supported())
+    except Exception:
+        return False
+
+
+def set_cpu_threads(intra_op=None, inter_op=None):
+    """Pin torch's intra-op and inter-op thread pools; None keeps torch's default."""
+    if inter_op:
+        try:
+            torch.set_num_interop_threads(inter_op)
+        except RuntimeError as e:
+            # Only possible before torch has started any inter-op work
+            print(f"Could not set inter-op threads: {e}", file=sys.stderr)
+    if intra_op:
+        torch.set_num_threads(intra_op)
+
+
+def image_encoder(model):
+    # The ViT trunk of the vision backbone, where nearly all the compute of a request goes
+    return model.backbone.vision_backbone.trunk
+
+
+def apply_cpu_profile(model, profile="fp32", compile_encoder=False):
+    """
+    Prepare a loaded model for CPU inference with `profile` (one of
+    CPU_PROFILES). Returns the dtype inference should autocast to, or None.
+    """
+    if profile not in CPU_PROFILES:
+        raise ValueError(f"Unknown CPU profile {profile!r}, expected one of {CPU_PROFILES}")
+
+    autocast_dtype = None
+    if profile == "bf16":
+        if cpu_supports_bf16():
+            autocast_dtype = torch.bfloat16
+        else:
+            print("This CPU has no native bf16 support; running the bf16 profile in fp32", file=sys.stderr)
+    elif profile == "int8":
+        # Weights are quantized once here, activations per call. Only the
+        # encoder: its qkv / proj / MLP layers are plain nn.Linear modules,
+        # while the decoder's attention reads its projection weights directly.
+        encoder = image_encoder(model).float()
+        torch.ao.quantization.quantize_dynamic(encoder, {torch.nn.Linear}, dtype=torch.qint8, inplace=True)
+
+    if compile_encoder:
+        import torch._dynamo as dynamo
+        # Anything the compiler cannot handle falls back to eager instead of failing the request
+        dynamo.config.suppress_errors = True
+        encoder = image_encoder(model)
+        encoder.forward = torch.compile(encoder.forward, dynamic=False)
+    return autocast_dtype
+
+
+def weights_dtype_error(device, weights_dtype="float32", cpu_profile="fp32"):
+    """
+    Why the model can't run in `weights_dtype` on `device` with `cpu_profile`,
+    or None. Half precision weights would otherwise get float32 inputs.
+    """
+    if weights_dtype == "float32":
+        return None
+    if device == "cpu" and cpu_profile == "bf16" and weights_dtype == "bfloat16":
+        if cpu_supports_bf16():
+            return None
+        return "--weights-dtype bfloat16 needs native bf16 support, which this CPU lacks"
+    return (
+        f"--weights-dtype {weights_dtype} on {device} runs without autocast to it; "
+        "only --weights-dtype bfloat16 with --cpu-profile bf16 on the CPU is supported"
+    )
+
+
+def load_processor(device, interactive=False, cpu_profile="fp32", compile_encoder=False, **model_options):
+    error = weights_dtype_error(device, model_options.get("weights_dtype", "float32"), cpu_profile)
+    if error:
+        raise ValueError(error)
+    model = load_model(device, interactive=interactive, **model_options)
+    autocast_dtype = None
+    if device == "cpu":
+        autocast_dtype = apply_cpu_profile(model, cpu_profile, compile_encoder)
+    elif cpu_profile != "fp32" or compile_encoder:
+        print(f"Ignoring the CPU profile on {device}", file=sys.stderr)
+    processor = Sam3Processor(model, device=device)
+    processor.autocast_dtype = autocast_dtype
+    return processor
+
+
+@contextlib.contextmanager
+def inference_context(processor):
+    """No autograd bookkeeping, plus the autocast the processor's CPU profile asks for."""
+    autocast_dtype = getattr(processor, "autocast_dtype", None)
+    with torch.inference_mode(), no_cuda_context():
+        if autocast_dtype is None:
+            yield
+        else:
+            with torch.autocast("cpu", dtype=autocast_dtype):
+                yield
+
+
+def warmup(processor, size=1008):
+    """Run a throwaway image and prompt to prime kernels and allocator pools. Returns the seconds taken."""
+    start = time.perf_counter()
+    with inference_context(processor):
+        state = processor.set_image(Image.new("RGB", (size, size), (128, 128, 128)))
+        processor.set_text_prompt(state=state, prompt=DEFAULT_PROMPT)
+    if torch.cuda.is_available():
+        torch.cuda.synchronize()
+    return time.perf_counter() - start
+
+
+# Request key that carries the raw image bytes of a binary frame (never part of the JSON)
+IMAGE_BUFFER_KEY = "_imageBuffer"
+
+# Binary frames start with the length of their JSON header
+FRAME_PREFIX = struct.Struct(">I")
+
+
+def _read_exact(stream, size):
+    data = stream.read(size)
+    if not data:
+        return None
+    while len(data) < size:
+        more = stream.read(size - len(data))
+        if not more:
+            raise EOFError("Truncated request frame")
+        data += more
+    return data
+
+
+def read_frame(stream):
+    """
+    Read one binary request frame, or return None at end of input.
+
+    A frame is a 4-byte big-endian header length, a UTF-8 JSON header (the
+    same fields as a JSON request, plus "imageBytes"), then "imageBytes" raw
+    bytes of the encoded image. The image is read straight into a single
+    preallocated buffer - no base64, no intermediate strings.
+    """
+    prefix = _read_exact(stream, FRAME_PREFIX.size)
+    if prefix is None:
+        return None
+    (header_size,) = FRAME_PREFIX.unpack(prefix)
+    if header_size == 0:
+        raise ValueError("Empty request header")
+    header = _read_exact(stream, header_size)
+    if header is None:
+        raise EOFError("Truncated request frame")
+    request = json.loads(header)
+    if not isinstance(request, dict):
+        raise ValueError("Request header is not a JSON object")
+
+    size = request.get("imageBytes", 0)
+    if size:
+        buffer = bytearray(size)
+        view = memoryview(buffer)
+        received = 0
+        while received < size:
+            n = stream.readinto(view[received:])
+            if not n:
+                raise EOFError("Truncated image payload")
+            received += n
+        request[IMAGE_BUFFER_KEY] = buffer
+    return request
+
+
+def has_image(request):
+    return bool(
+        request.get(IMAGE_BUFFER_KEY)
+        or request.get("imagePath")
+        or request.get("imageShm")
+        or request.get("imageBase64")
+    )
+
+
+def read_image_bytes(request):
+    image_b64 = request.get('imageBase64')
+
+    if not image_b64:
+        raise ValueError("No image data provided")
+
+    # Clean base64 string
+    comma = image_b64.find(",")
+    if comma != -1:
+        image_b64 = image_b64[comma + 1:]
+
+    return base64.b64decode(image_b64)
+
+
+@contextlib.contextmanager
+def _mapped_file(path, offset=0, length=0):
+    # mmap offsets must be aligned to the allocation granularity
+    aligned = offset - offset % mmap.ALLOCATIONGRANULARITY
+    with open(path, "rb") as f:
+        size = length + (offset - aligned) if length else 0
+        with mmap.mmap(f.fileno(), size, access=mmap.ACCESS_READ, offset=aligned) as mapped:
+            view = memoryview(mapped)[offset - aligned:]
+            try:
+                yield view
+            finally:
+                view.release()
+
+
+@contextlib.contextmanager
+def _shared_memory(spec):
+    from multiprocessing import shared_memory
+
+    shm = shared_memory.SharedMemory(name=spec["name"])
+    try:
+        # We only borrow the segment; stop the resource tracker from
+        # unlinking it behind the owner's back when this process exits.
+        from multiprocessing import resource_tracker
+        resource_tracker.unregister(shm._name, "shared_memory")
+    except Exception:
+        pass
+    offset = spec.get("offset", 0)
+    length = spec.get("length") or (shm.size - offset)
+    view = shm.buf[offset:offset + length]
+    try:
+        yield view
+    finally:
+        view.release()
+        shm.close()
+
+
+@contextlib.contextmanager
+def open_image_buffer(request):
+    """
+    Yield the encoded image as a bytes-like object, whichever way it was sent:
+
+      binary frame    the raw bytes that followed the frame header
+      "imagePath"     a file, memory-mapped (optionally "imageOffset"/"imageLength")
+      "imageShm"      {"name", "offset", "length"} of a shared memory segment
+      "imageBase64"   the original base64 / data URL field
+    """
+    if request.get(IMAGE_BUFFER_KEY):
+        yield request[IMAGE_BUFFER_KEY]
+    elif request.get("imagePath"):
+        with _mapped_file(
+            request["imagePath"],
+            offset=request.get("imageOffset", 0),
+            length=request.get("imageLength", 0),
+        ) as view:
+            yield view
+    elif request.get("imageShm"):
+        with _shared_memory(request["imageShm"]) as view:
+            yield view
+    else:
+        yield read_image_bytes(request)
+
+
+class BufferReader(io.RawIOBase):
+    """Read-only, seekable file object over any buffer, so PIL can decode without copying it first."""
+
+    def __init__(self, buffer):
+        super().__init__()
+        self.view = memoryview(buffer).cast("B")
+        self.pos = 0
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def readinto(self, b):
+        n = max(0, min(len(b), len(self.view) - self.pos))
+        b[:n] = self.view[self.pos:self.pos + n]
+        self.pos += n
+        return n
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        if whence == io.SEEK_CUR:
+            offset += self.pos
+        elif whence == io.SEEK_END:
+            offset += len(self.view)
+        self.pos = max(0, offset)
+        return self.pos
+
+    def tell(self):
+        return self.pos
+
+    def close(self):
+        self.view.release()
+        super().close()
+
+
+def _shrink(image, max_size):
+    """Scale `image` down to at most `max_size` on its longest side, decoding as little as possible."""
+    if not max_size or max(image.size) <= max_size:
+        return image
+    # Before anything is decoded, JPEGs can be decoded at 1/2..1/8 scale
+    # straight away (a no-op for other formats)
+    image.draft("RGB", (max_size, max_size))
+    # reduce() and thumbnail() reject palette, 1-bit and 16-bit modes; the
+    # caller converts to RGB anyway, so do it now for everything unusual
+    if image.mode not in ("RGB", "L", "RGBA"):
+        image = image.convert("RGB")
+    # Integer box reduction is much cheaper than resampling the full image
+    factor = max(image.size) // max_size
+    if factor >= 2:
+        image = image.reduce(factor)
+    if max(image.size) > max_size:
+        image.thumbnail((max_size, max_size), Image.BILINEAR)
+    return image
+
+
+def decode_image(request, image_data=None, max_size=0):
+    """
+    Decode the request's image, scaled down to at most `max_size` pixels on
+    its longest side (0: full resolution). Returns the RGB image and the
+    (width, height) of the source.
+    """
+    if image_data is None:
+        with open_image_buffer(request) as buffer:
+            return decode_image(request, buffer, max_size)
+
+    raw = request.get("rawPixels")
+    if raw:
+        # Already decoded pixels: {"width", "height", "mode"}; wrap them without parsing
+        mode = raw.get("mode", "RGB")
+        image = Image.frombuffer(mode, (raw["width"], raw["height"]), image_data, "raw", mode, 0, 1)
+        source_size = image.size
+        # convert() always returns a copy, so the image outlives the buffer
+        return _shrink(image, max_size).convert("RGB"), source_size
+
+    with BufferReader(image_data) as reader:
+        image = Image.open(reader)
+        source_size = image.size
+        return _shrink(image, max_size).convert("RGB"), source_size
+
+
+def mask_arrays(output):
+    """Pull the (H, W) mask arrays and float scores out of a prompt output."""
+    # output contains "masks", "boxes", "scores"
+    masks = output["masks"] # list of tensors? or tensor?
+    scores = output["scores"]
+
+    # masks is likely a list or tensor of shape (N, H, W)
+    if isinstance(masks, torch.Tensor):
+        # Under bf16 autocast, floating outputs come back as bfloat16, which numpy has no type for
+        if masks.is_floating_point() and masks.dtype != torch.float32:
+            masks = masks.float()
+        masks_cpu = masks.cpu().numpy()
+        scores_cpu = scores.float().cpu().numpy()
+    elif isinstance(masks, np.ndarray):
+        # The interactive (point) head already returns numpy arrays
+        masks_cpu = masks
+        scores_cpu = np.asarray(scores)
+    else:
+        # If it's a list
+         masks_cpu = [m.float().cpu().numpy() if m.is_floating_point() else m.cpu().numpy() for m in masks]
+         scores_cpu = [s.float().cpu().numpy() for s in scores]
+
+    arrays = []
+    for mask_array in masks_cpu:
+        # Squeeze if necessary (H, W)
+        if mask_array.ndim > 2:
+            mask_array = mask_array.squeeze()
+        arrays.append(mask_array)
+    return arrays, [float(score) for score in scores_cpu]
+
+
+def _binary(mask_array):
+    # mask_array is likely boolean or float 0..1.
+    if mask_array.dtype == bool:
+        return mask_array
+    return mask_array > 0.5
+
+
+def encode_png(mask_array):
+    # Convert to uint8 0..255
+    mask_uint8 = (mask_array * 255).astype(np.uint8)
+    mask_img = Image.fromarray(mask_uint8)
+
+    # Convert to base64 PNG
+    buffered = io.BytesIO()
+    mask_img.save(buffered, format="PNG")
+    return {"mask": base64.b64encode(buffered.getvalue()).decode('utf-8')}
+
+
+def _rle_counts(mask):
+    # COCO RLE: run lengths over the column-major flattened mask, starting with a run of zeros
+    flat = mask.ravel(order="F")
+    changes = np.flatnonzero(flat[1:] != flat[:-1]) + 1
+    counts = np.diff(np.concatenate(([0], changes, [flat.size])))
+    if flat.size and flat[0]:
+        counts = np.concatenate(([0], counts))
+    return counts
+
+
+def _rle_counts_to_string(counts):
+    # Same compressed string format as pycocotools (rleToString in maskApi.c)
+    out = bytearray()
+    for i in range(len(counts)):
+        x = int(counts[i])
+        if i > 2:
+            x -= int(counts[i - 2])
+        more = True
+        while more:
+            c = x & 0x1f
+            x >>= 5
+            more = x != -1 if c & 0x10 else x != 0
+            if more:
+                c |= 0x20
+            out.append(c + 48)
+    return out.decode("ascii")
+
+
+def encode_rle(mask_array):
+    mask = _binary(mask_array)
+    if mask_utils is not None:
+        rle = mask_utils.encode(np.asfortranarray(mask.astype(np.uint8)))
+        counts = rle["counts"].decode("ascii")
+    else:
+        counts = _rle_counts_to_string(_rle_counts(mask))
+    return {"rle": {"size": list(mask.shape), "counts": counts}}
+
+
+def encode_packbits(mask_array):
+    # Row-major bits, most significant bit first (numpy's default bitorder)
+    mask = _binary(mask_array)
+    packed = np.packbits(mask, axis=None)
+    return {
+        "bits": base64.b64encode(packed.tobytes()).decode('ascii'),
+        "shape": list(mask.shape),
+    }
+
+
+MASK_ENCODERS = {
+    "png": encode_png,
+    "rle": encode_rle,
+    "packbits": encode_packbits,
+}
+
+MASK_FORMATS = sorted(MASK_ENCODERS) + ["labelmap"]
+
+
+def encode_label_map(arrays, scores, offsets=None, canvas_size=None, out_size=None):
+    """
+    Paint every instance into one PNG: pixel value k means instance k (1-based),
+    0 means background. Higher scoring instances are painted last so they win
+    where masks overlap.
+
+    Masks that only cover part of the image (tiled inference) are painted at
+    their (x, y) `offsets` into a `canvas_size` (width, height) map, which is
+    then resized to `out_size` if that differs.
+    """
+    if canvas_size is None:
+        height, width = arrays[0].shape if arrays else (0, 0)
+    else:
+        width, height = canvas_size
+    dtype = np.uint8 if len(arrays) < 256 else np.uint16
+    label_map = np.zeros((height, width), dtype=dtype)
+    for index in np.argsort(scores, kind="stable"):
+        x, y = offsets[index] if offsets else (0, 0)
+        mask = _binary(arrays[index])
+        label_map[y:y + mask.shape[0], x:x + mask.shape[1]][mask] = index + 1
+
+    image = Image.fromarray(label_map)
+    if out_size is not None and out_size != image.size:
+        # Labels are ids, never blend them
+        image = image.resize(out_size, Image.NEAREST)
+    buffered = io.BytesIO()
+    image.save(buffered, format="PNG")
+    return base64.b64encode(buffered.getvalue()).decode('ascii')
+
+
+# Mask resolutions a request can ask for ("maskResolution"):
+#   "source":    the resolution of the uploaded image (default)
+#   "inference": the resolution the image was decoded at for inference; the
+#                response's "resolution" record carries the scale factor
+MASK_RESOLUTIONS = ("source", "inference")
+
+# Tiled inference ("tiles": true): overlapping tiles of the decoded image,
+# each run through the encoder at its native input size
+DEFAULT_TILE_SIZE = 1008
+DEFAULT_TILE_OVERLAP = 128
+
+
+def inference_options(request):
+    """(max inference size or 0, tile size or 0, tile overlap) requested for the image."""
+    max_size = int(request.get("maxInferenceSize") or 0)
+    tile_size = overlap = 0
+    if request.get("tiles"):
+        tile_size = int(request.get("tileSize") or DEFAULT_TILE_SIZE)
+        overlap = int(request.get("tileOverlap", DEFAULT_TILE_OVERLAP))
+        if not 0 <= overlap < tile_size:
+            raise ValueError(f"tileOverlap must be in [0, tileSize), got {overlap}")
+    return max_size, tile_size, overlap
+
+
+def tile_grid(width, height, size, overlap):
+    """(x0, y0, x1, y1) boxes of size x size tiles covering the image, neighbours sharing `overlap` pixels."""
+    def starts(length):
+        if length <= size:
+            return [0]
+        stride = size - overlap
+        positions = list(range(0, length - size, stride))
+        # The last tile sits flush with the far edge
+        return positions + [length - size]
+
+    return [
+        (x, y, min(x + size, width), min(y + size, height))
+        for y in starts(height)
+        for x in starts(width)
+    ]
+
+
+def place_mask(mask_array, x, y, canvas_size, out_size):
+    """
+    The mask of one detection as a full (out_size) image. `mask_array` sits
+    at (x, y) of the `canvas_size` (width, height) inference canvas; it is
+    either binary or a 0..1 probability map, which upsamples more smoothly.
+    """
+    width, height = canvas_size
+    if mask_array.shape != (height, width):
+        canvas = np.zeros((height, width), dtype=mask_array.dtype)
+        canvas[y:y + mask_array.shape[0], x:x + mask_array.shape[1]] = mask_array
+        mask_array = canvas
+    if out_size == canvas_size:
+        return mask_array
+    if mask_array.dtype == bool:
+        levels = mask_array.view(np.uint8) * np.uint8(255)
+    else:
+        levels = (np.clip(mask_array, 0, 1) * 255).astype(np.uint8)
+    # Upsampled one mask at a time, right before encoding
+    return np.asarray(Image.fromarray(levels).resize(out_size, Image.BILINEAR)) > 127
+
+
+def _payload_bytes(record):
+    return sum(
+        len(value) if isinstance(value, str) else _payload_bytes(value)
+        for value in record.values()
+        if isinstance(value, (str, dict))
+    )
+
+
+def _select_batch_item(value, index, batch_size):
+    # Pull one image's slice out of a batched backbone output, keeping the
+    # leading batch dimension so the result looks like a set_image() output.
+    if isinstance(value, torch.Tensor):
+        if value.dim() > 0 and value.shape[0] == batch_size:
+            return value[index:index + 1]
+        return value
+    if isinstance(value, dict):
+        return {k: _select_batch_item(v, index, batch_size) for k, v in value.items()}
+    if isinstance(value, (list, tuple)):
+        return type(value)(_select_batch_item(v, index, batch_size) for v in value)
+    return value
+
+
+def set_images(processor, images):
+    """Run the image encoder once for a whole batch and return one inference state per image."""
+    if len(images) == 1 or not hasattr(processor, "set_image_batch"):
+        return [processor.set_image(image) for image in images]
+
+    batch_state = processor.set_image_batch(images)
+    backbone_out = batch_state["backbone_out"]
+    states = []
+    for i, image in enumerate(images):
+        width, height = image.size
+        states.append({
+            "original_height": height,
+            "original_width": width,
+            "backbone_out": _select_batch_item(backbone_out, i, len(images)),
+        })
+    return states
+
+
+def _tensor_bytes(value):
+    if isinstance(value, torch.Tensor):
+        return value.element_size() * value.nelement()
+    if isinstance(value, dict):
+        return sum(_tensor_bytes(v) for v in value.values())
+    if isinstance(value, (list, tuple)):
+        return sum(_tensor_bytes(v) for v in value)
+    return 0
+
+
+def _snapshot_state(state):
+    # Prompting writes into the state (and into state["backbone_out"]), so
+    # only hand out shallow copies; the tensors themselves are shared.
+    snapshot = dict(state)
+    snapshot["backbone_out"] = dict(state["backbone_out"])
+    return snapshot
+
+
+def _plain_state(value):
+    """
+    Copy of a state made of dicts, lists, tuples, tensors and scalars only,
+    so the disk tier can be read back with torch.load(weights_only=True).
+    """
+    if isinstance(value, torch.Tensor):
+        return value.detach()
+    if isinstance(value, dict):
+        return {key: _plain_state(v) for key, v in value.items()}
+    if isinstance(value, (list, tuple)):
+        return type(value)(_plain_state(v) for v in value)
+    if value is None or isinstance(value, (bool, int, float, str)):
+        return value
+    raise TypeError(f"Cannot write {type(value).__name__} to the embedding disk cache")
+
+
+class EmbeddingCache:
+    """
+    Content-addressed cache of image inference states (backbone features).
+
+    Keys are SHA-256 hashes of the encoded image bytes, so a repeat request
+    for the same upload - with the same or a different prompt - skips both
+    the image decode and the encoder. The in-memory tier is an LRU bounded by
+    the byte size of the cached tensors; the optional disk tier keeps evicted
+    and newly computed states under `disk_dir`, bounded by `disk_bytes`.
+    """
+
+    def __init__(self, max_bytes, device, disk_dir=None, disk_bytes=0):
+        self.max_bytes = max_bytes
+        self.device = device
+        self.disk_dir = disk_dir
+        self.disk_bytes = disk_bytes
+        self.entries = OrderedDict()
+        self.bytes = 0
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.evictions = 0
+        if self.disk_dir:
+            os.makedirs(self.disk_dir, exist_ok=True)
+
+    @staticmethod
+    def key(image_data, variant=""):
+        # `variant` tells apart states of one upload decoded at different sizes
+        digest = hashlib.sha256(image_data).hexdigest()
+        return f"{digest}-{variant}" if variant else digest
+
+    def _disk_path(self, key):
+        return os.path.join(self.disk_dir, f"{key}.pt")
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None:
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return _snapshot_state(entry[0])
+
+        if self.disk_dir and os.path.exists(self._disk_path(key)):
+            try:
+                state = torch.load(self._disk_path(key), map_location=self.device, weights_only=True)
+            except Exception:
+                import traceback
+                traceback.print_exc(file=sys.stderr)
+                # Unreadable (or written by an older version); recompute it
+                with contextlib.suppress(FileNotFoundError):
+                    os.remove(self._disk_path(key))
+            else:
+                # Touch the file so disk trimming evicts least recently used first
+                os.utime(self._disk_path(key))
+                with self.lock:
+                    self.disk_hits += 1
+                self._insert(key, state)
+                return _snapshot_state(state)
+
+        with self.lock:
+            self.misses += 1
+        return None
+
+    def put(self, key, state):
+        snapshot = _snapshot_state(state)
+        self._insert(key, snapshot)
+        if self.disk_dir:
+            self._write_disk(key, snapshot)
+
+    def _insert(self, key, state):
+        nbytes = _tensor_bytes(state)
+        if nbytes > self.max_bytes:
             return
+        with self.lock:
+            if key in self.entries:
+                self.bytes -= self.entries.pop(key)[1]
+            self.entries[key] = (state, nbytes)
+            self.bytes += nbytes
+            while self.bytes > self.max_bytes:
+                _, (_, evicted_bytes) = self.entries.popitem(last=False)
+                self.bytes -= evicted_bytes
+                self.evictions += 1
 
-        image_b64 = request.get('imageBase64')
-        
-        if not image_b64:
-            print(json.dumps({"error": "No image data provided"}))
+    def _write_disk(self, key, state):
+        path = self._disk_path(key)
+        if os.path.exists(path):
             return
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        try:
+            torch.save(_plain_state(state), tmp_path)
+            os.replace(tmp_path, path)
+        except Exception:
+            import traceback
+            traceback.print_exc(file=sys.stderr)
+            return
+        self._trim_disk()
 
-        # Clean base64 string
-        if "," in image_b64:
-            image_b64 = image_b64.split(",")[1]
-
-        # Decode image
-        image_data = base64.b64decode(image_b64)
-        image = Image.open(io.BytesIO(image_data)).convert("RGB")
-
-        # Determine device
-        device = "cpu"
-        if torch.cuda.is_available():
-            device = "cuda"
-        elif torch.backends.mps.is_available():
-            device = "mps"
-        
-        # Load Model
-        # This will download the checkpoint on first run if not present
-        model = build_sam3_image_model() 
-        model.to(device)
-        processor = Sam3Processor(model)
+    def _trim_disk(self):
+        # Drop the least recently used files once the disk tier is over budget
+        files = []
+        for name in os.listdir(self.disk_dir):
+            if name.endswith(".pt"):
+                path = os.path.join(self.disk_dir, name)
+                stat = os.stat(path)
+                files.append((stat.st_mtime, stat.st_size, path))
+        total = sum(size for _, size, _ in files)
+        for _, size, path in sorted(files):
+            if total <= self.disk_bytes:
+                break
+            os.remove(path)
+            total -= size
 
-        # Prepare Inference
-        inference_state = processor.set_image(image)
-
-        # Prompt the model - "segment everything" equivalent or just find all objects?
-        # SAM3 "segment everything" often implies prompting with a grid of points or similar
-        # But here we can use a generic text prompt like "object" or "thing" if we want general segmentation,
-        # OR we can try to find an API in processor that does automatic mask generation.
-        # However, the user snippet showed: output = processor.set_text_prompt(state=inference_state, prompt="<YOUR_TEXT_PROMPT>")
-        
-        # For "segment everything" behavior without a specific prompt, standard SAM uses grid points.
-        # SAM3 might be different. Let's try a generic prompt "everything" or "object".
-        # Better yet, let's see if we can just return all candidate masks.
-        
+    def report(self):
+        with self.lock:
+            lookups = self.hits + self.disk_hits + self.misses
+            return {
+                "entries": len(self.entries),
+                "bytes": self.bytes,
+                "maxBytes": self.max_bytes,
+                "hits": self.hits,
+                "diskHits": self.disk_hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "hitRate": (self.hits + self.disk_hits) / lookups if lookups else None,
+                "diskDir": self.disk_dir,
+            }
+
+
+def prepare_states(processor, requests, cache=None):
+    """
+    Produce an inference state for every request, reusing cached embeddings
+    where possible and running the encoder once over all remaining images.
+
+    Tiled requests get a state holding the decoded image and its tile grid
+    instead; their tiles are encoded one by one in segment_tiles().
+
+    Returns a list with either a state or the exception raised for that request.
+    """
+    states = [None] * len(requests)
+    images = []
+    pending = []
+    for i, request in enumerate(requests):
+        try:
+            max_size, tile_size, tile_overlap = inference_options(request)
+            with open_image_buffer(request) as image_data:
+                if tile_size:
+                    image, (source_width, source_height) = decode_image(request, image_data, max_size)
+                    states[i] = {
+                        "image": image,
+                        "tiles": tile_grid(image.width, image.height, tile_size, tile_overlap),
+                        "source_width": source_width,
+                        "source_height": source_height,
+                    }
+                    continue
+                key = None
+                if cache is not None:
+                    key = EmbeddingCache.key(image_data, f"max{max_size}" if max_size else "")
+                state = cache.get(key) if cache is not None else None
+                if state is not None:
+                    states[i] = state
+                    continue
+                image, source_size = decode_image(request, image_data, max_size)
+                images.append(image)
+            pending.append((i, key, source_size))
+        except Exception as e:
+            states[i] = e
+
+    if not images:
+        return states
+
+    try:
+        encoded = set_images(processor, images)
+    except Exception as e:
+        import traceback
+        traceback.print_exc(file=sys.stderr)
+        for i, _, _ in pending:
+            states[i] = e
+        return states
+
+    for (i, key, source_size), state in zip(pending, encoded):
+        state["source_width"], state["source_height"] = source_size
+        if cache is not None:
+            cache.put(key, state)
+        states[i] = state
+    return states
+
+
+def parse_prompts(request):
+    """
+    Turn the request into an ordered list of prompt groups.
+
+    Supported request fields (all optional):
+      "prompts": ["chair", "lamp"]    text prompts (or a single "prompt": "chair")
+      "boxes":   [{"box": [x, y, w, h], "positive": true, "label": "chair"}]
+                 pixel-space exemplar boxes, each evaluated as its own group
+      "points":  [{"points": [[x, y], ...], "pointLabels": [1, 0], "label": "cup"}]
+                 pixel-space click prompts, each evaluated as its own group
+    """
+    prompts = request.get("prompts")
+    if prompts is None and request.get("prompt"):
+        prompts = [request["prompt"]]
+
+    groups = [{"kind": "text", "label": prompt, "prompt": prompt} for prompt in (prompts or [])]
+
+    for box in request.get("boxes") or []:
+        groups.append({
+            "kind": "box",
+            "label": box.get("label") or "box",
+            "box": box["box"],
+            "positive": box.get("positive", True),
+        })
+
+    for points in request.get("points") or []:
+        coords = points["points"]
+        groups.append({
+            "kind": "points",
+            "label": points.get("label") or "points",
+            "points": coords,
+            "pointLabels": points.get("pointLabels") or [1] * len(coords),
+        })
+
+    if not groups:
         # Since the user UI expects "segmentation" often implying "auto-segment",
-        # we will use a generic prompt "all objects" or similar if no prompt is provided.
-        # BUT, the current API request from the frontend doesn't pass a prompt for 'segment' action, it just sends the image.
+        # we use a generic prompt if no prompt is provided.
+        # The current API request from the frontend doesn't pass a prompt for 'segment' action, it just sends the image.
         # So we default to "objects".
-        
-        output = processor.set_text_prompt(state=inference_state, prompt="objects")
-
-        # output contains "masks", "boxes", "scores"
-        masks = output["masks"] # list of tensors? or tensor?
-        scores = output["scores"]
-        
-        # Process outputs
-        masks_data = []
-        
-        # masks is likely a list or tensor of shape (N, H, W)
-        if isinstance(masks, torch.Tensor):
-            masks_cpu = masks.cpu().numpy()
-            scores_cpu = scores.cpu().numpy()
+        groups.append({"kind": "text", "label": DEFAULT_PROMPT, "prompt": DEFAULT_PROMPT})
+    return groups
+
+
+def run_prompt(processor, inference_state, group):
+    # Every group starts from the same image embedding; only the prompt changes
+    if hasattr(processor, "reset_all_prompts"):
+        processor.reset_all_prompts(inference_state)
+
+    if group["kind"] == "text":
+        return processor.set_text_prompt(state=inference_state, prompt=group["prompt"])
+
+    width = inference_state["original_width"]
+    height = inference_state["original_height"]
+    # Prompt coordinates are in pixels of the uploaded image, which may have
+    # been decoded smaller for inference
+    source_width = inference_state.get("source_width", width)
+    source_height = inference_state.get("source_height", height)
+
+    if group["kind"] == "box":
+        # Sam3Processor takes boxes as normalized cx, cy, w, h
+        x, y, w, h = group["box"]
+        box = [
+            (x + w / 2) / source_width,
+            (y + h / 2) / source_height,
+            w / source_width,
+            h / source_height,
+        ]
+        return processor.add_geometric_prompt(box=box, label=bool(group["positive"]), state=inference_state)
+
+    # Point clicks go through the SAM-style interactive head
+    predict_inst = getattr(processor.model, "predict_inst", None)
+    if predict_inst is None:
+        raise ValueError("Point prompts need the model built with instance interactivity (--interactive)")
+    scale = np.array([width / source_width, height / source_height], dtype=np.float32)
+    masks, scores, _ = predict_inst(
+        inference_state,
+        point_coords=np.asarray(group["points"], dtype=np.float32) * scale,
+        point_labels=np.asarray(group["pointLabels"], dtype=np.int32),
+        multimask_output=False,
+    )
+    return {"masks": masks, "scores": scores}
+
+
+def _tile_group(group, scale, tile):
+    """
+    The prompt group in the pixel space of `tile` (x0, y0, x1, y1 of the
+    decoded image), or None if it does not apply there. Text prompts run on
+    every tile, boxes (clipped) on every tile they overlap and clicks on the
+    tiles containing the first click.
+    """
+    x0, y0, x1, y1 = tile
+    scale_x, scale_y = scale
+    if group["kind"] == "text":
+        return group
+    if group["kind"] == "box":
+        x, y, w, h = group["box"]
+        x, y, w, h = x * scale_x - x0, y * scale_y - y0, w * scale_x, h * scale_y
+        # Clip to the tile, the processor normalizes by the tile size
+        left, top = max(x, 0.0), max(y, 0.0)
+        right, bottom = min(x + w, x1 - x0), min(y + h, y1 - y0)
+        if right <= left or bottom <= top:
+            return None
+        return {**group, "box": [left, top, right - left, bottom - top]}
+    points = [[px * scale_x - x0, py * scale_y - y0] for px, py in group["points"]]
+    if not (0 <= points[0][0] < x1 - x0 and 0 <= points[0][1] < y1 - y0):
+        return None
+    return {**group, "points": points}
+
+
+def _crop_to_content(mask):
+    # (crop, x, y) of the mask's bounding box, or None for an empty mask
+    rows = np.flatnonzero(mask.any(axis=1))
+    if not rows.size:
+        return None
+    cols = np.flatnonzero(mask.any(axis=0))
+    # copy(): a view would keep the whole tile-sized mask alive
+    crop = mask[rows[0]:rows[-1] + 1, cols[0]:cols[-1] + 1].copy()
+    return crop, int(cols[0]), int(rows[0])
+
+
+def merge_tile_detections(detections, threshold=0.5):
+    """
+    Merge the pieces of objects that were cut by tile seams.
+
+    Greedy, highest score first: a detection from a tile that has not
+    contributed to a kept detection yet joins it when their masks agree on at
+    least `threshold` of the smaller one's pixels where their boxes overlap
+    (in practice: the strip both tiles saw). Joined masks are unioned.
+    Detections from the same tile are never merged; the model already
+    separated those. Returns the (mask, x, y) placements and their scores.
+    """
+    kept = []
+    for detection in sorted(detections, key=lambda d: -d["score"]):
+        mask, x, y = detection["mask"], detection["x"], detection["y"]
+        for other in kept:
+            if detection["tile"] in other["tiles"]:
+                continue
+            ox, oy, omask = other["x"], other["y"], other["mask"]
+            ix0, iy0 = max(x, ox), max(y, oy)
+            ix1 = min(x + mask.shape[1], ox + omask.shape[1])
+            iy1 = min(y + mask.shape[0], oy + omask.shape[0])
+            if ix0 >= ix1 or iy0 >= iy1:
+                continue
+            a = mask[iy0 - y:iy1 - y, ix0 - x:ix1 - x]
+            b = omask[iy0 - oy:iy1 - oy, ix0 - ox:ix1 - ox]
+            smaller = min(np.count_nonzero(a), np.count_nonzero(b))
+            if smaller and np.count_nonzero(a & b) >= threshold * smaller:
+                ux0, uy0 = min(x, ox), min(y, oy)
+                ux1 = max(x + mask.shape[1], ox + omask.shape[1])
+                uy1 = max(y + mask.shape[0], oy + omask.shape[0])
+                union = np.zeros((uy1 - uy0, ux1 - ux0), dtype=bool)
+                union[oy - uy0:oy - uy0 + omask.shape[0], ox - ux0:ox - ux0 + omask.shape[1]] = omask
+                union[y - uy0:y - uy0 + mask.shape[0], x - ux0:x - ux0 + mask.shape[1]] |= mask
+                other.update(mask=union, x=ux0, y=uy0)
+                other["tiles"].add(detection["tile"])
+                break
         else:
-            # If it's a list
-             masks_cpu = [m.cpu().numpy() for m in masks]
-             scores_cpu = [s.cpu().numpy() for s in scores]
-
-        # Iterate
-        for i in range(len(masks_cpu)):
-            mask_array = masks_cpu[i]
-            score = float(scores_cpu[i])
-            
-            # mask_array is likely boolean or float 0..1. 
-            # Convert to uint8 0..255
-            if mask_array.dtype == bool:
-                mask_uint8 = (mask_array * 255).astype(np.uint8)
+            kept.append({**detection, "tiles": {detection["tile"]}})
+    return [(d["mask"], d["x"], d["y"]) for d in kept], [d["score"] for d in kept]
+
+
+def segment_tiles(processor, inference_state, groups):
+    """
+    Run every prompt group over every tile of a tiled inference state. Tiles
+    go through the encoder one at a time, so only one tile's features are
+    held at once. Returns a (placements, scores) pair per group, placements
+    being (mask crop, x, y) in the decoded image.
+    """
+    image = inference_state["image"]
+    scale = (image.width / inference_state["source_width"], image.height / inference_state["source_height"])
+    detections = [[] for _ in groups]
+    for tile_index, tile in enumerate(inference_state["tiles"]):
+        tile_groups = [(i, _tile_group(group, scale, tile)) for i, group in enumerate(groups)]
+        tile_groups = [(i, group) for i, group in tile_groups if group is not None]
+        if not tile_groups:
+            continue
+        state = processor.set_image(image.crop(tile))
+        for i, group in tile_groups:
+            arrays, scores = mask_arrays(run_prompt(processor, state, group))
+            for mask_array, score in zip(arrays, scores):
+                cropped = _crop_to_content(_binary(mask_array))
+                if cropped is None:
+                    continue
+                crop, x, y = cropped
+                detections[i].append(
+                    {"mask": crop, "x": tile[0] + x, "y": tile[1] + y, "score": score, "tile": tile_index}
+                )
+        del state
+    return [merge_tile_detections(group_detections) for group_detections in detections]
+
+
+def _prompt_masks(processor, inference_state, prompt_groups, soft=False):
+    """
+    Yield (group, placements, scores) for every prompt group, placements
+    being (mask, x, y) in the inference canvas. With `soft`, masks are the
+    processor's probability maps where it has them, for smoother upsampling.
+    """
+    if "tiles" in inference_state:
+        for group, (placements, scores) in zip(prompt_groups, segment_tiles(processor, inference_state, prompt_groups)):
+            yield group, placements, scores
+        return
+
+    # The encoder ran once already; every prompt is evaluated against that one state.
+    for group in prompt_groups:
+        output = run_prompt(processor, inference_state, group)
+        if soft and isinstance(output.get("masks_logits"), torch.Tensor):
+            output = {"masks": output["masks_logits"], "scores": output["scores"]}
+        arrays, scores = mask_arrays(output)
+        yield group, [(mask_array, 0, 0) for mask_array in arrays], scores
+
+
+def segment(processor, request, inference_state=None, emit=None):
+    """
+    Run every prompt in the request and encode the resulting masks.
+
+    With "stream": true (and an `emit` callback) each mask is handed to
+    `emit` as its own {"type": "mask"} record as soon as it is encoded, and
+    the returned value is a final {"type": "summary"} record; nothing but
+    the current prompt's masks is held in memory. Otherwise the masks are
+    collected into a single {"type": "masks"} document.
+
+    Images decoded below their source resolution ("maxInferenceSize") or run
+    as tiles ("tiles") have their masks upsampled one at a time while
+    encoding, unless "maskResolution" is "inference"; the response then
+    carries a "resolution" record relating mask pixels to source pixels.
+    """
+    mask_format = request.get("maskFormat", "png")
+    if mask_format not in MASK_FORMATS:
+        raise ValueError(f"Unknown maskFormat {mask_format!r}, expected one of {MASK_FORMATS}")
+    mask_resolution = request.get("maskResolution", "source")
+    if mask_resolution not in MASK_RESOLUTIONS:
+        raise ValueError(f"Unknown maskResolution {mask_resolution!r}, expected one of {MASK_RESOLUTIONS}")
+    # A label map needs every instance before it can be written, so it is
+    # never streamed mask by mask; it arrives on the summary record instead.
+    stream = bool(request.get("stream")) and emit is not None
+    stream_masks = stream and mask_format != "labelmap"
+
+    if inference_state is None:
+        # Prepare Inference
+        inference_state = prepare_states(processor, [request])[0]
+        if isinstance(inference_state, Exception):
+            raise inference_state
+
+    tiled = "tiles" in inference_state
+    if tiled:
+        canvas_size = inference_state["image"].size
+    else:
+        canvas_size = (inference_state["original_width"], inference_state["original_height"])
+    source_size = (
+        inference_state.get("source_width", canvas_size[0]),
+        inference_state.get("source_height", canvas_size[1]),
+    )
+    out_size = source_size if mask_resolution == "source" else canvas_size
+
+    masks_data = []
+    arrays = []
+    offsets = []
+    scores = []
+    groups = []
+    count = 0
+    encode_seconds = 0.0
+    payload_bytes = 0
+    for group, placements, group_scores in _prompt_masks(
+        processor, inference_state, parse_prompts(request), soft=out_size != canvas_size
+    ):
+        groups.append({
+            "kind": group["kind"],
+            "label": group["label"],
+            "masks": list(range(count, count + len(placements))),
+        })
+
+        for (mask_array, x, y), score in zip(placements, group_scores):
+            record = {"score": score, "label": group["label"]}
+            if mask_format == "labelmap":
+                arrays.append(mask_array)
+                offsets.append((x, y))
+                scores.append(score)
             else:
-                 mask_uint8 = (mask_array * 255).astype(np.uint8)
-
-            # Squeeze if necessary (H, W)
-            if mask_uint8.ndim > 2:
-                mask_uint8 = mask_uint8.squeeze()
-
-            mask_img = Image.fromarray(mask_uint8)
-            
-            # Convert to base64 PNG
-            buffered = io.BytesIO()
-            mask_img.save(buffered, format="PNG")
-            mask_b64 = base64.b64encode(buffered.getvalue()).decode('utf-8')
-            
-            masks_data.append({
-                "mask": mask_b64,
-                "score": score,
-                "label": "object"
-            })
+                encode_start = time.perf_counter()
+                mask_array = place_mask(mask_array, x, y, canvas_size, out_size)
+                record.update(MASK_ENCODERS[mask_format](mask_array))
+                encode_seconds += time.perf_counter() - encode_start
+                payload_bytes += _payload_bytes(record)
+
+            if stream_masks:
+                emit({"type": "mask", "index": count, **record})
+            else:
+                masks_data.append(record)
+            count += 1
+
+    if stream:
+        response = {"type": "summary", "format": mask_format, "count": count, "groups": groups}
+    else:
+        response = {"type": "masks", "format": mask_format, "data": masks_data, "groups": groups}
+
+    if mask_format == "labelmap":
+        encode_start = time.perf_counter()
+        response["labelMap"] = encode_label_map(
+            [_binary(mask_array) for mask_array in arrays], scores, offsets, canvas_size, out_size
+        )
+        encode_seconds += time.perf_counter() - encode_start
+        payload_bytes = len(response["labelMap"])
+        if stream:
+            response["data"] = masks_data
+
+    if tiled or canvas_size != source_size:
+        response["resolution"] = {
+            "width": out_size[0],
+            "height": out_size[1],
+            "sourceWidth": source_size[0],
+            "sourceHeight": source_size[1],
+            "inferenceWidth": canvas_size[0],
+            "inferenceHeight": canvas_size[1],
+            # Mask pixels per source pixel along each axis
+            "scaleX": out_size[0] / source_size[0],
+            "scaleY": out_size[1] / source_size[1],
+            "tiles": len(inference_state["tiles"]) if tiled else 0,
+        }
+
+    response["encoding"] = {
+        "format": mask_format,
+        "encodeMs": encode_seconds * 1000.0,
+        "bytes": payload_bytes,
+    }
+    return response
+
+
+def apply_request_defaults(request, defaults):
+    # Command line defaults for per-request options the request leaves out
+    for key, value in (defaults or {}).items():
+        if value is not None:
+            request.setdefault(key, value)
+    return request
+
+
+def run_once(cache_bytes=0, cache_dir=None, cache_disk_bytes=0, interactive=False, binary=False, model_options=None,
+             request_defaults=None):
+    # One-shot mode: a single request on stdin, a single JSON document on stdout.
+    try:
+        if binary:
+            try:
+                request = read_frame(sys.stdin.buffer)
+            except (EOFError, ValueError):
+                print(json.dumps({"error": "Invalid request frame"}))
+                return
+            if request is None:
+                return
+        else:
+            # Read input from stdin
+            input_data = sys.stdin.read()
+            if not input_data:
+                return
+
+            try:
+                request = json.loads(input_data)
+            except json.JSONDecodeError:
+                print(json.dumps({"error": "Invalid JSON input"}))
+                return
+
+        if not has_image(request):
+            print(json.dumps({"error": "No image data provided"}))
+            return
+        apply_request_defaults(request, request_defaults)
 
-        print(json.dumps({
-            "type": "masks",
-            "data": masks_data
-        }))
+        device = pick_device()
+        load_start = time.perf_counter()
+        processor = load_processor(device, interactive=interactive, **(model_options or {}))
+        load_seconds = time.perf_counter() - load_start
+        cache = None
+        if cache_dir:
+            # One-shot runs only benefit from the disk tier
+            cache = EmbeddingCache(cache_bytes, device, disk_dir=cache_dir, disk_bytes=cache_disk_bytes)
+
+        first_mask_at = None
+
+        def emit(record):
+            nonlocal first_mask_at
+            first_mask_at = first_mask_at or time.perf_counter()
+            print(json.dumps(record), flush=True)
+
+        with inference_context(processor):
+            state = prepare_states(processor, [request], cache)[0]
+            if isinstance(state, Exception):
+                raise state
+            response = segment(processor, request, inference_state=state, emit=emit)
+        first_mask_at = first_mask_at or time.perf_counter()
+        response["timing"] = {
+            "loadSeconds": load_seconds,
+            "timeToFirstMaskSeconds": first_mask_at - PROCESS_START,
+        }
+        print(json.dumps(response))
 
     except Exception as e:
         import traceback
         traceback.print_exc(file=sys.stderr)
         print(json.dumps({"error": str(e)}))
 
+
+class BatchStats:
+    """Throughput and latency bookkeeping, bucketed by the size of the batch that served a request."""
+
+    def __init__(self, window=1000):
+        self.window = window
+        self.lock = threading.Lock()
+        self.batches = defaultdict(int)
+        self.images = defaultdict(int)
+        self.busy_seconds = defaultdict(float)
+        self.latencies = defaultdict(lambda: deque(maxlen=self.window))
+
+    def record(self, batch_size, batch_seconds, latencies):
+        with self.lock:
+            self.batches[batch_size] += 1
+            self.images[batch_size] += batch_size
+            self.busy_seconds[batch_size] += batch_seconds
+            self.latencies[batch_size].extend(latencies)
+
+    def report(self):
+        with self.lock:
+            report = {}
+            for batch_size in sorted(self.batches):
+                latencies = np.asarray(self.latencies[batch_size], dtype=np.float64) * 1000.0
+                busy = self.busy_seconds[batch_size]
+                report[str(batch_size)] = {
+                    "batches": self.batches[batch_size],
+                    "images": self.images[batch_size],
+                    "imagesPerSecond": self.images[batch_size] / busy if busy > 0 else None,
+                    "p50LatencyMs": float(np.percentile(latencies, 50)) if len(latencies) else None,
+                    "p99LatencyMs": float(np.percentile(latencies, 99)) if len(latencies) else None,
+                }
+            return report
+
+
+class BatchScheduler:
+    """
+    Dynamic micro-batching in front of Sam3Processor.
+
+    Requests are queued as they arrive. The worker thread takes the first
+    waiting request, keeps collecting for up to `window_ms` or until
+    `max_batch_size` requests are waiting, runs the image encoder once for the
+    whole batch and then hands each caller its own result.
+    """
+
+    def __init__(self, processor, on_result, max_batch_size=4, window_ms=10.0, cache=None):
+        self.processor = processor
+        self.on_result = on_result
+        self.cache = cache
+        self.max_batch_size = max(1, max_batch_size)
+        self.window = max(0.0, window_ms) / 1000.0
+        self.queue = queue.Queue()
+        self.stats = BatchStats()
+        self.thread = threading.Thread(target=self._run, daemon=True)
+
+    def start(self):
+        self.thread.start()
+
+    def submit(self, request, on_result=None):
+        self.queue.put((time.perf_counter(), request, on_result or self.on_result))
+
+    def fail_pending(self, result):
+        while True:
+            try:
+                _, request, on_result = self.queue.get_nowait()
+            except queue.Empty:
+                return
+            on_result(request, dict(result))
+            self.queue.task_done()
+
+    def drain(self):
+        """Block until every submitted request has been answered."""
+        self.queue.join()
+
+    def _collect(self):
+        batch = [self.queue.get()]
+        deadline = time.perf_counter() + self.window
+        while len(batch) < self.max_batch_size:
+            remaining = deadline - time.perf_counter()
+            if remaining <= 0:
+                break
+            try:
+                batch.append(self.queue.get(timeout=remaining))
+            except queue.Empty:
+                break
+        return batch
+
+    def _run(self):
+        while True:
+            batch = self._collect()
+            start = time.perf_counter()
+            latencies = self.run_batch(batch)
+            self.stats.record(len(batch), time.perf_counter() - start, latencies)
+
+    def run_batch(self, batch):
+        """Serve one batch, answering each caller as soon as its result is ready. Returns the latencies."""
+        # No autograd bookkeeping anywhere on the serving path
+        with inference_context(self.processor):
+            return self._run_batch(batch)
+
+    def _run_batch(self, batch):
+        latencies = []
+
+        def finish(enqueued, request, on_result, result):
+            on_result(request, result)
+            latencies.append(time.perf_counter() - enqueued)
+            self.queue.task_done()
+
+        states = prepare_states(self.processor, [request for _, request, _ in batch], self.cache)
+        for (enqueued, request, on_result), state in zip(batch, states):
+            if isinstance(state, Exception):
+                finish(enqueued, request, on_result, {"error": str(state)})
+                continue
+            try:
+                result = segment(
+                    self.processor,
+                    request,
+                    inference_state=state,
+                    emit=lambda record, request=request, on_result=on_result: on_result(request, record),
+                )
+            except Exception as e:
+                import traceback
+                traceback.print_exc(file=sys.stderr)
+                result = {"error": str(e)}
+            finish(enqueued, request, on_result, result)
+        return latencies
+
+
+class SegmentServer:
+    """
+    Long-lived worker that loads the model once and answers many requests.
+
+    The protocol is line-delimited JSON on stdin/stdout. Every request line is
+    an object; an optional "id" is echoed back on the matching response so
+    callers can have several requests in flight. Requests with "op": "health"
+    or "op": "stats" are answered immediately, even while the model is still
+    loading; segmentation requests are queued and micro-batched once the model
+    is ready. Streaming requests get several "mask" records followed by a
+    final "summary" record, all carrying the same id.
+    """
+
+    def __init__(self, device, max_batch_size=4, batch_window_ms=10.0, cache=None, interactive=False,
+                 model_options=None, warmup=False, request_defaults=None):
+        self.device = device
+        self.interactive = interactive
+        self.model_options = model_options or {}
+        self.request_defaults = request_defaults or {}
+        self.warmup = warmup
+        self.max_batch_size = max_batch_size
+        self.batch_window_ms = batch_window_ms
+        self.cache = cache
+        self.scheduler = BatchScheduler(
+            None,
+            self.respond,
+            max_batch_size=max_batch_size,
+            window_ms=batch_window_ms,
+            cache=cache,
+        )
+        self.status = "loading"
+        self.error = None
+        self.started_at = time.time()
+        self.load_seconds = None
+        self.warmup_seconds = None
+        self.time_to_first_mask = None
+        self.requests_served = 0
+        self.write_lock = threading.Lock()
+
+    def emit(self, record):
+        line = json.dumps(record)
+        with self.write_lock:
+            sys.stdout.write(line + "\n")
+            sys.stdout.flush()
+
+    def load(self):
+        start = time.perf_counter()
+        try:
+            processor = load_processor(self.device, interactive=self.interactive, **self.model_options)
+            self.load_seconds = time.perf_counter() - start
+            if self.warmup:
+                self.warmup_seconds = warmup(processor)
+            self.scheduler.processor = processor
+            self.status = "ready"
+            self.scheduler.start()
+            self.emit({
+                "type": "ready",
+                "device": self.device,
+                "loadSeconds": self.load_seconds,
+                "warmupSeconds": self.warmup_seconds,
+            })
+        except Exception as e:
+            import traceback
+            traceback.print_exc(file=sys.stderr)
+            self.status = "error"
+            self.error = str(e)
+            self.emit({"type": "ready", "error": self.error})
+            # Fail whatever was queued while we were loading
+            self.scheduler.fail_pending({"error": f"Model failed to load: {self.error}"})
+
+    def health(self):
+        return {
+            "type": "health",
+            "status": self.status,
+            "ready": self.status == "ready",
+            "device": self.device,
+            "error": self.error,
+            "uptimeSeconds": time.time() - self.started_at,
+            "loadSeconds": self.load_seconds,
+            "warmupSeconds": self.warmup_seconds,
+            "timeToFirstMaskSeconds": self.time_to_first_mask,
+            "cpuProfile": self.model_options.get("cpu_profile", "fp32") if self.device == "cpu" else None,
+            "threads": {"intraOp": torch.get_num_threads(), "interOp": torch.get_num_interop_threads()},
+            "requestsServed": self.requests_served,
+            "maxBatchSize": self.max_batch_size,
+            "batchWindowMs": self.batch_window_ms,
+        }
+
+    def stats(self):
+        return {
+            "type": "stats",
+            "batches": self.scheduler.stats.report(),
+            "cache": self.cache.report() if self.cache else None,
+        }
+
+    def respond(self, request, response):
+        if request.get("id") is not None:
+            response["id"] = request["id"]
+        if response.get("type") in ("masks", "summary"):
+            self.requests_served += 1
+        if self.time_to_first_mask is None and response.get("type") in ("mask", "masks", "summary"):
+            self.time_to_first_mask = time.perf_counter() - PROCESS_START
+            print(f"Time to first mask: {self.time_to_first_mask:.2f}s", file=sys.stderr)
+        self.emit(response)
+
+    def handle(self, request):
+        op = request.get("op")
+        if op == "health":
+            self.respond(request, self.health())
+            return
+        if op == "stats":
+            self.respond(request, self.stats())
+            return
+
+        if self.status == "error":
+            self.respond(request, {"error": f"Model failed to load: {self.error}"})
+            return
+        # Requests that arrive while the model is loading simply wait in the queue
+        self.scheduler.submit(apply_request_defaults(request, self.request_defaults))
+
+    def handle_line(self, line):
+        try:
+            request = json.loads(line)
+        except json.JSONDecodeError:
+            self.emit({"error": "Invalid JSON input"})
+            return
+        self.dispatch(request)
+
+    def dispatch(self, request):
+        try:
+            self.handle(request)
+        except Exception as e:
+            import traceback
+            traceback.print_exc(file=sys.stderr)
+            self.respond(request, {"error": str(e)})
+
+    def read_frames(self):
+        while True:
+            try:
+                request = read_frame(sys.stdin.buffer)
+            except (EOFError, ValueError) as e:
+                # The stream is out of sync; there is no way to find the next frame
+                self.emit({"error": f"Invalid request frame: {e}"})
+                return
+            if request is None:
+                return
+            self.dispatch(request)
+
+    def serve(self, binary=False):
+        threading.Thread(target=self.load, daemon=True).start()
+        if binary:
+            self.read_frames()
+        else:
+            for line in sys.stdin:
+                line = line.strip()
+                if not line:
+                    continue
+                self.handle_line(line)
+        # stdin closed: finish what is already queued before exiting
+        self.scheduler.drain()
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Segment images with SAM3.")
+    parser.add_argument(
+        "--serve",
+        action="store_true",
+        help="Run as a persistent worker speaking line-delimited JSON on stdin/stdout.",
+    )
+    parser.add_argument(
+        "--binary",
+        action="store_true",
+        help="Read length-prefixed binary request frames on stdin instead of JSON.",
+    )
+    parser.add_argument(
+        "--interactive",
+        action="store_true",
+        help="Build the model with the interactive head so requests can use point prompts.",
+    )
+    parser.add_argument(
+        "--max-batch-size",
+        type=int,
+        default=4,
+        help="Serve mode: largest number of images run through the encoder together.",
+    )
+    parser.add_argument(
+        "--batch-window-ms",
+        type=float,
+        default=10.0,
+        help="Serve mode: how long to wait for more requests before running a batch.",
+    )
+    parser.add_argument(
+        "--cache-bytes",
+        type=int,
+        default=1 << 30,
+        help="Serve mode: memory budget for cached image embeddings (0 disables the cache).",
+    )
+    parser.add_argument(
+        "--cache-dir",
+        default=None,
+        help="Directory for the on-disk embedding cache tier.",
+    )
+    parser.add_argument(
+        "--cache-disk-bytes",
+        type=int,
+        default=10 << 30,
+        help="Size budget for the on-disk embedding cache tier.",
+    )
+    parser.add_argument(
+        "--checkpoint",
+        default=None,
+        help="Local SAM3 checkpoint instead of the Hugging Face download.",
+    )
+    parser.add_argument(
+        "--weights-cache",
+        default=os.environ.get("SAM3_WEIGHTS_CACHE"),
+        help="Directory for ready-to-run safetensors weights; later starts map them in directly.",
+    )
+    parser.add_argument(
+        "--weights-dtype",
+        choices=sorted(WEIGHTS_DTYPES),
+        default="float32",
+        help="dtype the model (and the weights cache) is kept in; below float32 only bfloat16 with --cpu-profile bf16.",
+    )
+    parser.add_argument(
+        "--warmup",
+        action="store_true",
+        help="Serve mode: run a throwaway image through the model before reporting ready.",
+    )
+    parser.add_argument(
+        "--cpu-profile",
+        choices=CPU_PROFILES,
+        default=os.environ.get("SAM3_CPU_PROFILE", "fp32"),
+        help="CPU only: bf16 autocast or int8 dynamic quantization of the encoder (see CPU_PROFILES).",
+    )
+    parser.add_argument(
+        "--compile-encoder",
+        action="store_true",
+        help="CPU only: torch.compile the image encoder. The first image pays the compile; combine with --warmup.",
+    )
+    parser.add_argument(
+        "--intra-op-threads",
+        type=int,
+        default=None,
+        help="Threads torch uses inside one op (default: torch's choice, usually the physical cores).",
+    )
+    parser.add_argument(
+        "--inter-op-threads",
+        type=int,
+        default=None,
+        help="Threads torch uses to run independent ops concurrently.",
+    )
+    parser.add_argument(
+        "--max-inference-size",
+        type=int,
+        default=int(os.environ.get("SAM3_MAX_INFERENCE_SIZE", 0)),
+        help="Decode images to at most this many pixels on the longest side (0: full resolution). "
+             "Requests override it with \"maxInferenceSize\".",
+    )
+    parser.add_argument(
+        "--tile-size",
+        type=int,
+        default=DEFAULT_TILE_SIZE,
+        help="Tile size for requests with \"tiles\": true.",
+    )
+    parser.add_argument(
+        "--tile-overlap",
+        type=int,
+        default=DEFAULT_TILE_OVERLAP,
+        help="Pixels neighbouring tiles share, so objects on a seam are seen whole by one of them.",
+    )
+    return parser.parse_args(argv)
+
+
+def main():
+    args = parse_args()
+    error = weights_dtype_error(pick_device(), args.weights_dtype, args.cpu_profile)
+    if error:
+        sys.exit(f"segment.py: {error}")
+    # Before anything runs on torch's thread pools
+    set_cpu_threads(args.intra_op_threads, args.inter_op_threads)
+    model_options = {
+        "checkpoint": args.checkpoint,
+        "weights_cache": args.weights_cache,
+        "weights_dtype": args.weights_dtype,
+        "cpu_profile": args.cpu_profile,
+        "compile_encoder": args.compile_encoder,
+    }
+    request_defaults = {
+        "maxInferenceSize": args.max_inference_size or None,
+        "tileSize": args.tile_size,
+        "tileOverlap": args.tile_overlap,
+    }
+    if args.serve:
+        device = pick_device()
+        cache = None
+        if args.cache_bytes > 0 or args.cache_dir:
+            cache = EmbeddingCache(
+                args.cache_bytes,
+                device,
+                disk_dir=args.cache_dir,
+                disk_bytes=args.cache_disk_bytes,
+            )
+        SegmentServer(
+            device,
+            max_batch_size=args.max_batch_size,
+            batch_window_ms=args.batch_window_ms,
+            cache=cache,
+            interactive=args.interactive,
+            model_options=model_options,
+            warmup=args.warmup,
+            request_defaults=request_defaults,
+        ).serve(binary=args.binary)
+    else:
+        run_once(
+            cache_bytes=args.cache_bytes,
+            cache_dir=args.cache_dir,
+            cache_disk_bytes=args.cache_disk_bytes,
+            interactive=args.interactive,
+            binary=args.binary,
+            model_options=model_options,
+            request_defaults=request_defaults,
+        )
+
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()
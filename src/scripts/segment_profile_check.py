@@ -0,0 +1,199 @@
+"""
+Accuracy and speed check of segment.py's CPU profiles (--cpu-profile) against fp32.
+
+Runs a fixed image set (every image in --images, or --synthetic generated
+scenes) with a fixed list of text prompts through the fp32 model, then
+through every requested profile, one model in memory at a time. For each
+profile it reports the seconds per image, the speedup over fp32, the mean
+mask IoU against the fp32 masks and the worst per-image mean IoU. The masks
+of a prompt are matched to the fp32 ones greedily by IoU; a mask without a
+counterpart on the other side counts as IoU 0, so dropped or extra
+detections show up in the score. A lower --confidence-threshold brings
+the borderline detections into the comparison.
+
+With --validate the exit status is non-zero if a profile's mean IoU is
+below --min-iou.
+
+Usage:
+    python src/scripts/segment_profile_check.py --images data/profile-check --profiles bf16,int8
+    python src/scripts/segment_profile_check.py --synthetic 8 --prompts circle,square --compile-encoder
+"""
+
+import argparse
+import gc
+import os
+import sys
+import time
+
+import cv2
+import numpy as np
+import torch
+from PIL import Image
+
+from segment import (
+    CPU_PROFILES,
+    DEFAULT_PROMPT,
+    inference_context,
+    load_processor,
+    mask_arrays,
+    run_prompt,
+    set_cpu_threads,
+    warmup,
+)
+
+IMAGE_EXTENSIONS = (".jpg", ".jpeg", ".png", ".webp", ".bmp")
+
+
+def load_images(folder):
+    names = sorted(name for name in os.listdir(folder) if name.lower().endswith(IMAGE_EXTENSIONS))
+    return [Image.open(os.path.join(folder, name)).convert("RGB") for name in names]
+
+
+def make_images(count, height, width, seed=0):
+    """Filled circles and squares on a noisy background, the same set on every run."""
+    rng = np.random.default_rng(seed)
+    images = []
+    for _ in range(count):
+        pixels = rng.integers(90, 140, size=(height, width, 3), dtype=np.uint8)
+        for _ in range(rng.integers(2, 7)):
+            color = tuple(int(c) for c in rng.integers(0, 256, size=3))
+            center = (int(rng.integers(0, width)), int(rng.integers(0, height)))
+            radius = int(rng.integers(min(height, width) // 20, min(height, width) // 6))
+            if rng.random() < 0.5:
+                cv2.circle(pixels, center, radius, color, -1)
+            else:
+                corner = (center[0] + radius, center[1] + radius)
+                cv2.rectangle(pixels, center, corner, color, -1)
+        images.append(Image.fromarray(pixels))
+    return images
+
+
+def run_profile(profile, images, prompts, args):
+    """Masks per image and prompt (boolean arrays) and the mean seconds per image."""
+    processor = load_processor(
+        "cpu",
+        checkpoint=args.checkpoint,
+        weights_cache=args.weights_cache,
+        cpu_profile=profile,
+        compile_encoder=args.compile_encoder and profile != "fp32",
+    )
+    if args.confidence_threshold is not None:
+        processor.set_confidence_threshold(args.confidence_threshold)
+    # The first image would otherwise carry kernel selection (and compilation)
+    warmup(processor)
+
+    results = []
+    seconds = 0.0
+    for image in images:
+        start = time.perf_counter()
+        with inference_context(processor):
+            state = processor.set_image(image)
+            per_prompt = []
+            for prompt in prompts:
+                output = run_prompt(processor, state, {"kind": "text", "label": prompt, "prompt": prompt})
+                arrays, _ = mask_arrays(output)
+                per_prompt.append([mask if mask.dtype == bool else mask > 0.5 for mask in arrays])
+        seconds += time.perf_counter() - start
+        results.append(per_prompt)
+
+    # Only one model in memory at a time
+    del processor
+    gc.collect()
+    return results, seconds / len(images)
+
+
+def matched_ious(reference, candidate):
+    """
+    IoU of greedily matched (reference, candidate) mask pairs, best first,
+    followed by a 0 for every mask left without a partner.
+    """
+    if not reference or not candidate:
+        return [0.0] * (len(reference) + len(candidate))
+    ref = np.stack(reference).reshape(len(reference), -1).astype(np.float32)
+    cand = np.stack(candidate).reshape(len(candidate), -1).astype(np.float32)
+    # Pixel counts stay exact in float32 up to 16M pixels per mask
+    intersection = ref @ cand.T
+    union = ref.sum(axis=1)[:, None] + cand.sum(axis=1)[None, :] - intersection
+    iou = np.where(union > 0, intersection / np.maximum(union, 1), 1.0)
+
+    ious = []
+    while iou.size and iou.max() >= 0:
+        i, j = np.unravel_index(np.argmax(iou), iou.shape)
+        ious.append(float(iou[i, j]))
+        iou[i, :] = -1
+        iou[:, j] = -1
+    return ious + [0.0] * (len(reference) + len(candidate) - 2 * len(ious))
+
+
+def compare(reference, results):
+    """(mean IoU over all masks, worst per-image mean IoU, reference mask count, profile mask count)."""
+    all_ious = []
+    image_means = []
+    reference_count = count = 0
+    for reference_image, image in zip(reference, results):
+        image_ious = []
+        for reference_masks, masks in zip(reference_image, image):
+            image_ious += matched_ious(reference_masks, masks)
+            reference_count += len(reference_masks)
+            count += len(masks)
+        all_ious += image_ious
+        # An image where neither side found anything agrees perfectly
+        image_means.append(float(np.mean(image_ious)) if image_ious else 1.0)
+    mean = float(np.mean(all_ious)) if all_ious else 1.0
+    return mean, min(image_means), reference_count, count
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--images", default=None, help="Folder with the fixed image set.")
+    parser.add_argument("--synthetic", type=int, default=4, help="Generated images when --images is not given.")
+    parser.add_argument("--size", default="1008x1008", help="HxW of the generated images.")
+    parser.add_argument("--prompts", default=DEFAULT_PROMPT, help="Comma separated text prompts.")
+    parser.add_argument("--profiles", default=",".join(p for p in CPU_PROFILES if p != "fp32"))
+    parser.add_argument(
+        "--confidence-threshold",
+        type=float,
+        default=None,
+        help="Processor threshold (default: its own); lower compares low scoring masks too.",
+    )
+    parser.add_argument("--compile-encoder", action="store_true", help="Also compile the encoder of the profiles.")
+    parser.add_argument("--checkpoint", default=None)
+    parser.add_argument("--weights-cache", default=os.environ.get("SAM3_WEIGHTS_CACHE"))
+    parser.add_argument("--intra-op-threads", type=int, default=None)
+    parser.add_argument("--inter-op-threads", type=int, default=None)
+    parser.add_argument("--validate", action="store_true")
+    parser.add_argument("--min-iou", type=float, default=0.9)
+    args = parser.parse_args()
+
+    set_cpu_threads(args.intra_op_threads, args.inter_op_threads)
+    if args.images:
+        images = load_images(args.images)
+    else:
+        height, width = (int(n) for n in args.size.lower().split("x"))
+        images = make_images(args.synthetic, height, width)
+    if not images:
+        sys.exit(f"No images found in {args.images}")
+    prompts = args.prompts.split(",")
+
+    reference, reference_seconds = run_profile("fp32", images, prompts, args)
+    failures = []
+    print(f"{len(images)} images, prompts {prompts}, {torch.get_num_threads()} intra-op threads")
+    print(f"{'profile':>8} {'s/img':>8} {'speedup':>8} {'mean IoU':>9} {'worst img':>10} {'masks':>11}")
+    print(f"{'fp32':>8} {reference_seconds:>8.2f} {1.0:>7.2f}x {1.0:>9.4f} {1.0:>10.4f}")
+    for profile in args.profiles.split(","):
+        results, seconds = run_profile(profile, images, prompts, args)
+        mean, worst, reference_count, count = compare(reference, results)
+        print(
+            f"{profile:>8} {seconds:>8.2f} {reference_seconds / seconds:>7.2f}x {mean:>9.4f} "
+            f"{worst:>10.4f} {count:>5}/{reference_count:<5}"
+        )
+        if mean < args.min_iou:
+            failures.append(f"{profile}: mean IoU {mean:.4f} < {args.min_iou}")
+
+    if args.validate and failures:
+        print("\nValidation failed:\n  " + "\n  ".join(failures))
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()